@@ -0,0 +1,164 @@
+"""
+measures how long the print server takes from being started to
+answering /live and to being /ready to print, i.e. after a container
+restart. the server runs as its own process with --setup-cups, the way
+what.sh starts it, against fake cups client tools. the fake cups
+scheduler comes up --cups-start-seconds after the server is started,
+so ready_ms minus that is what the server adds on top of cups.
+
+$ python benchmark/cold_start.py --runs 10 --output baseline.json
+"""
+import argparse
+import json
+import os
+import pathlib
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+import harness
+
+
+# cups is up once the cups-up file exists, and lpadmin marks a printer
+# as added with a file
+FAKE_LPSTAT = """#!/bin/sh
+[ -f "{directory}/cups-up" ] || {{ echo "scheduler is not running"; exit 1; }}
+case "$1" in
+    -r) echo "scheduler is running" ;;
+    -a) shift; for name; do [ -f "{directory}/added-$name" ] && echo "$name accepting requests since Fri 17 Jul 2025 02:40:12 PM UTC"; done ;;
+esac
+exit 0
+"""
+FAKE_LPADMIN = """#!/bin/sh
+touch "{directory}/added-$2"
+"""
+CONFIG = {
+    "PRINTING": {
+        "LEFT": {"ENABLED": True, "NAME": "left-printer", "LPD_URL": "lpd://127.0.0.1"},
+        "RIGHT": {"ENABLED": True, "NAME": "right-printer", "LPD_URL": "lpd://127.0.0.1"},
+    }
+}
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="number of times the server is started. defaults to 10",
+    )
+    parser.add_argument(
+        "--cups-start-seconds",
+        type=float,
+        default=1,
+        help="how long after the server is started the fake cups scheduler comes up. defaults to 1",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="value passed to the server's flag of the same name. defaults to 1",
+    )
+    harness.add_output_args(parser)
+    return parser.parse_args()
+
+
+def install_fake_cups(directory: pathlib.Path):
+    for name, script in [("lpstat", FAKE_LPSTAT), ("lpadmin", FAKE_LPADMIN)]:
+        path = directory / name
+        path.write_text(script.format(directory=directory))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(client: httpx.Client, path: str, started_at: float, timeout=60) -> float:
+    """
+    returns how many seconds after started_at path first answered 200.
+    """
+    while time.time() - started_at < timeout:
+        try:
+            if client.get(path).status_code == 200:
+                return time.time() - started_at
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f"{path} didn't answer 200 within {timeout} seconds")
+
+
+def start_once(directory: pathlib.Path, args: argparse.Namespace) -> tuple:
+    for leftover in directory.glob("added-*"):
+        leftover.unlink()
+    (directory / "cups-up").unlink(missing_ok=True)
+    port = get_free_port()
+    started_at = time.time()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(harness.PRINTER_DIRECTORY / "server.py"),
+            "--setup-cups",
+            "--host=127.0.0.1",
+            f"--port={port}",
+            f"--workers={args.workers}",
+            f"--config-json-path={directory / 'config.json'}",
+            f"--job-database-path={directory / 'jobs.db'}",
+            f"--spool-directory={directory / 'spool'}",
+            f"--background-lock-path={directory / 'background.lock'}",
+            f"--prometheus-multiproc-dir={directory / 'metrics'}",
+        ],
+        cwd=harness.PRINTER_DIRECTORY,
+        env={**os.environ, "QUASAR_STARTED_AT": str(started_at)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    cups = threading.Timer(args.cups_start_seconds, (directory / "cups-up").touch)
+    cups.start()
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1) as client:
+            live_seconds = wait_for(client, "/live", started_at)
+            ready_seconds = wait_for(client, "/ready", started_at)
+    finally:
+        cups.cancel()
+        server.terminate()
+        server.wait()
+    return live_seconds, ready_seconds
+
+
+def summarize(seconds: list) -> dict:
+    results = harness.summarize(seconds, sum(seconds))
+    # neither means anything here, the server is its own process and
+    # there's one start per run
+    del results["rps"], results["peak_rss_mb"]
+    return results
+
+
+def main():
+    args = get_args()
+    config = {"runs": args.runs, "cups_start_seconds": args.cups_start_seconds, "workers": args.workers}
+    with tempfile.TemporaryDirectory() as directory:
+        directory = pathlib.Path(directory)
+        install_fake_cups(directory)
+        (directory / "config.json").write_text(json.dumps(CONFIG))
+        runs = [start_once(directory, args) for _ in range(args.runs)]
+    results = {
+        "live": summarize([live for live, _ in runs]),
+        "ready": summarize([ready for _, ready in runs]),
+        "ready_after_cups": summarize([ready - args.cups_start_seconds for _, ready in runs]),
+    }
+    harness.report(args, "cold_start", config, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+measures how long a scrape cycle of the snmp collector takes against
+--devices simulated printers on localhost, each answering after
+--agent-latency-ms. the simulated printer is the one the collector's
+tests use. needs the collector's requirements (pysnmp), not the print
+server's:
+
+$ pip install -r collector/requirements.txt
+$ python benchmark/collector_cycle.py --devices 4 --cycles 50 --output baseline.json
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import harness
+
+sys.path.insert(0, str(harness.COLLECTOR_DIRECTORY))
+import server  # noqa: E402
+from test_server import FakePrinterAgent  # noqa: E402
+
+
+PRINTER_VALUES = {
+    server.SnmpOid.INK_LEVEL.metric_value: 800,
+    server.SnmpOid.INK_CAPACITY.metric_value: 1000,
+    server.SnmpOid.PAGE_COUNT.metric_value: 123456,
+    # TRAY_EMPTY_2 is left out, so every cycle also goes through the
+    # retry the collector does when a printer doesn't have an oid
+    server.SnmpOid.TRAY_EMPTY.metric_value: 1,
+}
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=4,
+        help="number of simulated printers, each on its own 127.0.0.x address. defaults to 4",
+    )
+    parser.add_argument(
+        "--cycles",
+        type=int,
+        default=50,
+        help="number of scrape cycles to time. defaults to 50",
+    )
+    parser.add_argument(
+        "--agent-latency-ms",
+        type=float,
+        default=5,
+        help="how long each simulated printer takes to answer a request. defaults to 5",
+    )
+    harness.add_output_args(parser)
+    return parser.parse_args()
+
+
+async def run(devices: list, cycles: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(cycles):
+        cycle_start = time.perf_counter()
+        await server.scrape_devices(devices)
+        latencies.append(time.perf_counter() - cycle_start)
+    return harness.summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    args = get_args()
+    config = {
+        "devices": args.devices,
+        "cycles": args.cycles,
+        "agent_latency_ms": args.agent_latency_ms,
+    }
+    agents = [
+        FakePrinterAgent(PRINTER_VALUES, args.agent_latency_ms / 1000, ip=f"127.0.0.{i + 1}")
+        for i in range(args.devices)
+    ]
+    devices = [
+        server.SnmpDevice(ip=agent.socket.getsockname()[0], port=agent.port, timeout_seconds=1, retries=0)
+        for agent in agents
+    ]
+    try:
+        results = {"collector_cycle": asyncio.run(run(devices, args.cycles))}
+    finally:
+        for agent in agents:
+            agent.close()
+    # each printer gets two requests a cycle, the second after it
+    # turns down tray_empty_2
+    results["collector_cycle"]["snmp_requests"] = sum(agent.requests for agent in agents)
+    harness.report(args, "collector_cycle", config, results)
+
+
+if __name__ == "__main__":
+    main()
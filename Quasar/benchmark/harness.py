@@ -0,0 +1,192 @@
+"""
+shared pieces of the benchmarks in this directory: a fake `lp`, loading
+the print server in-process, latency stats and saving/comparing results.
+
+every benchmark takes --output to write its results as json, and
+--baseline to compare against an earlier --output. anything more than
+--tolerance worse than the baseline is printed and the script exits
+with 1, so it can gate a release:
+
+$ python benchmark/print_throughput.py --output before.json
+$ git checkout new-release
+$ python benchmark/print_throughput.py --baseline before.json
+"""
+import datetime
+import json
+import os
+import pathlib
+import platform
+import resource
+import stat
+import statistics
+import subprocess
+import sys
+
+PRINTER_DIRECTORY = pathlib.Path(__file__).resolve().parent.parent / "printer"
+COLLECTOR_DIRECTORY = pathlib.Path(__file__).resolve().parent.parent / "collector"
+
+# the real lp copies the file into the CUPS spool, so the fake one
+# deletes the file it was given to keep /tmp from filling up.
+FAKE_LP = """#!/bin/sh
+sleep {latency}
+for last; do :; done
+rm -f "$last"
+echo "request id is fake-printer-1 (1 file(s))"
+"""
+
+# metric name -> True if bigger is better
+COMPARED_METRICS = {
+    "rps": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def add_output_args(parser):
+    parser.add_argument(
+        "--output",
+        help="write the results to this json file, i.e. to use as a --baseline later",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="json file written by an earlier --output to compare the results against",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="how much worse than the baseline a result can be before it counts as a regression. defaults to 0.2 (20%%)",
+    )
+
+
+def install_fake_lp(directory: str, latency: float):
+    lp_path = pathlib.Path(directory) / "lp"
+    lp_path.write_text(FAKE_LP.format(latency=latency))
+    lp_path.chmod(lp_path.stat().st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+
+def load_server(directory: str, argv: list):
+    """
+    imports printer/server.py with the given flags. its database and
+    spool directory go in directory, and the limits that would turn
+    away or hold back a benchmark's requests (i.e. all coming from one
+    client) are turned off unless argv sets them.
+    """
+    sys.path.insert(0, str(PRINTER_DIRECTORY))
+    os.environ.setdefault("RIGHT_PRINTER_NAME", "fake-printer")
+    sys.argv = [
+        "server.py",
+        f"--job-database-path={pathlib.Path(directory) / 'jobs.db'}",
+        f"--spool-directory={pathlib.Path(directory) / 'spool'}",
+        "--client-requests-per-minute=0",
+        "--max-admitted-jobs=100000",
+        "--max-admitted-mb=100000",
+        # there's only a fake lp, no queue to wait on
+        "--max-cups-queue-depth=0",
+        *argv,
+    ]
+    import server
+
+    return server
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux, the highest it's been since the process
+    # started, so it only ever goes up from one case to the next
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summarize(latencies: list, elapsed_seconds: float) -> dict:
+    milliseconds = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed_seconds, 3),
+        "rps": round(len(latencies) / elapsed_seconds, 2),
+        "p50_ms": round(statistics.median(milliseconds), 2),
+        "p99_ms": round(percentile(milliseconds, 99), 2),
+        "max_ms": round(max(milliseconds), 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PRINTER_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    returns a line for every case and metric in results that's more
+    than tolerance worse than in the baseline.
+    """
+    regressions = []
+    for case, metrics in results.items():
+        for name, bigger_is_better in COMPARED_METRICS.items():
+            before = baseline.get(case, {}).get(name)
+            after = metrics.get(name)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (bigger_is_better and change < -tolerance) or (
+                not bigger_is_better and change > tolerance
+            ):
+                regressions.append(f"{case} {name}: {before} -> {after} ({change:+.0%})")
+    return regressions
+
+
+def report(args, benchmark: str, config: dict, results: dict):
+    """
+    prints results (case -> metrics), writes them to --output and
+    compares them to --baseline, exiting with 1 on a regression.
+    """
+    columns = ["requests", "rps", "p50_ms", "p99_ms", "max_ms", "peak_rss_mb"]
+    print(f"{benchmark}: {json.dumps(config)}")
+    print(f"{'case':<20}" + "".join(f"{column:>14}" for column in columns))
+    for case, metrics in results.items():
+        print(f"{case:<20}" + "".join(f"{metrics.get(column, ''):>14}" for column in columns))
+
+    if args.output:
+        pathlib.Path(args.output).write_text(
+            json.dumps(
+                {
+                    "benchmark": benchmark,
+                    "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "git_commit": get_git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "config": config,
+                    "results": results,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"wrote {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text())
+        if baseline.get("config") != config:
+            print("warning: the baseline was run with a different config, the comparison may not mean much")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
@@ -0,0 +1,119 @@
+"""
+measures /healthcheck/printer latency while a batch of large uploads
+are hitting /print at the same time. if printing ever blocks the event
+loop again, the p99 below jumps from milliseconds to however long
+`lp` takes to run.
+
+the server is driven in-process through httpx's ASGI transport, and a
+fake `lp` that sleeps is put at the front of PATH so uploads take the
+real subprocess path without needing CUPS. run it with:
+
+$ python benchmark/healthcheck_latency.py --uploads 8 --upload-size-mb 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+import harness
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--uploads",
+        type=int,
+        default=8,
+        help="number of concurrent uploads to send to /print. defaults to 8",
+    )
+    parser.add_argument(
+        "--upload-size-mb",
+        type=int,
+        default=20,
+        help="size of each upload in megabytes. defaults to 20",
+    )
+    parser.add_argument(
+        "--lp-latency-seconds",
+        type=float,
+        default=2,
+        help="how long the fake lp command takes to return. defaults to 2",
+    )
+    parser.add_argument(
+        "--max-concurrent-print-jobs",
+        type=int,
+        default=4,
+        help="value passed to the server's flag of the same name. defaults to 4",
+    )
+    parser.add_argument(
+        "--health-check-interval-seconds",
+        type=float,
+        default=0.01,
+        help="time between health check requests. defaults to 0.01",
+    )
+    return parser.parse_args()
+
+
+async def upload(client: httpx.AsyncClient, payload: bytes):
+    response = await client.post(
+        "/print",
+        files={"file": ("bench.pdf", payload, "application/pdf")},
+        data={"copies": "1", "sides": "one-sided"},
+    )
+    response.raise_for_status()
+
+
+async def run(args: argparse.Namespace, app) -> list:
+    payload = os.urandom(args.upload_size_mb * 1024 * 1024)
+    transport = httpx.ASGITransport(app=app)
+    latencies = []
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        uploads = asyncio.gather(
+            *(upload(client, payload) for _ in range(args.uploads))
+        )
+        uploads_task = asyncio.ensure_future(uploads)
+        while not uploads_task.done():
+            start = time.perf_counter()
+            response = await client.get("/healthcheck/printer")
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+            await asyncio.sleep(args.health_check_interval_seconds)
+        await uploads_task
+    return latencies
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as directory:
+        harness.install_fake_lp(directory, args.lp_latency_seconds)
+        server = harness.load_server(
+            directory,
+            [
+                f"--max-concurrent-print-jobs={args.max_concurrent_print_jobs}",
+                "--dedupe-window-seconds=0",
+            ],
+        )
+        start = time.perf_counter()
+        latencies = asyncio.run(run(args, server.app))
+        elapsed = time.perf_counter() - start
+
+    milliseconds = [latency * 1000 for latency in latencies]
+    print(
+        f"{args.uploads} uploads of {args.upload_size_mb} MB, "
+        f"lp latency {args.lp_latency_seconds}s, "
+        f"--max-concurrent-print-jobs={args.max_concurrent_print_jobs}"
+    )
+    print(f"total time: {elapsed:.2f}s")
+    print(f"health checks sent: {len(milliseconds)}")
+    print(f"health check p50: {statistics.median(milliseconds):.1f}ms")
+    print(f"health check p99: {harness.percentile(milliseconds, 99):.1f}ms")
+    print(f"health check max: {max(milliseconds):.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+measures what a prometheus scrape of the print server's /metrics
+costs, both on a fresh server and after --prints jobs have filled in
+the histograms and per printer series. run it with:
+
+$ python benchmark/metrics_scrape.py --scrapes 500 --output baseline.json
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import harness
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scrapes",
+        type=int,
+        default=500,
+        help="number of /metrics requests sent for each case. defaults to 500",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="how many scrapes are in flight at once. defaults to 1, like a single prometheus",
+    )
+    parser.add_argument(
+        "--prints",
+        type=int,
+        default=200,
+        help="number of print jobs sent before the second case. defaults to 200",
+    )
+    harness.add_output_args(parser)
+    return parser.parse_args()
+
+
+async def scrape(client: httpx.AsyncClient) -> tuple:
+    start = time.perf_counter()
+    response = await client.get("/metrics")
+    response.raise_for_status()
+    return time.perf_counter() - start, len(response.content)
+
+
+async def run_case(client: httpx.AsyncClient, scrapes: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_scrape():
+        async with semaphore:
+            return await scrape(client)
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(limited_scrape() for _ in range(scrapes)))
+    elapsed = time.perf_counter() - start
+    results = harness.summarize([latency for latency, _ in responses], elapsed)
+    results["response_bytes"] = responses[-1][1]
+    return results
+
+
+async def print_jobs(client: httpx.AsyncClient, prints: int):
+    for _ in range(prints):
+        response = await client.post(
+            "/print",
+            files={"file": ("bench.pdf", os.urandom(1024), "application/pdf")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+        response.raise_for_status()
+
+
+async def run(app, args: argparse.Namespace) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        results = {"metrics_fresh": await run_case(client, args.scrapes, args.concurrency)}
+        await print_jobs(client, args.prints)
+        results["metrics_after_prints"] = await run_case(client, args.scrapes, args.concurrency)
+    return results
+
+
+def main():
+    args = get_args()
+    config = {"scrapes": args.scrapes, "concurrency": args.concurrency, "prints": args.prints}
+    with tempfile.TemporaryDirectory() as directory:
+        harness.install_fake_lp(directory, 0)
+        server = harness.load_server(directory, [])
+        results = asyncio.run(run(server.app, args))
+    harness.report(args, "metrics_scrape", config, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+measures /print throughput and latency for a few upload sizes. every
+size gets --requests uploads, --concurrency of them in flight at once.
+
+like healthcheck_latency.py, the server runs in-process behind httpx's
+ASGI transport and a fake `lp` that sleeps for --lp-latency-seconds
+stands in for CUPS. run it with:
+
+$ python benchmark/print_throughput.py --upload-sizes-kb 16,1024,16384 --output baseline.json
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import harness
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--upload-sizes-kb",
+        default="16,1024,16384",
+        help="comma separated sizes of the uploads to send, one case each. defaults to 16,1024,16384",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="number of uploads sent for each size. defaults to 64",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="how many uploads are in flight at once. defaults to 16",
+    )
+    parser.add_argument(
+        "--lp-latency-seconds",
+        type=float,
+        default=0.05,
+        help="how long the fake lp command takes to return. defaults to 0.05",
+    )
+    parser.add_argument(
+        "--max-concurrent-print-jobs",
+        type=int,
+        default=4,
+        help="value passed to the server's flag of the same name. defaults to 4",
+    )
+    harness.add_output_args(parser)
+    return parser.parse_args()
+
+
+async def upload(client: httpx.AsyncClient, payload: bytes) -> float:
+    start = time.perf_counter()
+    response = await client.post(
+        "/print",
+        files={"file": ("bench.pdf", payload, "application/pdf")},
+        data={"copies": "1", "sides": "one-sided"},
+    )
+    response.raise_for_status()
+    if "print_id" not in response.json():
+        raise RuntimeError(f"print failed: {response.text}")
+    return time.perf_counter() - start
+
+
+async def run_case(app, payload: bytes, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited_upload(client):
+        async with semaphore:
+            return await upload(client, payload)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(limited_upload(client) for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+    return harness.summarize(latencies, elapsed)
+
+
+def main():
+    args = get_args()
+    sizes_kb = [int(size) for size in args.upload_sizes_kb.split(",")]
+    config = {
+        "upload_sizes_kb": sizes_kb,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "lp_latency_seconds": args.lp_latency_seconds,
+        "max_concurrent_print_jobs": args.max_concurrent_print_jobs,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        harness.install_fake_lp(directory, args.lp_latency_seconds)
+        server = harness.load_server(
+            directory,
+            [
+                f"--max-concurrent-print-jobs={args.max_concurrent_print_jobs}",
+                f"--max-upload-size-mb={max(sizes_kb) // 1024 + 1}",
+                # every upload of a case is the same bytes
+                "--dedupe-window-seconds=0",
+            ],
+        )
+        for size_kb in sizes_kb:
+            payload = os.urandom(size_kb * 1024)
+            results[f"print_{size_kb}kb"] = asyncio.run(
+                run_case(server.app, payload, args.requests, args.concurrency)
+            )
+    harness.report(args, "print_throughput", config, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
-import time
+import asyncio
 import argparse
-from threading import Thread
+import collections
 import enum
+import json
 import logging
+import time
 
 from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 import prometheus_client
-from pysnmp.hlapi import *
+from pysnmp.hlapi.v3arch.asyncio import *
 import uvicorn
 
 snmp_metric = prometheus_client.Gauge(
@@ -22,14 +24,27 @@ snmp_error = prometheus_client.Gauge(
     ["name", "ip"],
 )
 
-snmp_req_duration = prometheus_client.Summary(
+snmp_req_duration = prometheus_client.Histogram(
     "snmp_request_duration",
-    "Time it took for SNMP request",
+    "Time it took for SNMP request, every OID is fetched in the same one",
+    ["ip"],
+)
+
+snmp_scrape_cycle_duration = prometheus_client.Histogram(
+    "snmp_scrape_cycle_duration",
+    "Time it took to scrape every device that was due",
 )
 
 device_unreachable = prometheus_client.Gauge(
     "device_unreachable",
-    "set to 1 when error",
+    "set to 1 when the last request to the device got no response",
+    ["ip"],
+)
+
+snmp_last_success = prometheus_client.Gauge(
+    "snmp_last_success_timestamp",
+    "epoch time of the last response from the device",
+    ["ip"],
 )
 
 app = FastAPI()
@@ -65,27 +80,150 @@ class SnmpOid(enum.Enum):
         self.metric_value = metric_value
         self.is_error = is_error
 
-def scrape_snmp(ip_list):
+# one per printer we scrape. timeout and retries apply to each
+# request sent to the device, so a slow printer only holds up itself
+SnmpDevice = collections.namedtuple(
+    "SnmpDevice", ["ip", "port", "timeout_seconds", "retries"]
+)
+
+# every request goes through this one engine. it's created the first
+# time it's needed so that it binds to the running event loop.
+snmp_engine = None
+
+
+def get_snmp_engine():
+    global snmp_engine
+    if snmp_engine is None:
+        snmp_engine = SnmpEngine()
+    return snmp_engine
+
+
+def load_devices(config_json_path, timeout_seconds, retries):
+    """
+    returns a device for each enabled printer in config.json. a printer
+    can override the timeout and retries with SNMP_TIMEOUT_SECONDS and
+    SNMP_RETRIES.
+    """
+    with open(config_json_path) as f:
+        printing = json.load(f)["PRINTING"]
+    devices = {}
+    for printer in printing.values():
+        if not printer.get("ENABLED") or printer["IP"] in devices:
+            continue
+        devices[printer["IP"]] = SnmpDevice(
+            ip=printer["IP"],
+            port=printer.get("SNMP_PORT", 161),
+            timeout_seconds=printer.get("SNMP_TIMEOUT_SECONDS", timeout_seconds),
+            retries=printer.get("SNMP_RETRIES", retries),
+        )
+    return list(devices.values())
+
+
+# used by --scrape-mode=on-demand. ip -> time.monotonic() of the
+# last scrape of that device that finished
+last_scraped = {}
+# ip -> the scrape of that device currently running, so concurrent
+# /metrics requests share one fetch instead of each sending their own
+in_flight_scrapes = {}
+
+
+def refresh_device(device):
+    """
+    returns the running scrape of the device, starting one if there
+    isn't one already.
+    """
+    task = in_flight_scrapes.get(device.ip)
+    if task is not None:
+        return task
+
+    def finish(_):
+        last_scraped[device.ip] = time.monotonic()
+        del in_flight_scrapes[device.ip]
+
+    task = asyncio.create_task(scrape_device(device))
+    task.add_done_callback(finish)
+    in_flight_scrapes[device.ip] = task
+    return task
+
+
+async def refresh_stale_devices(devices, ttl_seconds, wait_seconds):
+    """
+    scrapes every device whose metrics are older than ttl_seconds.
+    if a device takes longer than wait_seconds to answer we stop
+    waiting and serve its old values, the scrape keeps going in the
+    background and the next request gets the fresh ones.
+    """
+    now = time.monotonic()
+    stale_devices = [
+        device
+        for device in devices
+        if device.ip not in last_scraped
+        or now - last_scraped[device.ip] > ttl_seconds
+    ]
+    if not stale_devices:
+        return
+    with snmp_scrape_cycle_duration.time():
+        await asyncio.wait(
+            [refresh_device(device) for device in stale_devices],
+            timeout=wait_seconds,
+        )
+
+
+async def scrape_snmp(devices):
     while True:
-        for ip in ip_list:
-            get_snmp_data(ip)
-        time.sleep(args.sleep_duration_minutes * 60)
-
-def get_snmp_data(ip):
-    for oid in SnmpOid:
-        with snmp_req_duration.time():
-            errorIndication, errorStatus, errorIndex, varBinds = next(
-            getCmd(SnmpEngine(),
+        await scrape_devices(devices)
+        await asyncio.sleep(args.sleep_duration_minutes * 60)
+
+
+async def scrape_devices(devices):
+    with snmp_scrape_cycle_duration.time():
+        await asyncio.gather(*(scrape_device(device) for device in devices))
+
+
+async def scrape_device(device):
+    """
+    get_snmp_data, but a device that makes it raise only stops its own
+    scrape, and the error gets logged instead of killing scrape_snmp
+    (or sitting in a task nobody awaits).
+    """
+    try:
+        await get_snmp_data(device)
+    except Exception:
+        logging.exception(f"Scraping {device.ip} failed")
+
+
+async def get_snmp_data(device):
+    ip = device.ip
+    # all OIDs go out in a single GET. SNMPv1 fails the whole request
+    # if any one of them is missing and points errorIndex at it, so we
+    # drop that OID and ask again for the rest.
+    oids = list(SnmpOid)
+    while oids:
+        start = time.perf_counter()
+        errorIndication, errorStatus, errorIndex, varBinds = await get_cmd(
+            get_snmp_engine(),
             CommunityData('public', mpModel=0),
-            UdpTransportTarget((ip, 161)),
+            await UdpTransportTarget.create(
+                (ip, device.port),
+                timeout=device.timeout_seconds,
+                retries=device.retries,
+            ),
             ContextData(),
-            ObjectType(ObjectIdentity(oid.metric_value)))
-            )
+            *(ObjectType(ObjectIdentity(oid.metric_value)) for oid in oids),
+        )
+        snmp_req_duration.labels(ip=ip).observe(time.perf_counter() - start)
         if errorIndication:
-            logging.error(f"Error indication from {ip} for metric {oid.metric_value}: {errorIndication}")
-            device_unreachable.set(1)
-            continue
+            logging.error(f"Error indication from {ip}: {errorIndication}")
+            device_unreachable.labels(ip=ip).set(1)
+            return
+        # any response, even an error status, means the device is up
+        device_unreachable.labels(ip=ip).set(0)
+        snmp_last_success.labels(ip=ip).set_to_current_time()
         if errorStatus:
+            if not errorIndex:
+                logging.error(f"Error status from {ip}: {errorStatus.prettyPrint()}")
+                return
+            oid = oids.pop(int(errorIndex) - 1)
             logging.error(f"Error status from {ip} for metric {oid.metric_value}: {errorStatus.prettyPrint()}")
             # SNMP OIDs related to errors often dissappear when
             # the associated issue that the metric refers to is
@@ -97,17 +235,27 @@ def get_snmp_data(ip):
                 snmp_error.labels(name=oid.metric_name, ip=ip).set(0)
             continue
 
-        device_unreachable.set(0)
-        if not varBinds:
-            continue
-        res = varBinds[0]
-        if oid.is_error:
-            snmp_error.labels(name=oid.metric_name, ip=ip).set(1)
-            continue
-        snmp_metric.labels(name=oid.metric_name, ip=ip).set(res[1])
+        for oid, res in zip(oids, varBinds):
+            if oid.is_error:
+                snmp_error.labels(name=oid.metric_name, ip=ip).set(1)
+                continue
+            snmp_metric.labels(name=oid.metric_name, ip=ip).set(res[1])
+        return
+
+@app.on_event("startup")
+async def start_scraping():
+    if args.scrape_mode != "interval":
+        return
+    # the task is kept on app.state so it isn't garbage collected
+    app.state.scrape_task = asyncio.create_task(scrape_snmp(app.state.devices))
+
 
 @app.get("/metrics")
 async def metrics():
+    if args.scrape_mode == "on-demand":
+        await refresh_stale_devices(
+            app.state.devices, args.cache_ttl_seconds, args.refresh_wait_seconds
+        )
     return Response(
         content=prometheus_client.generate_latest(),
         media_type="text/plain",
@@ -118,8 +266,8 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--config-json-path",
-        help="List of IP addresses of snmp agent (default: 192.168.69.208,192.168.69.149)",
-        default="config\config.json"
+        help="path to config json, the IP of every enabled printer in it is scraped",
+        default="config/config.json"
     )
     parser.add_argument(
         "--host",
@@ -139,11 +287,42 @@ if __name__ == "__main__":
         default=2
     )
 
+    parser.add_argument(
+        "--scrape-mode",
+        choices=["interval", "on-demand"],
+        help="interval scrapes every --sleep-duration-minutes. on-demand scrapes when /metrics is requested and the last scrape is older than --cache-ttl-seconds, default is interval",
+        default="interval"
+    )
+    parser.add_argument(
+        "--cache-ttl-seconds",
+        type=float,
+        help="with --scrape-mode=on-demand, how old a device's metrics can get before /metrics scrapes it again, default is 30",
+        default=30
+    )
+    parser.add_argument(
+        "--refresh-wait-seconds",
+        type=float,
+        help="with --scrape-mode=on-demand, how long /metrics waits on a slow device before serving its previous values, default is 2",
+        default=2
+    )
+    parser.add_argument(
+        "--snmp-timeout-seconds",
+        type=float,
+        help="how long to wait for a printer to answer each request, default is 1",
+        default=1
+    )
+    parser.add_argument(
+        "--snmp-retries",
+        type=int,
+        help="how many times a request to a printer is retried after a timeout, default is 2",
+        default=2
+    )
+
     args = parser.parse_args()
-    ip_list = args.ips.split(',')
+    app.state.devices = load_devices(
+        args.config_json_path, args.snmp_timeout_seconds, args.snmp_retries
+    )
 
-    thread = Thread(target = scrape_snmp, args=(ip_list,), daemon=True)
-    thread.start()
     uvicorn.run(
         app, 
         host=args.host, 
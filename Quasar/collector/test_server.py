@@ -0,0 +1,227 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api
+import prometheus_client
+
+import server
+
+
+INK_LEVEL_OID = server.SnmpOid.INK_LEVEL.metric_value
+
+
+class FakePrinterAgent:
+    """
+    answers SNMPv1 GETs from a dict of OID -> integer on a local UDP
+    port. like the printers, asking for an OID it doesn't have fails
+    the whole request with noSuchName pointing at that OID.
+    """
+
+    def __init__(self, values, delay_seconds=0, ip="127.0.0.1"):
+        self.values = values
+        self.delay_seconds = delay_seconds
+        self.requests = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((ip, 0))
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        protocol = api.PROTOCOL_MODULES[api.SNMP_VERSION_1]
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except OSError:
+                return
+            self.requests += 1
+            request, _ = decoder.decode(data, asn1Spec=protocol.Message())
+            request_pdu = protocol.apiMessage.get_pdu(request)
+            response = protocol.apiMessage.get_response(request)
+            response_pdu = protocol.apiMessage.get_pdu(response)
+
+            var_binds = []
+            for i, (oid, _) in enumerate(protocol.apiPDU.get_varbinds(request_pdu)):
+                value = self.values.get(str(oid))
+                if value is None:
+                    protocol.apiPDU.set_error_status(response_pdu, 2)  # noSuchName
+                    protocol.apiPDU.set_error_index(response_pdu, i + 1)
+                    var_binds = protocol.apiPDU.get_varbinds(request_pdu)
+                    break
+                var_binds.append((oid, protocol.Integer(value)))
+            protocol.apiPDU.set_varbinds(response_pdu, var_binds)
+
+            time.sleep(self.delay_seconds)
+            self.socket.sendto(encoder.encode(response), address)
+
+    def close(self):
+        self.socket.close()
+
+
+def get_sample(metric_name, **labels):
+    return prometheus_client.REGISTRY.get_sample_value(metric_name, labels)
+
+
+class TestSnmpScrape(unittest.TestCase):
+    def setUp(self):
+        # the engine binds to the event loop it was first used in, and
+        # every test runs in a new loop
+        server.snmp_engine = None
+        server.last_scraped.clear()
+        server.in_flight_scrapes.clear()
+
+    def start_agent(self, values, delay_seconds=0, ip="127.0.0.1"):
+        agent = FakePrinterAgent(values, delay_seconds, ip)
+        self.addCleanup(agent.close)
+        return agent
+
+    def device(self, ip, port, timeout_seconds=1, retries=0):
+        return server.SnmpDevice(ip=ip, port=port, timeout_seconds=timeout_seconds, retries=retries)
+
+    def test_all_oids_fetched_in_one_request(self):
+        agent = self.start_agent({oid.metric_value: 1 for oid in server.SnmpOid})
+        agent.values[INK_LEVEL_OID] = 42
+
+        asyncio.run(server.scrape_devices([self.device("127.0.0.1", agent.port)]))
+
+        self.assertEqual(agent.requests, 1)
+        self.assertEqual(get_sample("snmp_metric", name="ink_level", ip="127.0.0.1"), 42)
+        self.assertEqual(get_sample("snmp_error", name="tray_empty", ip="127.0.0.1"), 1)
+        self.assertEqual(get_sample("device_unreachable", ip="127.0.0.1"), 0)
+
+    def test_per_device_metrics(self):
+        agent = self.start_agent({oid.metric_value: 1 for oid in server.SnmpOid}, ip="127.0.0.3")
+        unreachable_port = FakePrinterAgent({}, ip="127.0.0.4")
+        # nothing answers on a closed socket
+        unreachable_port.close()
+        cycles_before = get_sample("snmp_scrape_cycle_duration_count") or 0
+        requests_before = get_sample("snmp_request_duration_count", ip="127.0.0.3") or 0
+
+        start = time.time()
+        asyncio.run(server.scrape_devices([
+            self.device("127.0.0.3", agent.port),
+            self.device("127.0.0.4", unreachable_port.port, timeout_seconds=0.2),
+        ]))
+
+        self.assertEqual(get_sample("device_unreachable", ip="127.0.0.3"), 0)
+        self.assertEqual(get_sample("device_unreachable", ip="127.0.0.4"), 1)
+        self.assertGreaterEqual(get_sample("snmp_last_success_timestamp", ip="127.0.0.3"), int(start))
+        self.assertIsNone(get_sample("snmp_last_success_timestamp", ip="127.0.0.4"))
+        self.assertEqual(
+            get_sample("snmp_request_duration_count", ip="127.0.0.3"),
+            requests_before + 1,
+        )
+        self.assertEqual(get_sample("snmp_scrape_cycle_duration_count"), cycles_before + 1)
+
+    def test_missing_oid_is_dropped_and_retried(self):
+        values = {oid.metric_value: 7 for oid in server.SnmpOid}
+        del values[server.SnmpOid.TRAY_EMPTY.metric_value]
+        agent = self.start_agent(values, ip="127.0.0.2")
+
+        asyncio.run(server.scrape_devices([self.device("127.0.0.2", agent.port)]))
+
+        self.assertEqual(agent.requests, 2)
+        self.assertEqual(get_sample("snmp_error", name="tray_empty", ip="127.0.0.2"), 0)
+        self.assertEqual(get_sample("snmp_error", name="tray_empty_2", ip="127.0.0.2"), 1)
+        self.assertEqual(get_sample("snmp_metric", name="page_count", ip="127.0.0.2"), 7)
+
+    def test_failing_device_does_not_stop_others(self):
+        agent = self.start_agent({oid.metric_value: 5 for oid in server.SnmpOid}, ip="127.0.0.5")
+        get_snmp_data = server.get_snmp_data
+
+        async def get_snmp_data_or_fail(device):
+            if device.ip == "127.0.0.6":
+                raise RuntimeError("bad device")
+            await get_snmp_data(device)
+
+        with mock.patch("server.get_snmp_data", get_snmp_data_or_fail):
+            with self.assertLogs(level="ERROR") as logs:
+                asyncio.run(server.scrape_devices([
+                    self.device("127.0.0.6", 161),
+                    self.device("127.0.0.5", agent.port),
+                ]))
+
+        self.assertEqual(get_sample("snmp_metric", name="page_count", ip="127.0.0.5"), 5)
+        self.assertIn("Scraping 127.0.0.6 failed", logs.output[0])
+
+    def test_slow_device_does_not_delay_others(self):
+        values = {oid.metric_value: 1 for oid in server.SnmpOid}
+        slow_agents = [self.start_agent(values, delay_seconds=0.5) for _ in range(4)]
+        devices = [
+            self.device("127.0.0.1", agent.port, timeout_seconds=2)
+            for agent in slow_agents
+        ]
+
+        start = time.monotonic()
+        asyncio.run(server.scrape_devices(devices))
+        elapsed = time.monotonic() - start
+
+        # scraped one after another this would take at least 2 seconds
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual([agent.requests for agent in slow_agents], [1, 1, 1, 1])
+
+
+class TestOnDemandScrape(unittest.TestCase):
+    def setUp(self):
+        server.snmp_engine = None
+        server.last_scraped.clear()
+        server.in_flight_scrapes.clear()
+        self.values = {oid.metric_value: 1 for oid in server.SnmpOid}
+
+    def start_agent(self, delay_seconds=0):
+        agent = FakePrinterAgent(self.values, delay_seconds)
+        self.addCleanup(agent.close)
+        device = server.SnmpDevice(ip="127.0.0.1", port=agent.port, timeout_seconds=2, retries=0)
+        return agent, device
+
+    def test_concurrent_refreshes_share_one_scrape(self):
+        agent, device = self.start_agent(delay_seconds=0.2)
+
+        async def scrape_concurrently():
+            await asyncio.gather(*(
+                server.refresh_stale_devices([device], ttl_seconds=30, wait_seconds=5)
+                for _ in range(10)
+            ))
+
+        asyncio.run(scrape_concurrently())
+        self.assertEqual(agent.requests, 1)
+
+    def test_fresh_metrics_are_not_scraped_again(self):
+        agent, device = self.start_agent()
+
+        async def scrape_twice(ttl_seconds):
+            await server.refresh_stale_devices([device], ttl_seconds, wait_seconds=5)
+            await server.refresh_stale_devices([device], ttl_seconds, wait_seconds=5)
+
+        asyncio.run(scrape_twice(ttl_seconds=30))
+        self.assertEqual(agent.requests, 1)
+
+        server.snmp_engine = None
+        asyncio.run(scrape_twice(ttl_seconds=0))
+        self.assertEqual(agent.requests, 3)
+
+    def test_slow_device_serves_stale_metrics(self):
+        agent, device = self.start_agent(delay_seconds=1)
+
+        async def scrape():
+            start = time.monotonic()
+            await server.refresh_stale_devices([device], ttl_seconds=30, wait_seconds=0.1)
+            elapsed = time.monotonic() - start
+            # the scrape is still running after we stopped waiting on it
+            self.assertIn(device.ip, server.in_flight_scrapes)
+            await server.in_flight_scrapes[device.ip]
+            return elapsed
+
+        elapsed = asyncio.run(scrape())
+        self.assertLess(elapsed, 0.5)
+        self.assertIn(device.ip, server.last_scraped)
+        self.assertEqual(agent.requests, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import math
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# once this many users have a rate limit bucket, the ones that have
+# refilled all the way are forgotten
+MAX_CLIENT_BUCKETS = 10000
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code, reason, retry_after_seconds):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+
+
+class AdmissionController:
+    """
+    decides whether a print request gets to start uploading. there's a
+    limit on how many admitted requests can be uploading, waiting for a
+    printer worker or running lp at once, and on how many bytes they
+    add up to. past either limit requests get a 503. on top of that
+    take_token() gives each user a token bucket of client_burst
+    requests refilling at client_rate_per_second, and going over it
+    gets a 429. it's keyed on the user id rather than the client's
+    address, every request comes through the ssh tunnel from localhost.
+
+    this is only meant to be used from the event loop, it isn't thread
+    safe.
+    """
+
+    def __init__(
+        self,
+        max_jobs=32,
+        max_bytes=1024 * 1024 * 1024,
+        client_rate_per_second=0.5,
+        client_burst=10,
+        retry_after_seconds=10,
+    ):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.client_rate_per_second = client_rate_per_second
+        self.client_burst = client_burst
+        self.retry_after_seconds = retry_after_seconds
+        self.jobs = 0
+        self.bytes = 0
+        # user id -> (tokens, last refilled at)
+        self._buckets = {}
+
+    def admit(self, size_bytes=0):
+        """
+        raises AdmissionRejected if the request can't be taken right
+        now. otherwise it counts toward the limits until release().
+        """
+        # an empty queue always takes a request, so one bigger than
+        # max_bytes isn't turned away forever
+        if self.jobs > 0 and (
+            self.jobs >= self.max_jobs or self.bytes + size_bytes > self.max_bytes
+        ):
+            reason = "too_many_jobs" if self.jobs >= self.max_jobs else "too_many_bytes"
+            self._reject(503, reason, self.retry_after_seconds)
+
+        self.jobs += 1
+        self.bytes += size_bytes
+        self._update_metrics()
+
+    def release(self, size_bytes=0):
+        self.jobs -= 1
+        self.bytes -= size_bytes
+        self._update_metrics()
+
+    def take_token(self, user_id):
+        """
+        raises AdmissionRejected if user_id has used up its requests.
+        """
+        if self.client_rate_per_second <= 0:
+            return
+        now = time.monotonic()
+        tokens, refilled_at = self._buckets.get(user_id, (self.client_burst, now))
+        tokens = min(
+            self.client_burst,
+            tokens + (now - refilled_at) * self.client_rate_per_second,
+        )
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            retry_after_seconds = (1 - tokens) / self.client_rate_per_second
+            self._reject(429, "client_rate_limited", retry_after_seconds)
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > MAX_CLIENT_BUCKETS:
+            self._forget_idle_users(now)
+
+    def _forget_idle_users(self, now):
+        for user_id, (tokens, refilled_at) in list(self._buckets.items()):
+            if tokens + (now - refilled_at) * self.client_rate_per_second >= self.client_burst:
+                del self._buckets[user_id]
+
+    def _reject(self, status_code, reason, retry_after_seconds):
+        metrics_handler.print_admission_rejections.labels(reason=reason).inc()
+        raise AdmissionRejected(
+            status_code, reason, max(1, math.ceil(retry_after_seconds))
+        )
+
+    def _update_metrics(self):
+        metrics_handler.print_admitted_jobs.set(self.jobs)
+        metrics_handler.print_admitted_bytes.set(self.bytes)
@@ -0,0 +1,186 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# what.sh exports this, as epoch seconds, right before it starts cups
+STARTED_AT_VARIABLE = "QUASAR_STARTED_AT"
+
+
+def get_started_at(default) -> float:
+    """
+    returns when the container started going by what.sh, or default
+    if it wasn't started by what.sh.
+    """
+    try:
+        return float(os.environ[STARTED_AT_VARIABLE])
+    except (KeyError, ValueError):
+        return default
+
+
+def run(command) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        timeout=10,
+    )
+
+
+def is_scheduler_running() -> bool:
+    try:
+        result = run(["lpstat", "-r"])
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    # prints "scheduler is not running" and exits with 1 until cups is up
+    return result.returncode == 0 and "not running" not in result.stdout
+
+
+def get_accepting_printers(printer_names) -> set:
+    """
+    returns the printers out of printer_names that cups knows about and
+    is accepting jobs for.
+    """
+    try:
+        result = run(["lpstat", "-a", *printer_names])
+    except (OSError, subprocess.TimeoutExpired):
+        return set()
+    # one line per printer, i.e.
+    # right-printer accepting requests since Fri 17 Jul 2025 02:40:12 PM UTC
+    return {
+        line.split(None, 1)[0]
+        for line in result.stdout.splitlines()
+        if " accepting requests" in line
+    }
+
+
+def register_printer(printer, ppd_path):
+    """
+    adds the printer to cups, or updates it, and has cups enable it and
+    accept jobs for it. same as create_and_enable_printer in what.sh
+    used to do.
+    """
+    logging.info(f"setting up {printer.name} with uri {printer.lpd_url}")
+    result = run(["lpadmin", "-p", printer.name, "-v", printer.lpd_url, "-P", ppd_path, "-E"])
+    if result.returncode != 0:
+        raise RuntimeError(f"lpadmin returned code {result.returncode} stderr: {result.stderr}")
+
+
+class CupsReadiness:
+    """
+    waits for cups to come up after the container starts, so the
+    server can answer /live right away and /ready (and take jobs) as
+    soon as cups can, rather than what.sh sleeping a fixed 10 seconds
+    before anything else happens. cups is polled every interval_seconds,
+    doubling up to max_interval_seconds.
+
+    if should_register() is true once the cups scheduler is running,
+    the enabled printers that have an LPD_URL in config.json are added
+    to it. with more than one worker only the leader does this, the
+    rest wait for the printers to show up. we're ready as soon as one
+    printer is accepting jobs, so lpadmin failing for one printer doesn't
+    keep the other from printing. the ones that aren't are in
+    missing_printers, and are checked on every max_missing_interval_seconds
+    in case they show up later.
+
+    the time from started_at to each step is exported as
+    server_startup_seconds.
+    """
+
+    def __init__(
+        self,
+        printers,
+        should_register=lambda: False,
+        ppd_path="/etc/cups/ppd/HP-LaserJet-p2015dn.ppd",
+        started_at=None,
+        interval_seconds=0.1,
+        max_interval_seconds=2,
+        max_missing_interval_seconds=30,
+    ):
+        self.printers = [printer for printer in printers if printer.enabled]
+        self.should_register = should_register
+        self.ppd_path = ppd_path
+        self.started_at = started_at or time.time()
+        self.interval_seconds = interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.max_missing_interval_seconds = max_missing_interval_seconds
+        self.is_ready = False
+        # names of enabled printers cups isn't accepting jobs for
+        self.missing_printers = []
+        # what /ready says while is_ready is false
+        self.waiting_for = "cups scheduler"
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="cups-readiness", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def set_ready(self):
+        self.is_ready = True
+        self.waiting_for = None
+        self._record_phase("ready")
+        logging.info(f"ready to print {time.time() - self.started_at:.2f} seconds after starting")
+
+    def _run(self):
+        if not self._wait_for(is_scheduler_running):
+            return
+        self._record_phase("cups_ready")
+
+        if self.should_register():
+            for printer in self.printers:
+                if printer.lpd_url is None:
+                    continue
+                try:
+                    register_printer(printer, self.ppd_path)
+                except Exception:
+                    logging.exception(f"unable to set up {printer.name}")
+            self._record_phase("printers_registered")
+
+        names = [printer.name for printer in self.printers]
+        self.missing_printers = names
+        self.waiting_for = f"printers {', '.join(names)}"
+        if names and not self._wait_for(lambda: len(self._check_printers(names)) < len(names)):
+            return
+        self.set_ready()
+        if not self.missing_printers:
+            return
+        logging.warning(
+            f"ready without {', '.join(self.missing_printers)}, cups isn't accepting jobs for them"
+        )
+        if self._wait_for(lambda: not self._check_printers(names), self.max_missing_interval_seconds):
+            logging.info("cups is accepting jobs for every printer now")
+
+    def _check_printers(self, names) -> list:
+        """
+        updates and returns missing_printers.
+        """
+        accepting = get_accepting_printers(names)
+        self.missing_printers = [name for name in names if name not in accepting]
+        return self.missing_printers
+
+    def _wait_for(self, condition, max_interval_seconds=None) -> bool:
+        """
+        returns True once condition() is, or False if stopped first.
+        """
+        interval = self.interval_seconds
+        while not condition():
+            if self._stop_event.wait(interval):
+                return False
+            interval = min(interval * 2, max_interval_seconds or self.max_interval_seconds)
+        return True
+
+    def _record_phase(self, phase):
+        metrics_handler.server_startup_seconds.labels(phase=phase).set(time.time() - self.started_at)
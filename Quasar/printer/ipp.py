@@ -0,0 +1,399 @@
+"""
+just enough of the Internet Printing Protocol (RFC 8010/8011) to talk to
+CUPS without forking lp or lpstat. messages are encoded by hand and sent
+over pooled keep-alive HTTP connections.
+"""
+import enum
+import http.client
+import logging
+import os
+import queue
+import struct
+import threading
+import urllib.parse
+
+
+IPP_VERSION = (1, 1)
+
+
+class Operation(enum.IntEnum):
+    PRINT_JOB = 0x0002
+    CANCEL_JOB = 0x0008
+    GET_JOB_ATTRIBUTES = 0x0009
+    GET_JOBS = 0x000A
+    GET_PRINTER_ATTRIBUTES = 0x000B
+    CUPS_GET_PRINTERS = 0x4002
+
+
+class GroupTag(enum.IntEnum):
+    OPERATION = 0x01
+    JOB = 0x02
+    END = 0x03
+    PRINTER = 0x04
+    UNSUPPORTED = 0x05
+
+
+class ValueTag(enum.IntEnum):
+    UNSUPPORTED = 0x10
+    UNKNOWN = 0x12
+    NO_VALUE = 0x13
+    INTEGER = 0x21
+    BOOLEAN = 0x22
+    ENUM = 0x23
+    OCTET_STRING = 0x30
+    DATE_TIME = 0x31
+    RESOLUTION = 0x32
+    RANGE_OF_INTEGER = 0x33
+    BEGIN_COLLECTION = 0x34
+    TEXT_WITH_LANGUAGE = 0x35
+    NAME_WITH_LANGUAGE = 0x36
+    END_COLLECTION = 0x37
+    TEXT = 0x41
+    NAME = 0x42
+    KEYWORD = 0x44
+    URI = 0x45
+    URI_SCHEME = 0x46
+    CHARSET = 0x47
+    NATURAL_LANGUAGE = 0x48
+    MIME_MEDIA_TYPE = 0x49
+    MEMBER_NAME = 0x4A
+
+
+class JobState(enum.IntEnum):
+    PENDING = 3
+    PENDING_HELD = 4
+    PROCESSING = 5
+    PROCESSING_STOPPED = 6
+    CANCELED = 7
+    ABORTED = 8
+    COMPLETED = 9
+
+
+class IppError(Exception):
+    pass
+
+
+def _encode_value(value_tag, value) -> bytes:
+    if value_tag in (ValueTag.INTEGER, ValueTag.ENUM):
+        return struct.pack(">i", value)
+    if value_tag == ValueTag.BOOLEAN:
+        return struct.pack(">?", value)
+    if value_tag == ValueTag.RANGE_OF_INTEGER:
+        return struct.pack(">ii", *value)
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+def _decode_value(value_tag, value: bytes):
+    if value_tag in (ValueTag.INTEGER, ValueTag.ENUM) and len(value) == 4:
+        return struct.unpack(">i", value)[0]
+    if value_tag == ValueTag.BOOLEAN and len(value) == 1:
+        return struct.unpack(">?", value)[0]
+    if value_tag == ValueTag.RANGE_OF_INTEGER and len(value) == 8:
+        return struct.unpack(">ii", value)
+    if value_tag in (ValueTag.TEXT_WITH_LANGUAGE, ValueTag.NAME_WITH_LANGUAGE):
+        # 2 byte language length, language, 2 byte text length, text
+        language_length = struct.unpack(">H", value[:2])[0]
+        return value[4 + language_length :].decode("utf-8", "replace")
+    if 0x40 <= value_tag <= 0x5F:
+        return value.decode("utf-8", "replace")
+    if value_tag in (ValueTag.UNSUPPORTED, ValueTag.UNKNOWN, ValueTag.NO_VALUE):
+        return None
+    return value
+
+
+def encode_message(code, request_id, groups) -> bytes:
+    """
+    code is the operation id for a request, or the status code for a
+    response. groups is a list of (GroupTag, attributes), where
+    attributes is a list of (ValueTag, name, value). a list value is
+    encoded as a multi-valued attribute.
+    """
+    message = bytearray(struct.pack(">BBHi", *IPP_VERSION, code, request_id))
+    for group_tag, attributes in groups:
+        message.append(group_tag)
+        for value_tag, name, value in attributes:
+            values = value if isinstance(value, list) else [value]
+            for i, single_value in enumerate(values):
+                # every value after the first is sent with an empty name,
+                # which is how IPP marks an additional value
+                encoded_name = name.encode("utf-8") if i == 0 else b""
+                encoded_value = _encode_value(value_tag, single_value)
+                message.append(value_tag)
+                message += struct.pack(">H", len(encoded_name)) + encoded_name
+                message += struct.pack(">H", len(encoded_value)) + encoded_value
+    message.append(GroupTag.END)
+    return bytes(message)
+
+
+class IppMessage:
+    def __init__(self, version, code, request_id, groups, data=b""):
+        self.version = version
+        # operation id for requests, status code for responses
+        self.code = code
+        self.request_id = request_id
+        # list of (GroupTag, {name: [values]})
+        self.groups = groups
+        self.data = data
+
+    def get_groups(self, group_tag) -> list:
+        return [attributes for tag, attributes in self.groups if tag == group_tag]
+
+    def get(self, group_tag, name, default=None):
+        for attributes in self.get_groups(group_tag):
+            if name in attributes:
+                return attributes[name][0]
+        return default
+
+    @property
+    def is_successful(self) -> bool:
+        return self.code < 0x0100
+
+
+def decode_message(data: bytes) -> IppMessage:
+    if len(data) < 9:
+        raise IppError(f"ipp message is too short ({len(data)} bytes)")
+    major, minor, code, request_id = struct.unpack(">BBHi", data[:8])
+    groups = []
+    attributes = None
+    name = None
+    collection_depth = 0
+    offset = 8
+    while offset < len(data):
+        tag = data[offset]
+        offset += 1
+        if tag == GroupTag.END:
+            break
+        if tag < 0x10:
+            attributes = {}
+            groups.append((tag, attributes))
+            continue
+        if attributes is None or offset + 2 > len(data):
+            raise IppError(f"malformed ipp message at byte {offset}")
+        name_length = struct.unpack(">H", data[offset : offset + 2])[0]
+        offset += 2
+        value_name = data[offset : offset + name_length].decode("utf-8", "replace")
+        offset += name_length
+        value_length = struct.unpack(">H", data[offset : offset + 2])[0]
+        offset += 2
+        value = data[offset : offset + value_length]
+        offset += value_length
+
+        # members of a collection are skipped, the collection itself is
+        # recorded with a value of None. we never need their contents.
+        if tag == ValueTag.BEGIN_COLLECTION:
+            collection_depth += 1
+            if collection_depth == 1:
+                if value_name:
+                    name = value_name
+                attributes.setdefault(name, []).append(None)
+            continue
+        if tag == ValueTag.END_COLLECTION:
+            collection_depth -= 1
+            continue
+        if collection_depth:
+            continue
+
+        if value_name:
+            name = value_name
+        attributes.setdefault(name, []).append(_decode_value(tag, value))
+    return IppMessage((major, minor), code, request_id, groups, data[offset:])
+
+
+def parse_page_ranges(page_range: str) -> list:
+    """
+    turns the page range a user typed in, i.e. "1-3,5", into the
+    (first, last) tuples IPP's page-ranges attribute expects.
+    """
+    ranges = []
+    for part in page_range.replace(" ", "").split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+class IppClient:
+    """
+    sends IPP requests to a CUPS server. connections are kept alive
+    and reused across requests from a pool shared by every thread.
+    """
+
+    def __init__(self, url="http://localhost:631", pool_size=4, timeout=30, user="quasar"):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 631
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.user = user
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._request_id = 0
+        self._request_id_lock = threading.Lock()
+
+    def printer_uri(self, printer_name) -> str:
+        return f"ipp://{self.host}:{self.port}/printers/{printer_name}"
+
+    def _next_request_id(self) -> int:
+        with self._request_id_lock:
+            self._request_id += 1
+            return self._request_id
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _put_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _send(self, conn, path, message: bytes, document=None):
+        document_size = 0
+        if document is not None:
+            document_size = os.fstat(document.fileno()).st_size - document.tell()
+        conn.putrequest("POST", path)
+        conn.putheader("Content-Type", "application/ipp")
+        conn.putheader("Content-Length", str(len(message) + document_size))
+        conn.endheaders()
+        conn.send(message)
+        if document is not None:
+            # http.client reads file objects in blocks, so the document
+            # is never loaded into memory all at once
+            conn.send(document)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise IppError(f"cups returned HTTP {response.status} for {path}")
+        if response.will_close:
+            conn.close()
+        return decode_message(body)
+
+    def request(self, path, operation, attributes, document=None, extra_groups=()) -> IppMessage:
+        """
+        sends one operation and returns the decoded response. attributes
+        go in the operation group, after the charset and language every
+        request has to start with.
+        """
+        groups = [
+            (
+                GroupTag.OPERATION,
+                [
+                    (ValueTag.CHARSET, "attributes-charset", "utf-8"),
+                    (ValueTag.NATURAL_LANGUAGE, "attributes-natural-language", "en"),
+                ]
+                + list(attributes),
+            )
+        ]
+        groups.extend(extra_groups)
+        message = encode_message(operation, self._next_request_id(), groups)
+        document_start = document.tell() if document is not None else None
+
+        conn, reused = self._get_connection()
+        try:
+            response = self._send(conn, path, message, document)
+        except (BrokenPipeError, ConnectionResetError, http.client.RemoteDisconnected):
+            conn.close()
+            if not reused:
+                raise
+            # cups closes idle keep-alive connections on its own, so a
+            # pooled connection failing is expected once in a while.
+            # retry once on a fresh one.
+            logging.info(f"pooled connection to {self.host}:{self.port} was closed, reconnecting")
+            if document is not None:
+                document.seek(document_start)
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                response = self._send(conn, path, message, document)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        self._put_connection(conn)
+
+        if not response.is_successful:
+            status_message = response.get(GroupTag.OPERATION, "status-message", "")
+            raise IppError(
+                f"{Operation(operation).name} failed with status {response.code:#06x}: {status_message}"
+            )
+        return response
+
+    def print_job(
+        self,
+        printer_name,
+        file_path,
+        copies=1,
+        sides="one-sided",
+        page_range=None,
+        media=None,
+        document_format=None,
+    ) -> int:
+        job_attributes = [
+            (ValueTag.INTEGER, "copies", int(copies)),
+            (ValueTag.KEYWORD, "sides", sides),
+        ]
+        if media:
+            job_attributes.append((ValueTag.KEYWORD, "media", media))
+        if page_range:
+            job_attributes.append(
+                (ValueTag.RANGE_OF_INTEGER, "page-ranges", parse_page_ranges(page_range))
+            )
+        operation_attributes = [
+            (ValueTag.URI, "printer-uri", self.printer_uri(printer_name)),
+            (ValueTag.NAME, "requesting-user-name", self.user),
+            (ValueTag.NAME, "job-name", os.path.basename(file_path)),
+        ]
+        if document_format:
+            operation_attributes.append((ValueTag.MIME_MEDIA_TYPE, "document-format", document_format))
+        with open(file_path, "rb") as document:
+            response = self.request(
+                f"/printers/{printer_name}",
+                Operation.PRINT_JOB,
+                operation_attributes,
+                document=document,
+                extra_groups=[(GroupTag.JOB, job_attributes)],
+            )
+        return response.get(GroupTag.JOB, "job-id")
+
+    def get_jobs(self, printer_name, which_jobs="not-completed") -> list:
+        """
+        returns a dict of attributes for every job on the printer.
+        """
+        response = self.request(
+            f"/printers/{printer_name}",
+            Operation.GET_JOBS,
+            [
+                (ValueTag.URI, "printer-uri", self.printer_uri(printer_name)),
+                (ValueTag.NAME, "requesting-user-name", self.user),
+                (ValueTag.KEYWORD, "which-jobs", which_jobs),
+                (
+                    ValueTag.KEYWORD,
+                    "requested-attributes",
+                    [
+                        "job-id",
+                        "job-state",
+                        "job-originating-user-name",
+                        "job-k-octets",
+                        "time-at-creation",
+                        "job-media-sheets-completed",
+                    ],
+                ),
+            ],
+        )
+        return [
+            {name: values[0] for name, values in attributes.items()}
+            for attributes in response.get_groups(GroupTag.JOB)
+        ]
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,345 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    print_id TEXT,
+    file_id TEXT,
+    time REAL NOT NULL,
+    copies INTEGER,
+    sides TEXT,
+    page_range TEXT,
+    pages INTEGER,
+    printer TEXT,
+    client TEXT,
+    user_id TEXT,
+    -- queued until it's been sent to cups, then sent, or failed if it
+    -- never got there. null for jobs from before this column
+    state TEXT
+);
+CREATE INDEX IF NOT EXISTS job_print_id ON job (print_id);
+CREATE INDEX IF NOT EXISTS job_time ON job (time);
+CREATE INDEX IF NOT EXISTS job_file_id ON job (file_id);
+CREATE TABLE IF NOT EXISTS job_event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    print_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_event_print_id ON job_event (print_id);
+CREATE TABLE IF NOT EXISTS idempotency_key (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_key_time ON idempotency_key (time);
+CREATE TABLE IF NOT EXISTS quota_usage (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    pages INTEGER NOT NULL,
+    PRIMARY KEY (user_id, period)
+);
+"""
+# (name, type) of columns of the job table that older databases
+# don't have yet
+JOB_COLUMNS_ADDED_LATER = [("pages", "INTEGER"), ("user_id", "TEXT"), ("state", "TEXT")]
+
+
+class JobStore:
+    """
+    sqlite backed ledger of print jobs. writes are put on a queue and
+    committed in batches by a background thread, so a request handler
+    never waits on an fsync. reads go through their own connection,
+    which WAL mode allows to run alongside the writer.
+    """
+
+    def __init__(self, database_path, batch_size=100, flush_interval_seconds=1.0):
+        self.database_path = database_path
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self._queue = queue.Queue()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._add_missing_columns(conn)
+        conn.close()
+
+        self._writer = threading.Thread(
+            target=self._write_forever,
+            name="job-store-writer",
+            daemon=True,
+        )
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only syncs at checkpoints. a crash can lose
+        # the last few commits but never corrupts the database
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _add_missing_columns(self, conn):
+        # CREATE TABLE IF NOT EXISTS leaves a database from before a
+        # column was added alone, so those get added here
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(job)")}
+        for name, column_type in JOB_COLUMNS_ADDED_LATER:
+            if name not in columns:
+                conn.execute(f"ALTER TABLE job ADD COLUMN {name} {column_type}")
+        conn.commit()
+
+    def execute_later(self, sql, params=()):
+        """
+        queue a write for the background thread to commit with the
+        next batch.
+        """
+        self._queue.put((sql, params))
+
+    def record_job(
+        self,
+        print_id,
+        file_id,
+        copies=None,
+        sides=None,
+        page_range=None,
+        printer=None,
+        client=None,
+        created_at=None,
+        pages=None,
+        user_id=None,
+        state=None,
+    ):
+        if created_at is None:
+            created_at = time.time()
+        self.execute_later(
+            """
+            INSERT INTO job (print_id, file_id, time, copies, sides, page_range, pages, printer, client, user_id, state)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (print_id, file_id, created_at, copies, sides, page_range, pages, printer, client, user_id, state),
+        )
+
+    def record_job_sent(self, file_id, print_id, printer=None):
+        """
+        fills in where a job recorded as queued went.
+        """
+        self.execute_later(
+            "UPDATE job SET print_id = ?, printer = ?, state = 'sent' WHERE file_id = ?",
+            (print_id, printer, file_id),
+        )
+
+    def record_job_failed(self, file_id):
+        self.execute_later("UPDATE job SET state = 'failed' WHERE file_id = ?", (file_id,))
+
+    def record_job_state(self, print_id, state, changed_at=None):
+        if changed_at is None:
+            changed_at = time.time()
+        self.execute_later(
+            "INSERT INTO job_event (print_id, state, time) VALUES (?, ?, ?)",
+            (print_id, state, changed_at),
+        )
+
+    def get_job_states(self, print_id) -> list:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT state, time FROM job_event WHERE print_id = ? ORDER BY time, id",
+                (print_id,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def get_job_events_after(self, event_id, limit=1000) -> list:
+        """
+        returns up to limit job state changes recorded after the one
+        with id event_id, oldest first.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, print_id, state, time FROM job_event WHERE id > ? ORDER BY id LIMIT ?",
+                (event_id, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def get_last_job_event_id(self) -> int:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT MAX(id) FROM job_event").fetchone()
+        finally:
+            conn.close()
+        return row[0] or 0
+
+    def get_unfinished_print_ids(self, since=0, before=None) -> list:
+        """
+        returns (print id, printer) of jobs sent to cups between since
+        and before that no completed, canceled or aborted state has
+        been recorded for.
+        """
+        if before is None:
+            before = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                """
+                SELECT DISTINCT print_id, printer FROM job
+                WHERE time >= ? AND time < ? AND print_id IS NOT NULL AND print_id != ''
+                AND NOT EXISTS (
+                    SELECT 1 FROM job_event
+                    WHERE job_event.print_id = job.print_id
+                    AND job_event.state IN ('completed', 'canceled', 'aborted')
+                )
+                """,
+                (since, before),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [(row["print_id"], row["printer"]) for row in rows]
+
+    def get_job(self, file_id):
+        """
+        returns the job for the file (i.e. the job id /print handed
+        out), or None if there isn't one.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT * FROM job WHERE file_id = ? ORDER BY time DESC LIMIT 1",
+                (file_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row is not None else None
+
+    def get_jobs(self, since=0, limit=100) -> list:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM job WHERE time >= ? ORDER BY time LIMIT ?",
+                (since, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def record_idempotency_key(self, key, response, created_at=None):
+        if created_at is None:
+            created_at = time.time()
+        self.execute_later(
+            "INSERT OR REPLACE INTO idempotency_key (key, response, time) VALUES (?, ?, ?)",
+            (key, json.dumps(response), created_at),
+        )
+
+    def expire_idempotency_keys(self, before):
+        self.execute_later("DELETE FROM idempotency_key WHERE time < ?", (before,))
+
+    def get_idempotency_key(self, key, since=0):
+        """
+        returns the response recorded for key at or after `since`, or
+        None if there isn't one.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT response FROM idempotency_key WHERE key = ? AND time >= ?",
+                (key, since),
+            ).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row["response"]) if row is not None else None
+
+    def add_quota_usage(self, user_id, period, pages):
+        """
+        adds pages (which can be negative, for a refund) to what the
+        user has printed in the period.
+        """
+        self.execute_later(
+            """
+            INSERT INTO quota_usage (user_id, period, pages) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, period) DO UPDATE SET pages = pages + excluded.pages
+            """,
+            (user_id, period, pages),
+        )
+
+    def get_quota_usage(self, periods) -> list:
+        """
+        returns every user's pages for the given periods, see
+        quota.get_periods.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM quota_usage WHERE period IN ({', '.join('?' for _ in periods)})",
+                periods,
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def flush(self):
+        """
+        block until every queued write has been committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        commit whatever is still queued and stop the writer thread.
+        """
+        self._queue.put(None)
+        self._writer.join()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval_seconds
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_forever(self):
+        conn = self._connect()
+        closed = False
+        while not closed:
+            batch = self._next_batch()
+            # close() puts None on the queue, which is always the last
+            # item of its batch
+            closed = batch[-1] is None
+            writes = batch[:-1] if closed else batch
+            try:
+                with conn:
+                    for sql, params in writes:
+                        conn.execute(sql, params)
+            except Exception:
+                logging.exception(f"failed to commit batch of {len(writes)} writes, retrying them one by one")
+                self._write_one_by_one(conn, writes)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        conn.close()
+
+    def _write_one_by_one(self, conn, writes):
+        # a bad write only loses itself, not the batch it came with
+        for sql, params in writes:
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            except Exception:
+                logging.exception(f"failed to commit {sql.split()[0]} write with {params}")
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import threading
+import time
+
+
+# what the job states cups reports mean for someone waiting on their
+# job, see QueuedJob.state. "queued" is what the queue monitor reports
+# when the backend (i.e. lpstat) doesn't give a state.
+CUPS_STATES = {
+    "queued": "spooled",
+    "pending": "spooled",
+    "pending_held": "spooled",
+    "processing": "printing",
+    "processing_stopped": "printing",
+    "completed": "completed",
+    "canceled": "failed",
+    "aborted": "failed",
+}
+TERMINAL_STATES = {"completed", "failed"}
+
+
+class JobTracker:
+    """
+    keeps the state of recent jobs in memory and lets clients subscribe
+    to changes. a job goes queued (on disk, waiting for lp) -> spooled
+    (cups has it) -> printing -> completed, or ends up failed at any
+    point. the cups states come from the QueueMonitor, so there's only
+    ever one thing polling cups no matter how many clients are waiting.
+
+    updates can come from any thread, subscribers get them on their own
+    event loop.
+    """
+
+    def __init__(self, max_jobs=10000):
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        # job id -> job, oldest first
+        self._jobs = collections.OrderedDict()
+        # print id -> job ids, a duplicate upload shares the print id
+        # of the job it duplicates
+        self._job_ids_by_print_id = collections.defaultdict(set)
+        # job id -> list of (loop, asyncio.Queue)
+        self._subscribers = collections.defaultdict(list)
+
+    def set_state(self, job_id, state, **fields):
+        """
+        moves the job to state, creating it if it's new. fields (i.e.
+        print_id and printer) are saved alongside it. a job that
+        completed or failed stays that way.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = {"job_id": job_id, "state": None, "print_id": None, "printer": None}
+                self._jobs[job_id] = job
+                if len(self._jobs) > self.max_jobs:
+                    self._evict()
+            if job["state"] in TERMINAL_STATES or job["state"] == state:
+                return
+            job.update(fields)
+            job["state"] = state
+            job["updated_at"] = time.time()
+            if job["print_id"]:
+                self._job_ids_by_print_id[job["print_id"]].add(job_id)
+            update = dict(job)
+            subscribers = list(self._subscribers.get(job_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, update)
+
+    def record_cups_state(self, print_id, cups_state):
+        """
+        called by the queue monitor whenever a job in cups changes
+        state. jobs we didn't submit are ignored.
+        """
+        state = CUPS_STATES.get(cups_state)
+        if state is None:
+            return
+        with self._lock:
+            job_ids = list(self._job_ids_by_print_id.get(print_id, ()))
+        for job_id in job_ids:
+            self.set_state(job_id, state)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_state_of_print(self, print_id):
+        """
+        returns the state of the jobs that went to cups as print_id, or
+        None if we aren't tracking any.
+        """
+        with self._lock:
+            for job_id in self._job_ids_by_print_id.get(print_id, ()):
+                return self._jobs[job_id]["state"]
+        return None
+
+    def subscribe(self, job_id) -> asyncio.Queue:
+        """
+        returns a queue that gets the job every time its state changes.
+        has to be called from the event loop that reads the queue.
+        """
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers[job_id].append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(job_id, [])
+            subscribers[:] = [s for s in subscribers if s[1] is not queue]
+            if not subscribers:
+                self._subscribers.pop(job_id, None)
+
+    def _evict(self):
+        # the database still has evicted jobs, see job_from_store in
+        # server.py
+        while len(self._jobs) > self.max_jobs:
+            job_id, job = self._jobs.popitem(last=False)
+            job_ids = self._job_ids_by_print_id.get(job["print_id"])
+            if job_ids is not None:
+                job_ids.discard(job_id)
+                if not job_ids:
+                    del self._job_ids_by_print_id[job["print_id"]]
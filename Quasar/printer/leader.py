@@ -0,0 +1,64 @@
+import fcntl
+import logging
+import os
+import threading
+
+
+class LeaderElection:
+    """
+    picks one process out of the server's workers to run the things
+    there should only be one of, i.e. the queue monitor and the ssh
+    tunnel watchdog. whoever holds an exclusive lock on lock_path is
+    the leader. the lock goes away with the process holding it, so if
+    the leader dies another worker, which tries again every
+    retry_interval_seconds, takes over.
+
+    on_elected is called once, from whichever thread won the lock.
+    """
+
+    def __init__(self, lock_path, on_elected, retry_interval_seconds=5):
+        self.lock_path = lock_path
+        self.on_elected = on_elected
+        self.retry_interval_seconds = retry_interval_seconds
+        self._fd = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def start(self):
+        # a single worker shouldn't have to wait for a thread to find
+        # out it's the leader
+        if self._try_to_lead():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="leader-election", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.retry_interval_seconds):
+            if self._try_to_lead():
+                return
+
+    def _try_to_lead(self) -> bool:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        logging.info(f"process {os.getpid()} holds {self.lock_path}, running background tasks")
+        self.on_elected()
+        return True
@@ -1,6 +1,15 @@
 import enum
+import os
 
 import prometheus_client
+from prometheus_client import multiprocess
+
+
+# the library's default buckets stop at 10 seconds, which a large
+# upload or a slow lp can go past
+REQUEST_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# a long job can sit in the scheduler for a good while
+SCHEDULER_WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
 
 
 class Metrics(enum.Enum):
@@ -23,8 +32,219 @@ class Metrics(enum.Enum):
         "total bytes of files pointed to by cache",
         prometheus_client.Gauge,
     )
+    SSH_TUNNEL_UP = (
+        "ssh_tunnel_up",
+        "1 while the ssh tunnel to core-v4 is connected, 0 while it's being reopened",
+        prometheus_client.Gauge,
+    )
+    SSH_TUNNEL_CONNECTED_AT = (
+        "ssh_tunnel_connected_at",
+        "unix time the ssh tunnel last came up, time() minus this is its uptime",
+        prometheus_client.Gauge,
+    )
+    SSH_TUNNEL_RECONNECTS = (
+        "ssh_tunnel_reconnects",
+        "number of times the ssh tunnel went down and was reopened, by reason",
+        prometheus_client.Counter,
+        ["reason"],
+    )
+    SERVER_STARTUP_SECONDS = (
+        "server_startup_seconds",
+        "seconds from the container starting to each startup phase (cups_ready, printers_registered, ready)",
+        prometheus_client.Gauge,
+        ["phase"],
+    )
+    SSH_TUNNEL_RECONNECT_SECONDS = (
+        "ssh_tunnel_reconnect_seconds",
+        "time from the ssh tunnel going down to it being back up",
+        prometheus_client.Histogram,
+        (),
+        (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    )
+    PRINT_JOBS_ROUTED = (
+        "print_jobs_routed",
+        "number of print jobs sent to each printer",
+        prometheus_client.Counter,
+        ["printer"],
+    )
+    PRINTER_ESTIMATED_DRAIN_SECONDS = (
+        "printer_estimated_drain_seconds",
+        "estimated seconds until a printer finishes the jobs in its queue",
+        prometheus_client.Gauge,
+        ["printer"],
+    )
+    PRINTER_FAILOVERS = (
+        "printer_failovers",
+        "number of times a printer was passed over for a job, by reason",
+        prometheus_client.Counter,
+        ["printer", "reason"],
+    )
+    PRINTER_CAN_PRINT = (
+        "printer_can_print",
+        "1 if the printer can take jobs going by the snmp collector, 0 if it's i.e. out of paper",
+        prometheus_client.Gauge,
+        ["printer"],
+    )
+
+    PRINT_QUEUE_DEPTH = (
+        "print_queue_depth",
+        "number of jobs in a printer's cups queue",
+        prometheus_client.Gauge,
+        ["printer"],
+    )
+    PRINT_SCHEDULER_PENDING = (
+        "print_scheduler_pending",
+        "number of jobs held by the scheduler until a cups queue has room",
+        prometheus_client.Gauge,
+    )
+    PRINT_SCHEDULER_WAIT_SECONDS = (
+        "print_scheduler_wait_seconds",
+        "time jobs waited in the scheduler before being sent to cups, by size in pages times copies",
+        prometheus_client.Histogram,
+        ["size"],
+        SCHEDULER_WAIT_BUCKETS,
+    )
+    PRINT_QUEUE_OLDEST_JOB_AGE_SECONDS = (
+        "print_queue_oldest_job_age_seconds",
+        "seconds since the oldest job in a printer's cups queue was submitted",
+        prometheus_client.Gauge,
+        ["printer"],
+    )
+    PRINT_JOB_STATE_TRANSITIONS = (
+        "print_job_state_transitions",
+        "number of times a job in a cups queue moved into each state",
+        prometheus_client.Counter,
+        ["printer", "state"],
+    )
+
+    PRINT_REQUEST_SECONDS = (
+        "print_request_seconds",
+        "end to end latency of requests to /print, including receiving the upload",
+        prometheus_client.Histogram,
+        (),
+        REQUEST_BUCKETS,
+    )
+    PRINT_UPLOAD_RECEIVE_SECONDS = (
+        "print_upload_receive_seconds",
+        "time from a /print request arriving to its upload being fully received",
+        prometheus_client.Histogram,
+        (),
+        REQUEST_BUCKETS,
+    )
+    PRINT_DISK_WRITE_SECONDS = (
+        "print_disk_write_seconds",
+        "time spent writing an upload to disk",
+        prometheus_client.Histogram,
+        (),
+        REQUEST_BUCKETS,
+    )
+    PRINT_SUBMISSION_SECONDS = (
+        "print_submission_seconds",
+        "time spent handing a job to cups, i.e. running lp",
+        prometheus_client.Histogram,
+        ["printer"],
+        REQUEST_BUCKETS,
+    )
+    PRINT_BYTES_RECEIVED = (
+        "print_bytes_received",
+        "total bytes of files uploaded to /print",
+        prometheus_client.Counter,
+    )
+    PRINT_REQUESTS_IN_FLIGHT = (
+        "print_requests_in_flight",
+        "number of requests to /print currently being handled",
+        prometheus_client.Gauge,
+    )
+    PRINT_ERRORS = (
+        "print_errors",
+        "number of failed requests to /print, by what went wrong",
+        prometheus_client.Counter,
+        ["kind"],
+    )
+
+    PRINT_DUPLICATES_SKIPPED = (
+        "print_duplicates_skipped",
+        "number of uploads that matched a recent one and weren't printed again",
+        prometheus_client.Counter,
+    )
+
+    PRINT_IDEMPOTENT_REPLAYS = (
+        "print_idempotent_replays",
+        "number of requests to /print answered with the response to an earlier request with the same idempotency key",
+        prometheus_client.Counter,
+    )
+
+    PRINT_ADMITTED_JOBS = (
+        "print_admitted_jobs",
+        "number of requests to /print admitted and not finished yet, i.e. uploading, waiting for a worker or running lp",
+        prometheus_client.Gauge,
+    )
+    PRINT_ADMITTED_BYTES = (
+        "print_admitted_bytes",
+        "total size of the uploads of requests to /print admitted and not finished yet",
+        prometheus_client.Gauge,
+    )
+    PRINT_ADMISSION_REJECTIONS = (
+        "print_admission_rejections",
+        "number of requests to /print turned away because the server was too busy or the client sent too many",
+        prometheus_client.Counter,
+        ["reason"],
+    )
+
+    PRINT_PAGES_SUBMITTED = (
+        "print_pages_submitted",
+        "number of pages sent to each printer, counting copies. only pdfs are counted",
+        prometheus_client.Counter,
+        ["printer"],
+    )
+    PDF_PREFLIGHT_SECONDS = (
+        "pdf_preflight_seconds",
+        "time spent counting the pages of an upload",
+        prometheus_client.Histogram,
+    )
+    PRINT_QUOTA_REJECTIONS = (
+        "print_quota_rejections",
+        "number of print requests turned away because the user was out of pages, by the quota they hit",
+        prometheus_client.Counter,
+        ["period"],
+    )
+    NORMALIZE_SECONDS = (
+        "normalize_seconds",
+        "time spent converting an upload to the printer's format, by format",
+        prometheus_client.Histogram,
+        ["format"],
+        REQUEST_BUCKETS,
+    )
+    NORMALIZE_CACHE_REQUESTS = (
+        "normalize_cache_requests",
+        "number of uploads looked up in the normalized document cache, by result (hit or miss)",
+        prometheus_client.Counter,
+        ["result"],
+    )
+    NORMALIZE_CACHE_BYTES = (
+        "normalize_cache_bytes",
+        "total size of the normalized document cache as of the last conversion",
+        prometheus_client.Gauge,
+    )
+    SPOOL_BYTES = (
+        "spool_bytes",
+        "total size of the uploads in the spool directory",
+        prometheus_client.Gauge,
+    )
+    SPOOL_FILES = (
+        "spool_files",
+        "number of uploads in the spool directory, by whether they're in use, kept by --dont-delete-pdfs or left behind",
+        prometheus_client.Gauge,
+        ["state"],
+    )
+    SPOOL_FILES_SWEPT = (
+        "spool_files_swept",
+        "number of uploads deleted by the spool sweeper, by which limit they were over",
+        prometheus_client.Counter,
+        ["reason"],
+    )
 
-    def __init__(self, title, description, prometheus_type, labels=()):
+    def __init__(self, title, description, prometheus_type, labels=(), buckets=None):
         # we use the above default value for labels because it matches what's used
         # in the prometheus_client library's metrics constructor, see
         # https://github.com/prometheus/client_python/blob/fd4da6cde36a1c278070cf18b4b9f72956774b05/prometheus_client/metrics.py#L115
@@ -32,6 +252,40 @@ class Metrics(enum.Enum):
         self.description = description
         self.prometheus_type = prometheus_type
         self.labels = labels
+        # only used by histograms, None means the library's default buckets
+        self.buckets = buckets
+
+
+# with --workers every worker process writes its metrics to files in
+# PROMETHEUS_MULTIPROC_DIR, and /metrics adds them up. counters and
+# histograms are just summed, gauges need to be told how to combine.
+# live* modes drop the values of workers that have exited.
+GAUGE_MULTIPROCESS_MODES = {
+    "last_health_check_request": "max",
+    "ssh_tunnel_last_opened": "max",
+    "server_startup_seconds": "max",
+    # only the leader runs the tunnel, a leader that died is down
+    "ssh_tunnel_up": "livemax",
+    "ssh_tunnel_connected_at": "livemax",
+    "printer_estimated_drain_seconds": "mostrecent",
+    "printer_can_print": "mostrecent",
+    # the cache directory is shared, whoever converted last saw it last
+    "normalize_cache_bytes": "mostrecent",
+    # every worker holds its own jobs
+    "print_scheduler_pending": "livesum",
+    # only the worker running the queue monitor sets these
+    "print_queue_depth": "mostrecent",
+    "print_queue_oldest_job_age_seconds": "mostrecent",
+    "print_requests_in_flight": "livesum",
+    "print_admitted_jobs": "livesum",
+    "print_admitted_bytes": "livesum",
+    "spool_bytes": "livesum",
+    "spool_files": "livesum",
+}
+
+
+def is_multiprocess() -> bool:
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
 
 
 class MetricsHandler:
@@ -42,11 +296,16 @@ class MetricsHandler:
     
     def init(self) -> None:
         for metric in Metrics:
+            kwargs = {}
+            if metric.buckets is not None:
+                kwargs["buckets"] = metric.buckets
+            if metric.prometheus_type is prometheus_client.Gauge:
+                kwargs["multiprocess_mode"] = GAUGE_MULTIPROCESS_MODES.get(metric.title, "all")
             setattr(
                 self,
                 metric.title,
                 metric.prometheus_type(
-                    metric.title, metric.description, labelnames=metric.labels
+                    metric.title, metric.description, labelnames=metric.labels, **kwargs
                 ),
             )
 
@@ -57,3 +316,46 @@ class MetricsHandler:
             cls.init(cls)
             # Put any initialization here.
         return cls._instance
+
+    def get_registry(self) -> prometheus_client.CollectorRegistry:
+        """
+        returns the registry to export, the metrics of every worker
+        added up if there's more than one.
+        """
+        if not is_multiprocess():
+            return prometheus_client.REGISTRY
+        directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        # uvicorn doesn't tell us when a worker exits, so this is
+        # where the live* gauges of dead workers get cleaned up
+        for pid in {name.rsplit("_", 1)[-1][:-len(".db")] for name in os.listdir(directory)}:
+            if pid.isdigit() and not is_process_alive(int(pid)):
+                multiprocess.mark_process_dead(int(pid), directory)
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, directory)
+        return registry
+
+    def generate_latest(self) -> bytes:
+        return prometheus_client.generate_latest(self.get_registry())
+
+
+def is_process_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def prepare_multiprocess_directory(directory):
+    """
+    empties directory and points prometheus_client at it. has to run
+    before the worker processes are started, since they pick the
+    variable up when they first import prometheus_client.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".db"):
+            os.remove(os.path.join(directory, name))
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
@@ -0,0 +1,241 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import threading
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# --normalize-format -> (ghostscript device, file extension). the
+# P2015dn speaks both, pcl is what its driver would send it and what it
+# prints fastest, postscript still goes through cups' filters (and the
+# printer's interpreter) but with fonts and images already flattened.
+FORMATS = {
+    "pcl": ("pxlmono", "pcl"),
+    "ps": ("ps2write", "ps"),
+}
+
+
+class ConversionError(Exception):
+    pass
+
+
+def get_command(input_path, output_path, output_format, page_range=None, sides="one-sided") -> list:
+    device, _ = FORMATS[output_format]
+    command = [
+        "gs",
+        "-q",
+        "-dSAFER",
+        "-dBATCH",
+        "-dNOPAUSE",
+        f"-sDEVICE={device}",
+        f"-sOutputFile={output_path}",
+    ]
+    if page_range:
+        command.append(f"-sPageList={page_range}")
+    if output_format == "pcl":
+        # pcl is sent to the printer as is, so anything cups would've
+        # done has to be in the file already
+        command.append("-r600")
+        if sides in ("two-sided-long-edge", "two-sided-short-edge"):
+            command.append("-dDuplex=true")
+            command.append(f"-dTumble={'true' if sides == 'two-sided-short-edge' else 'false'}")
+    command.append(str(input_path))
+    return command
+
+
+def convert(input_path, output_path, output_format, page_range=None, sides="one-sided", timeout_seconds=120):
+    """
+    converts the pdf at input_path with ghostscript, raising
+    ConversionError if it can't (i.e. the pdf is broken). runs in the
+    normalizer's process pool. output_path only ever holds a complete
+    conversion, so another worker can't pick up half a file.
+    """
+    partial_path = f"{output_path}.{os.getpid()}.partial"
+    command = get_command(input_path, partial_path, output_format, page_range, sides)
+    try:
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=timeout_seconds,
+        )
+    except subprocess.TimeoutExpired:
+        _remove(partial_path)
+        raise ConversionError(f"ghostscript took longer than {timeout_seconds} seconds")
+    except OSError as e:
+        raise ConversionError(f"unable to run ghostscript: {e}")
+    if result.returncode != 0 or not os.path.exists(partial_path) or os.path.getsize(partial_path) == 0:
+        _remove(partial_path)
+        # ghostscript says what's wrong with the pdf on the last lines
+        errors = " ".join((result.stderr or result.stdout).strip().splitlines()[-3:])
+        raise ConversionError(f"ghostscript returned code {result.returncode}: {errors}")
+    os.replace(partial_path, output_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Normalizer:
+    """
+    converts uploads to what the printer takes directly (see FORMATS),
+    so it doesn't spend minutes rasterizing a scanned handout itself. a
+    pdf ghostscript can't read is turned away before it gets to cups,
+    where it would have jammed the queue.
+
+    conversions run in a process pool, so neither the event loop nor
+    the lp threads wait on them, and are kept in cache_directory named
+    after the upload's hash and the options baked into them. a handout
+    printed over and over is converted once. once the directory is over
+    max_cache_bytes the least recently used conversions are deleted,
+    going by their mtime, which a cache hit bumps. the directory can be
+    shared by every worker.
+
+    a conversion normalize() hands out is pinned, eviction leaves it
+    alone until it's been release()d, so a job waiting in the scheduler
+    still has its file when its turn comes. pins only hold in the
+    process that took them, other workers sharing the directory go by
+    the mtime, and a conversion that was just handed out is the last
+    thing they'd evict.
+    """
+
+    def __init__(
+        self,
+        output_format,
+        cache_directory,
+        max_cache_bytes=1024 * 1024 * 1024,
+        workers=2,
+        timeout_seconds=120,
+    ):
+        self.output_format = output_format
+        self.cache_directory = pathlib.Path(cache_directory)
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout_seconds = timeout_seconds
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # path of a conversion -> how many jobs are holding on to it
+        self._pins = collections.Counter()
+        # spawned rather than forked, forking a process that's running
+        # threads (the lp pool, the job store's writer) can deadlock the
+        # child. they're only started once the first conversion is.
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    @property
+    def is_raw(self) -> bool:
+        """
+        whether conversions should skip cups' filters, pcl already has
+        everything cups would've added.
+        """
+        return self.output_format == "pcl"
+
+    def get_cache_path(self, digest, page_range=None, sides="one-sided") -> pathlib.Path:
+        key = hashlib.sha256(f"{digest}:{self.output_format}:{page_range}:{sides}".encode()).hexdigest()
+        return self.cache_directory / f"{key}.{FORMATS[self.output_format][1]}"
+
+    async def normalize(self, file_path, digest, page_range=None, sides="one-sided") -> pathlib.Path:
+        """
+        returns the path of the converted file, raising ConversionError
+        if the upload couldn't be converted. page_range and sides are
+        baked into it. the file is pinned until release() is called
+        with it.
+        """
+        output_path = self.get_cache_path(digest, page_range, sides)
+        # pinned before it's looked up, so an eviction can't slip in
+        # between the two
+        self._pin(output_path)
+        try:
+            try:
+                # bumped so eviction sees it as recently used
+                os.utime(output_path)
+                metrics_handler.normalize_cache_requests.labels(result="hit").inc()
+                return output_path
+            except FileNotFoundError:
+                metrics_handler.normalize_cache_requests.labels(result="miss").inc()
+
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(
+                    self._executor,
+                    convert,
+                    str(file_path),
+                    str(output_path),
+                    self.output_format,
+                    page_range,
+                    sides,
+                    self.timeout_seconds,
+                )
+            finally:
+                metrics_handler.normalize_seconds.labels(format=self.output_format).observe(
+                    time.perf_counter() - start
+                )
+            await asyncio.to_thread(self.evict)
+            return output_path
+        except BaseException:
+            self.release(output_path)
+            raise
+
+    def release(self, path):
+        """
+        unpins a conversion normalize() returned, once its job has gone
+        to cups (or won't).
+        """
+        with self._lock:
+            self._pins[str(path)] -= 1
+            if self._pins[str(path)] <= 0:
+                del self._pins[str(path)]
+
+    def _pin(self, path):
+        with self._lock:
+            self._pins[str(path)] += 1
+
+    def evict(self):
+        """
+        deletes the least recently used conversions until the cache is
+        under max_cache_bytes. pinned conversions are left alone (but
+        counted) even if they're bigger than the whole cache.
+        """
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_directory):
+            if entry.name.endswith(".partial"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # another worker evicted it first
+                continue
+            total_bytes += stat.st_size
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_cache_bytes:
+                break
+            with self._lock:
+                # checked right before deleting, normalize() may have
+                # pinned it since the scan
+                if path in self._pins:
+                    continue
+                _remove(path)
+            total_bytes -= size
+            logging.info(f"evicted {path} from the normalized document cache")
+        metrics_handler.normalize_cache_bytes.set(total_bytes)
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
@@ -0,0 +1,359 @@
+import collections
+import logging
+import mmap
+import os
+import re
+import threading
+import zlib
+
+
+# startxref is always in the last few hundred bytes, this leaves room
+# for junk some writers append after %%EOF
+TAIL_SIZE = 4096
+
+STARTXREF_PATTERN = re.compile(rb"startxref\s+(\d+)")
+OBJECT_HEADER_PATTERN = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj")
+ROOT_PATTERN = re.compile(rb"/Root\s+(\d+)\s+\d+\s+R")
+PAGES_PATTERN = re.compile(rb"/Pages\s+(\d+)\s+\d+\s+R")
+COUNT_PATTERN = re.compile(rb"/Count\s+(\d+)")
+PREV_PATTERN = re.compile(rb"/Prev\s+(\d+)")
+XREF_STREAM_PATTERN = re.compile(rb"/XRefStm\s+(\d+)")
+LENGTH_PATTERN = re.compile(rb"/Length\s+(\d+)(?!\s+\d+\s+R)")
+W_PATTERN = re.compile(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]")
+INDEX_PATTERN = re.compile(rb"/Index\s*\[([\d\s]+)\]")
+SIZE_PATTERN = re.compile(rb"/Size\s+(\d+)")
+FIRST_PATTERN = re.compile(rb"/First\s+(\d+)")
+PREDICTOR_PATTERN = re.compile(rb"/Predictor\s+(\d+)")
+COLUMNS_PATTERN = re.compile(rb"/Columns\s+(\d+)")
+# a page object, not the /Type /Pages of the page tree
+PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+
+
+class PdfError(Exception):
+    pass
+
+
+def count_pages(file_path):
+    """
+    returns how many pages the pdf at file_path has, or None if it
+    isn't a pdf at all. only the cross reference table, the trailer and
+    the couple of objects they point to are read, and the file is
+    memory mapped, so this takes about as long for a 300 MB pdf as for
+    a 3 page one. if the structure is broken, the page objects are
+    counted instead by scanning the whole file. raises PdfError if the
+    file says it's a pdf but there's no page to be found that way
+    either.
+    """
+    # os.open instead of open, the tests mock open to fake uploads
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        if os.fstat(fd).st_size == 0:
+            return None
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as data:
+            if b"%PDF-" not in data[:1024]:
+                return None
+            try:
+                return PdfReader(data).count_pages()
+            except PdfError as e:
+                # pages packed in object streams are compressed, so
+                # this finds nothing in those
+                pages = sum(1 for _ in PAGE_PATTERN.finditer(data))
+                if not pages:
+                    raise
+                logging.warning(f"{file_path} is broken ({e}), counted {pages} page objects instead")
+                return pages
+    finally:
+        os.close(fd)
+
+
+def is_pdf(file_path) -> bool:
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        return b"%PDF-" in os.read(fd, 1024)
+    finally:
+        os.close(fd)
+
+
+class PdfReader:
+    """
+    just enough of a pdf parser to follow the trailer to the page tree.
+    handles classic xref tables, xref streams (pdf 1.5+), objects
+    packed in object streams and incremental updates.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        # object number -> (1, offset) or (2, object stream number, index)
+        self.entries = {}
+        self.trailers = []
+        self._object_streams = {}
+        self._read_xref_chain(self._find_startxref())
+
+    def count_pages(self) -> int:
+        for trailer in self.trailers:
+            root = ROOT_PATTERN.search(trailer)
+            if root is not None:
+                break
+        else:
+            raise PdfError("trailer has no /Root")
+        catalog = self.get_object(int(root.group(1)))
+        pages = PAGES_PATTERN.search(catalog)
+        if pages is None:
+            raise PdfError("catalog has no /Pages")
+        count = COUNT_PATTERN.search(self.get_object(int(pages.group(1))))
+        if count is None:
+            raise PdfError("page tree has no /Count")
+        return int(count.group(1))
+
+    def get_object(self, number) -> bytes:
+        """
+        returns the body of the object, up to its stream or endobj.
+        """
+        entry = self.entries.get(number)
+        if entry is None:
+            raise PdfError(f"object {number} isn't in the xref")
+        if entry[0] == 2:
+            return self._get_compressed_object(entry[1], entry[2])
+        body_start = self._skip_object_header(entry[1], number)
+        end = self._find_object_end(body_start)
+        return bytes(self.data[body_start:end])
+
+    def _find_startxref(self) -> int:
+        tail_start = max(0, len(self.data) - TAIL_SIZE)
+        index = self.data.rfind(b"startxref", tail_start)
+        if index < 0:
+            raise PdfError("no startxref")
+        match = STARTXREF_PATTERN.match(self.data, index)
+        if match is None:
+            raise PdfError("startxref has no offset")
+        return int(match.group(1))
+
+    def _read_xref_chain(self, offset):
+        # the newest section comes first and wins, /Prev points at the
+        # one it updates
+        seen = set()
+        pending = [offset]
+        while pending:
+            offset = pending.pop(0)
+            if offset in seen or offset >= len(self.data):
+                continue
+            seen.add(offset)
+            start = offset
+            while start < len(self.data) and self.data[start:start + 1].isspace():
+                start += 1
+            if self.data[start:start + 4] == b"xref":
+                trailer = self._read_xref_table(start + 4)
+                # hybrid files keep the entries of their compressed
+                # objects in a stream next to the table
+                xref_stream = XREF_STREAM_PATTERN.search(trailer)
+                if xref_stream is not None:
+                    pending.insert(0, int(xref_stream.group(1)))
+            else:
+                trailer = self._read_xref_stream(start)
+            self.trailers.append(trailer)
+            previous = PREV_PATTERN.search(trailer)
+            if previous is not None:
+                pending.append(int(previous.group(1)))
+
+    def _read_xref_table(self, offset) -> bytes:
+        trailer_start = self.data.find(b"trailer", offset)
+        if trailer_start < 0:
+            raise PdfError("xref table has no trailer")
+        tokens = self.data[offset:trailer_start].split()
+        i = 0
+        try:
+            while i < len(tokens):
+                first, count = int(tokens[i]), int(tokens[i + 1])
+                i += 2
+                for number in range(first, first + count):
+                    entry_offset, kind = int(tokens[i]), tokens[i + 2]
+                    i += 3
+                    if kind == b"n":
+                        self.entries.setdefault(number, (1, entry_offset))
+        except (IndexError, ValueError):
+            raise PdfError("malformed xref table")
+        trailer_end = self.data.find(b"startxref", trailer_start)
+        if trailer_end < 0:
+            trailer_end = len(self.data)
+        return bytes(self.data[trailer_start:trailer_end])
+
+    def _read_xref_stream(self, offset) -> bytes:
+        body_start = self._skip_object_header(offset)
+        dictionary, stream = self._read_stream(body_start)
+        widths = W_PATTERN.search(dictionary)
+        size = SIZE_PATTERN.search(dictionary)
+        if widths is None or size is None:
+            raise PdfError("xref stream has no /W or /Size")
+        widths = [int(width) for width in widths.groups()]
+        index = INDEX_PATTERN.search(dictionary)
+        index = [int(n) for n in index.group(1).split()] if index else [0, int(size.group(1))]
+
+        row_size = sum(widths)
+        position = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for number in range(first, first + count):
+                row = stream[position:position + row_size]
+                position += row_size
+                if len(row) < row_size:
+                    raise PdfError("xref stream is shorter than its /Index")
+                fields = []
+                field_start = 0
+                for width in widths:
+                    fields.append(int.from_bytes(row[field_start:field_start + width], "big"))
+                    field_start += width
+                # a zero width type field means every entry is type 1
+                kind = fields[0] if widths[0] else 1
+                if kind in (1, 2):
+                    self.entries.setdefault(number, (kind, fields[1], fields[2]))
+        return dictionary
+
+    def _get_compressed_object(self, stream_number, index) -> bytes:
+        if stream_number not in self._object_streams:
+            dictionary, stream = self._read_stream(
+                self._skip_object_header(self.entries.get(stream_number, (1, -1))[1], stream_number)
+            )
+            first = FIRST_PATTERN.search(dictionary)
+            if first is None:
+                raise PdfError(f"object stream {stream_number} has no /First")
+            first = int(first.group(1))
+            header = stream[:first].split()
+            offsets = [first + int(offset) for offset in header[1::2]]
+            self._object_streams[stream_number] = (stream, offsets)
+        stream, offsets = self._object_streams[stream_number]
+        if index >= len(offsets):
+            raise PdfError(f"object stream {stream_number} has no object {index}")
+        end = offsets[index + 1] if index + 1 < len(offsets) else len(stream)
+        return stream[offsets[index]:end]
+
+    def _skip_object_header(self, offset, number=None) -> int:
+        if offset < 0:
+            raise PdfError(f"object {number} isn't in the xref")
+        match = OBJECT_HEADER_PATTERN.match(self.data, offset)
+        if match is None or (number is not None and int(match.group(1)) != number):
+            raise PdfError(f"no object {number} at offset {offset}")
+        return match.end()
+
+    def _find_object_end(self, start) -> int:
+        ends = [
+            index
+            for index in (self.data.find(b"stream", start), self.data.find(b"endobj", start))
+            if index >= 0
+        ]
+        if not ends:
+            raise PdfError(f"object at {start} never ends")
+        return min(ends)
+
+    def _read_stream(self, body_start) -> tuple:
+        """
+        returns the dictionary and decoded data of the stream object
+        whose body starts at body_start.
+        """
+        stream_keyword = self.data.find(b"stream", body_start)
+        if stream_keyword < 0:
+            raise PdfError(f"object at {body_start} isn't a stream")
+        dictionary = bytes(self.data[body_start:stream_keyword])
+        stream_start = stream_keyword + len(b"stream")
+        if self.data[stream_start:stream_start + 2] == b"\r\n":
+            stream_start += 2
+        elif self.data[stream_start:stream_start + 1] in (b"\n", b"\r"):
+            stream_start += 1
+        length = LENGTH_PATTERN.search(dictionary)
+        if length is not None:
+            stream_end = stream_start + int(length.group(1))
+        else:
+            # the length is an indirect object, which could itself be
+            # in this stream
+            stream_end = self.data.find(b"endstream", stream_start)
+            if stream_end < 0:
+                raise PdfError(f"stream at {stream_start} never ends")
+        stream = bytes(self.data[stream_start:stream_end])
+
+        if b"/FlateDecode" in dictionary:
+            try:
+                stream = zlib.decompress(stream)
+            except zlib.error:
+                # trailing whitespace before endstream upsets zlib
+                # when we had to guess the length
+                stream = zlib.decompressobj().decompress(stream)
+        elif b"/Filter" in dictionary:
+            raise PdfError("only FlateDecode streams are supported")
+        predictor = PREDICTOR_PATTERN.search(dictionary)
+        if predictor is not None and int(predictor.group(1)) >= 10:
+            columns = COLUMNS_PATTERN.search(dictionary)
+            stream = undo_png_predictor(stream, int(columns.group(1)) if columns else 1)
+        return dictionary, stream
+
+
+def undo_png_predictor(data, columns) -> bytes:
+    """
+    reverses the png row filters xref streams are usually compressed
+    with. every row starts with a byte saying which filter it used.
+    """
+    output = bytearray()
+    previous = bytearray(columns)
+    for row_start in range(0, len(data), columns + 1):
+        filter_type = data[row_start]
+        row = bytearray(data[row_start + 1:row_start + 1 + columns])
+        for i in range(len(row)):
+            left = row[i - 1] if i else 0
+            up = previous[i]
+            up_left = previous[i - 1] if i else 0
+            if filter_type == 1:
+                row[i] = (row[i] + left) & 0xFF
+            elif filter_type == 2:
+                row[i] = (row[i] + up) & 0xFF
+            elif filter_type == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xFF
+            elif filter_type == 4:
+                estimate = left + up - up_left
+                distances = (abs(estimate - left), abs(estimate - up), abs(estimate - up_left))
+                closest = (left, up, up_left)[distances.index(min(distances))]
+                row[i] = (row[i] + closest) & 0xFF
+        output += row
+        previous = row
+    return bytes(output)
+
+
+class PageCounter:
+    """
+    counts pages with count_pages, remembering the result by content
+    hash so a pdf that's printed over and over (i.e. a handout) is only
+    parsed once.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # sha256 hex digest -> page count, None if it isn't a pdf, or the
+        # PdfError it raised
+        self._counts = collections.OrderedDict()
+
+    def count_pages(self, file_path, digest):
+        """
+        returns the page count of the file, or None if it isn't a pdf
+        (or couldn't be read). raises PdfError if it's a pdf we can't
+        count the pages of.
+        """
+        with self._lock:
+            if digest in self._counts:
+                self._counts.move_to_end(digest)
+                pages = self._counts[digest]
+                if isinstance(pages, PdfError):
+                    raise pages
+                return pages
+        try:
+            pages = count_pages(file_path)
+        except OSError:
+            logging.exception(f"unable to read {file_path} to count its pages")
+            # nothing was learned about the content, so nothing's saved
+            return None
+        except PdfError as e:
+            logging.warning(f"unable to count the pages of {file_path}: {e}")
+            pages = e
+        with self._lock:
+            self._counts[digest] = pages
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        if isinstance(pages, PdfError):
+            raise pages
+        return pages
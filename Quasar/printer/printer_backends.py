@@ -0,0 +1,204 @@
+import dataclasses
+import logging
+import subprocess
+import time
+
+from ipp import IppClient, JobState
+
+
+@dataclasses.dataclass
+class QueuedJob:
+    # same format lp prints, i.e. right-printer-53
+    print_id: str
+    printer: str
+    state: str = None
+    user: str = None
+    size_bytes: int = None
+    # epoch seconds
+    created_at: float = None
+
+
+class LpBackend:
+    """
+    submits jobs by running `lp` and reads the queue with `lpstat -o`.
+    every call forks a process, but it needs nothing besides the
+    cups client tools.
+    """
+
+    name = "lp"
+
+    def get_command(self, file_path, printer_name, num_copies, page_range=None, sides="one-sided", raw=False) -> str:
+        extra_options = ""
+        if page_range:
+            # to speciy page ranges, we can do:
+            # `-o page-ranges=<whatever user sent>` OR `-P <whatever user sent>`
+            extra_options = f"-o page-ranges={page_range}"
+        if raw:
+            # raw files (i.e. pcl we converted) skip cups' filters and go
+            # to the printer as is
+            extra_options = f"{extra_options} -o raw".strip()
+        return f"lp -n {num_copies} {extra_options} -o sides={sides} -o media=na_letter_8.5x11in -d {printer_name} {file_path}"
+
+    def describe(self, *args, **kwargs) -> str:
+        return f"command would've been `{self.get_command(*args, **kwargs)}`"
+
+    def submit(self, file_path, printer_name, num_copies, page_range=None, sides="one-sided", raw=False) -> str:
+        command = self.get_command(file_path, printer_name, num_copies, page_range, sides, raw)
+        print_job = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        print_job.wait()
+
+        if print_job.returncode != 0:
+            logging.error(
+                f"command returned code {print_job.returncode} stderr: {print_job.stderr.read()} stdout: {print_job.stdout.read()}"
+            )
+            return None
+        try:
+            print_id = print_job.stdout.read().strip().split(" ")[3]
+            logging.info(f"extracted print id is {print_id}")
+            return print_id
+        except Exception:
+            logging.exception(
+                f"failed to extract print id from stdout: {print_job.stdout.read()}"
+            )
+            # need to find a better value to return when the command exited
+            # with code 0 but the output could not be parsed for a job id.
+            return ''
+
+    def get_queue(self, printer_name) -> list:
+        return self._lpstat(["-o", printer_name], printer_name)
+
+    def get_finished_jobs(self, printer_name) -> list:
+        """
+        returns the jobs cups still remembers finishing. lpstat doesn't
+        say whether one completed or was canceled, so their state is
+        None.
+        """
+        return self._lpstat(["-W", "completed", "-o", printer_name], printer_name)
+
+    def _lpstat(self, arguments, printer_name) -> list:
+        result = subprocess.run(
+            ["lpstat", *arguments],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        return parse_lpstat_output(result.stdout, printer_name)
+
+
+def parse_lpstat_output(output, printer_name) -> list:
+    """
+    lpstat -o prints one line per job that hasn't completed, i.e.
+    right-printer-53 sce 1024 Fri 17 Jul 2025 02:40:12 PM UTC
+    it doesn't say whether the job is pending or printing.
+    """
+    jobs = []
+    for line in output.splitlines():
+        fields = line.split(None, 3)
+        if len(fields) < 3:
+            continue
+        print_id, user, size = fields[:3]
+        jobs.append(
+            QueuedJob(
+                print_id=print_id,
+                printer=printer_name,
+                user=user,
+                size_bytes=int(size) if size.isdigit() else None,
+                created_at=_parse_lpstat_time(fields[3]) if len(fields) == 4 else None,
+            )
+        )
+    return jobs
+
+
+def _parse_lpstat_time(value):
+    # lpstat formats the time with the container's locale, these are
+    # the formats we've seen from the C and en_US locales
+    for time_format in ("%a %d %b %Y %I:%M:%S %p %Z", "%a %b %d %H:%M:%S %Y"):
+        try:
+            return time.mktime(time.strptime(value.strip(), time_format))
+        except ValueError:
+            continue
+    return None
+
+
+# what `lp -o raw` asks cups for
+RAW_DOCUMENT_FORMAT = "application/vnd.cups-raw"
+
+
+class IppBackend:
+    """
+    talks IPP to the cups server directly over pooled keep-alive
+    connections, so neither printing nor checking the queue forks
+    a process. job ids and states come back as structured data.
+    """
+
+    name = "ipp"
+
+    def __init__(self, cups_url="http://localhost:631", pool_size=4):
+        self.client = IppClient(cups_url, pool_size=pool_size)
+
+    def describe(self, file_path, printer_name, num_copies, page_range=None, sides="one-sided", raw=False) -> str:
+        return (
+            f"Print-Job to {self.client.printer_uri(printer_name)} would've sent {file_path} with "
+            f"copies={num_copies} sides={sides} page-ranges={page_range} raw={raw}"
+        )
+
+    def submit(self, file_path, printer_name, num_copies, page_range=None, sides="one-sided", raw=False) -> str:
+        try:
+            job_id = self.client.print_job(
+                printer_name,
+                file_path,
+                copies=num_copies,
+                sides=sides,
+                page_range=page_range,
+                media="na_letter_8.5x11in",
+                document_format=RAW_DOCUMENT_FORMAT if raw else None,
+            )
+        except Exception:
+            logging.exception(f"Print-Job to {printer_name} failed")
+            return None
+        if job_id is None:
+            logging.error(f"Print-Job to {printer_name} succeeded but returned no job-id")
+            return ''
+        print_id = f"{printer_name}-{job_id}"
+        logging.info(f"extracted print id is {print_id}")
+        return print_id
+
+    def get_queue(self, printer_name) -> list:
+        return self._get_jobs(printer_name, "not-completed")
+
+    def get_finished_jobs(self, printer_name) -> list:
+        """
+        returns the jobs cups still remembers finishing, in the
+        completed, canceled or aborted state.
+        """
+        return self._get_jobs(printer_name, "completed")
+
+    def _get_jobs(self, printer_name, which_jobs) -> list:
+        jobs = []
+        for attributes in self.client.get_jobs(printer_name, which_jobs=which_jobs):
+            state = attributes.get("job-state")
+            k_octets = attributes.get("job-k-octets")
+            jobs.append(
+                QueuedJob(
+                    print_id=f"{printer_name}-{attributes.get('job-id')}",
+                    printer=printer_name,
+                    state=JobState(state).name.lower() if state in JobState._value2member_map_ else None,
+                    user=attributes.get("job-originating-user-name"),
+                    size_bytes=k_octets * 1024 if k_octets is not None else None,
+                    created_at=attributes.get("time-at-creation"),
+                )
+            )
+        return jobs
+
+
+def get_backend(name, cups_url="http://localhost:631", pool_size=4):
+    if name == IppBackend.name:
+        return IppBackend(cups_url, pool_size=pool_size)
+    return LpBackend()
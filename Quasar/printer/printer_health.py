@@ -0,0 +1,161 @@
+import collections
+import dataclasses
+import logging
+import threading
+import time
+
+from prometheus_client.parser import text_string_to_metric_families
+import requests
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# the collector exports an empty paper tray under either of these
+# names depending on the printer, see SnmpOid in collector/server.py
+TRAY_EMPTY_METRIC_NAMES = ("tray_empty", "tray_empty_2")
+
+HEALTHY = "healthy"
+# can print, but someone should take a look (i.e. toner is low)
+DEGRADED = "degraded"
+# jobs sent to it would sit in cups until someone fixes it
+DOWN = "down"
+# no recent data from the collector, so we assume it can print
+UNKNOWN = "unknown"
+
+
+@dataclasses.dataclass
+class PrinterHealth:
+    status: str = UNKNOWN
+    problems: list = dataclasses.field(default_factory=list)
+    toner_percent: float = None
+    page_count: int = None
+    # epoch time of the printer's last snmp response
+    last_seen_at: float = None
+
+    @property
+    def can_print(self) -> bool:
+        return self.status != DOWN
+
+
+@dataclasses.dataclass
+class DeviceSamples:
+    errors: dict = dataclasses.field(default_factory=dict)
+    values: dict = dataclasses.field(default_factory=dict)
+    unreachable: bool = False
+    last_success: float = None
+
+
+def parse_collector_metrics(text) -> dict:
+    """
+    returns the snmp samples of every printer in the collector's
+    /metrics output, by ip.
+    """
+    devices = collections.defaultdict(DeviceSamples)
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            ip = sample.labels.get("ip")
+            if ip is None:
+                continue
+            if family.name == "snmp_error":
+                devices[ip].errors[sample.labels.get("name")] = sample.value
+            elif family.name == "snmp_metric":
+                devices[ip].values[sample.labels.get("name")] = sample.value
+            elif family.name == "device_unreachable":
+                devices[ip].unreachable = sample.value == 1
+            elif family.name == "snmp_last_success_timestamp":
+                devices[ip].last_success = sample.value
+    return dict(devices)
+
+
+def assess(samples, low_toner_percent=10) -> PrinterHealth:
+    health = PrinterHealth(status=HEALTHY, last_seen_at=samples.last_success)
+    if samples.unreachable:
+        health.problems.append("unreachable")
+    if any(samples.errors.get(name) == 1 for name in TRAY_EMPTY_METRIC_NAMES):
+        health.problems.append("tray_empty")
+
+    # the printer mib uses negative levels for "unknown" and "some
+    # left", only a level of 0 means it's actually out
+    level = samples.values.get("ink_level")
+    capacity = samples.values.get("ink_capacity")
+    if level is not None and level >= 0 and capacity:
+        health.toner_percent = round(100 * level / capacity, 1)
+    if level == 0:
+        health.problems.append("out_of_toner")
+    elif health.toner_percent is not None and health.toner_percent < low_toner_percent:
+        health.problems.append("low_toner")
+
+    if samples.values.get("page_count") is not None:
+        health.page_count = int(samples.values["page_count"])
+    if health.problems:
+        health.status = DEGRADED if health.problems == ["low_toner"] else DOWN
+    return health
+
+
+class PrinterHealthMonitor:
+    """
+    keeps a health snapshot of every printer, built from what the snmp
+    collector last saw. the snapshot is fetched again once it's older
+    than ttl_seconds. if the collector can't be reached the last
+    snapshot is used, until it's older than stale_after_seconds, after
+    which every printer is UNKNOWN. an old snapshot saying a printer
+    is down shouldn't stop us printing forever.
+    """
+
+    def __init__(
+        self,
+        printers,
+        collector_metrics_url,
+        ttl_seconds=30,
+        stale_after_seconds=600,
+        low_toner_percent=10,
+        timeout=2,
+    ):
+        self.printers = printers
+        self.collector_metrics_url = collector_metrics_url
+        self.ttl_seconds = ttl_seconds
+        self.stale_after_seconds = stale_after_seconds
+        self.low_toner_percent = low_toner_percent
+        self.timeout = timeout
+        # held while fetching, so concurrent callers share one request
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._fetched_at = None
+        # printer name -> PrinterHealth
+        self._snapshot = {}
+
+    def get_snapshot(self) -> dict:
+        """
+        returns the health of every printer by name.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.ttl_seconds:
+                self._refresh()
+                self._checked_at = now
+            if self._fetched_at is None or now - self._fetched_at > self.stale_after_seconds:
+                return {printer.name: PrinterHealth() for printer in self.printers}
+            return dict(self._snapshot)
+
+    def _refresh(self):
+        try:
+            response = requests.get(self.collector_metrics_url, timeout=self.timeout)
+            response.raise_for_status()
+            devices = parse_collector_metrics(response.text)
+        except Exception:
+            logging.exception(f"failed to get printer health from {self.collector_metrics_url}")
+            return
+        snapshot = {}
+        for printer in self.printers:
+            samples = devices.get(printer.ip)
+            health = (
+                assess(samples, self.low_toner_percent) if samples is not None else PrinterHealth()
+            )
+            if health.status == DOWN and self._snapshot.get(printer.name, PrinterHealth()).can_print:
+                logging.warning(f"{printer.name} can't print: {', '.join(health.problems)}")
+            metrics_handler.printer_can_print.labels(printer=printer.name).set(int(health.can_print))
+            snapshot[printer.name] = health
+        self._snapshot = snapshot
+        self._fetched_at = time.monotonic()
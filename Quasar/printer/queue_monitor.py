@@ -0,0 +1,248 @@
+import collections
+import logging
+import threading
+import time
+
+from metrics import MetricsHandler
+from printer_backends import QueuedJob
+
+
+metrics_handler = MetricsHandler.instance()
+
+# what cups reports for a job that won't change state again
+FINISHED_STATES = {"completed", "canceled", "aborted"}
+# how many print ids we remember having recorded as finished, so a job
+# isn't finished twice before its state is in the job database
+MAX_FINISHED_PRINT_IDS = 10000
+
+
+class QueueMonitor:
+    """
+    watches the cups queue of every printer and records when a job
+    shows up, changes state or leaves the queue. nothing is recorded
+    while the queue stays the same.
+
+    a job that leaves the queue is looked up in the jobs cups finished,
+    to tell a completed job from one that was canceled or aborted. so
+    are jobs the job database says were sent in the last
+    reconcile_window_seconds and haven't finished, which covers a short
+    job that came and went between two polls, or one another worker
+    sent (their wake() doesn't reach us). a job cups doesn't remember
+    at all is taken to have completed.
+
+    the queue is polled every min_interval_seconds while it has jobs
+    in it or the job database has unfinished ones. otherwise the
+    interval doubles after every poll, up to max_interval_seconds, and
+    drops back down as soon as wake() is called (i.e. when a job is
+    submitted) or a job appears.
+
+    on_transition, if given, is called with the print id and new state
+    of every job that changes state.
+    """
+
+    def __init__(
+        self,
+        printer_names,
+        backend,
+        job_store=None,
+        min_interval_seconds=1,
+        max_interval_seconds=60,
+        on_transition=None,
+        reconcile_window_seconds=24 * 60 * 60,
+    ):
+        self.printer_names = printer_names
+        self.backend = backend
+        self.job_store = job_store
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.on_transition = on_transition
+        self.reconcile_window_seconds = reconcile_window_seconds
+        self.interval_seconds = min_interval_seconds
+        # print id -> QueuedJob, as of the last poll
+        self.jobs = {}
+        # print ids recorded as finished, oldest first
+        self._finished_print_ids = collections.OrderedDict()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        self._wake_event.set()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="queue-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            self._wake_event.wait(self.interval_seconds)
+            if self._wake_event.is_set():
+                self._wake_event.clear()
+                self.interval_seconds = self.min_interval_seconds
+
+    def poll(self):
+        now = time.time()
+        current_jobs = {}
+        # printers we couldn't reach keep their last known jobs, so a
+        # failed poll doesn't look like every job finished at once
+        failed_printers = set()
+        for printer_name in self.printer_names:
+            try:
+                queue = self.backend.get_queue(printer_name)
+            except Exception as e:
+                logging.warning(f"unable to get print queue for {printer_name}: {e}")
+                failed_printers.add(printer_name)
+                continue
+            for job in queue:
+                current_jobs[job.print_id] = job
+            metrics_handler.print_queue_depth.labels(printer=printer_name).set(len(queue))
+            created_at = [job.created_at for job in queue if job.created_at is not None]
+            metrics_handler.print_queue_oldest_job_age_seconds.labels(
+                printer=printer_name
+            ).set(now - min(created_at) if created_at else 0)
+
+        # cups only lists jobs that haven't finished, so these have
+        left_queue = {}
+        for print_id, job in self.jobs.items():
+            if job.printer in failed_printers:
+                current_jobs[print_id] = job
+            elif print_id not in current_jobs:
+                left_queue[print_id] = job
+        # and so have these, if they were sent before we looked
+        unfinished = [
+            (print_id, printer_name)
+            for print_id, printer_name in self._get_unfinished_print_ids(now)
+            if print_id not in self._finished_print_ids and printer_name in self.printer_names
+        ]
+        unseen = {}
+        for print_id, printer_name in unfinished:
+            if (
+                print_id in current_jobs
+                or print_id in left_queue
+                or printer_name in failed_printers
+            ):
+                continue
+            unseen[print_id] = QueuedJob(print_id=print_id, printer=printer_name)
+        self._reconcile(left_queue, unseen, now)
+
+        for print_id, job in current_jobs.items():
+            previous = self.jobs.get(print_id)
+            if previous is None:
+                self._record_transition(job, None, job.state or "queued", now)
+            elif previous.state != job.state:
+                self._record_transition(job, previous.state, job.state, now)
+        self.jobs = current_jobs
+
+        if current_jobs or any(print_id not in self._finished_print_ids for print_id, _ in unfinished):
+            self.interval_seconds = self.min_interval_seconds
+        else:
+            self.interval_seconds = min(
+                self.interval_seconds * 2, self.max_interval_seconds
+            )
+
+    def _get_unfinished_print_ids(self, now) -> list:
+        if self.job_store is None:
+            return []
+        try:
+            return self.job_store.get_unfinished_print_ids(
+                since=now - self.reconcile_window_seconds, before=now
+            )
+        except Exception:
+            logging.exception("unable to read unfinished jobs from the job database")
+            return []
+
+    def _reconcile(self, left_queue, unseen, now):
+        """
+        records how the jobs that left the queue, and the unseen jobs
+        the job database says haven't finished, ended up.
+        """
+        finished_jobs = {}
+        failed_printers = set()
+        for printer_name in {job.printer for job in [*left_queue.values(), *unseen.values()]}:
+            try:
+                for job in self.backend.get_finished_jobs(printer_name):
+                    finished_jobs[job.print_id] = job
+            except Exception as e:
+                logging.warning(f"unable to get finished jobs for {printer_name}: {e}")
+                failed_printers.add(printer_name)
+
+        for print_id, job in [*left_queue.items(), *unseen.items()]:
+            finished_job = finished_jobs.get(print_id)
+            if finished_job is None and print_id in unseen and job.printer in failed_printers:
+                # try again on the next poll
+                continue
+            state = "completed"
+            if finished_job is not None and finished_job.state in FINISHED_STATES:
+                state = finished_job.state
+            self._record_transition(job, job.state, state, now)
+            self._finished_print_ids[print_id] = None
+            while len(self._finished_print_ids) > MAX_FINISHED_PRINT_IDS:
+                self._finished_print_ids.popitem(last=False)
+
+    def _record_transition(self, job, old_state, new_state, now):
+        logging.info(f"{job.print_id} on {job.printer}: {old_state} -> {new_state}")
+        metrics_handler.print_job_state_transitions.labels(
+            printer=job.printer, state=new_state
+        ).inc()
+        if self.job_store is not None:
+            self.job_store.record_job_state(job.print_id, new_state, now)
+        if self.on_transition is not None:
+            self.on_transition(job.print_id, new_state)
+
+
+class JobEventFollower:
+    """
+    with more than one worker only the leader runs a QueueMonitor.
+    every other worker follows the state changes it records in the job
+    database instead, so their trackers hear about jobs they sent too.
+    events recorded before start() are skipped, the trackers rebuild
+    older jobs from the database when they're asked about them.
+
+    is_leader is checked before every poll. once this worker becomes
+    the leader it gets the changes from its own monitor and stops
+    reading them back.
+    """
+
+    def __init__(self, job_store, on_transition, is_leader, interval_seconds=1):
+        self.job_store = job_store
+        self.on_transition = on_transition
+        self.is_leader = is_leader
+        self.interval_seconds = interval_seconds
+        self.last_event_id = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.last_event_id = self.job_store.get_last_job_event_id()
+        self._thread = threading.Thread(
+            target=self._run, name="job-event-follower", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            if self.is_leader():
+                return
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("unable to read job events")
+
+    def poll(self):
+        for event in self.job_store.get_job_events_after(self.last_event_id):
+            self.on_transition(event["print_id"], event["state"])
+            self.last_event_id = event["id"]
@@ -0,0 +1,213 @@
+import datetime
+import threading
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, period, limit, used, retry_after_seconds):
+        super().__init__(f"{used} of {limit} pages used this {period}")
+        self.period = period
+        self.limit = limit
+        self.used = used
+        self.retry_after_seconds = retry_after_seconds
+
+
+def get_periods(now) -> dict:
+    """
+    returns the day and week that now falls in, i.e.
+    {"day": "2025-01-01", "week": "2025-W01"}
+    """
+    year, week, _ = now.isocalendar()
+    return {"day": now.date().isoformat(), "week": f"{year}-W{week:02d}"}
+
+
+def seconds_until_reset(period, now) -> int:
+    midnight = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time(), now.tzinfo
+    )
+    if period == "week":
+        # weeks start on monday, same as isocalendar
+        midnight += datetime.timedelta(days=6 - now.weekday())
+    return max(1, int((midnight - now).total_seconds()))
+
+
+class QuotaStore:
+    """
+    counts the pages each user prints per day and per week. the
+    counters for the current day and week live in memory so checking a
+    quota never touches the disk. pages counted since the last flush
+    are added to the job database at most every flush_interval_seconds
+    (through the job store's writer thread), and the totals are read
+    back, so a crash loses at most that many seconds of counting and
+    the server's workers see each other's pages within about that long.
+
+    load() reads the current day and week at startup. after that the
+    counters roll over in memory at midnight, and the new periods' totals
+    are read back in the background, so a request never waits on the
+    database.
+
+    a limit of 0 means no limit, pages are still counted.
+    """
+
+    def __init__(self, job_store, daily_pages=0, weekly_pages=0, flush_interval_seconds=5):
+        self.job_store = job_store
+        self.limits = {"day": daily_pages, "week": weekly_pages}
+        self.flush_interval_seconds = flush_interval_seconds
+        self._lock = threading.Lock()
+        # (user id, period key) -> pages, as of the last read from the
+        # database plus what this process has flushed since
+        self._pages = {}
+        # (user id, period key) -> pages counted (or refunded) since the
+        # last flush
+        self._pending = {}
+        self._last_flushed_at = time.monotonic()
+        self._syncing = False
+        self._periods = None
+
+    def load(self, now=None):
+        """
+        reads the pages of the day and week now falls in from the
+        database. blocks, call it before serving requests.
+        """
+        periods = get_periods(now or datetime.datetime.now())
+        rows = self.job_store.get_quota_usage(list(periods.values()))
+        with self._lock:
+            self._pages = {(row["user_id"], row["period"]): row["pages"] for row in rows}
+            self._periods = periods
+
+    def check(self, user_id, pages=1, now=None):
+        """
+        raises QuotaExceeded if the user can't print pages more pages.
+        """
+        with self._lock:
+            self._check(user_id, pages, self._roll_over(now))
+
+    def reserve(self, user_id, pages, now=None):
+        """
+        counts pages against the user, or raises QuotaExceeded without
+        counting anything if that would put them over.
+        """
+        with self._lock:
+            now = self._roll_over(now)
+            self._check(user_id, pages, now)
+            for key in self._periods.values():
+                self._pending[(user_id, key)] = self._pending.get((user_id, key), 0) + pages
+        self._maybe_sync()
+
+    def refund(self, user_id, pages, now=None):
+        """
+        gives back pages that were reserved but never printed.
+        """
+        with self._lock:
+            self._roll_over(now)
+            for key in self._periods.values():
+                refunded = min(pages, self._used(user_id, key))
+                if refunded:
+                    self._pending[(user_id, key)] = self._pending.get((user_id, key), 0) - refunded
+        self._maybe_sync()
+
+    def get_usage(self, user_id, now=None) -> dict:
+        with self._lock:
+            self._roll_over(now)
+            return {
+                period: {
+                    "used": self._used(user_id, key),
+                    "limit": self.limits[period] or None,
+                }
+                for period, key in self._periods.items()
+            }
+
+    def flush(self):
+        """
+        queues the pages counted since the last flush to be added to the
+        database.
+        """
+        with self._lock:
+            self._flush()
+
+    def sync(self):
+        """
+        flushes, waits for the job store to commit it and reads back the
+        totals, which include what other workers have flushed.
+        """
+        try:
+            while True:
+                with self._lock:
+                    self._flush()
+                    periods = self._periods
+                if periods is None:
+                    return
+                self.job_store.flush()
+                rows = self.job_store.get_quota_usage(list(periods.values()))
+                with self._lock:
+                    # after a roll over while the lock was let go, the
+                    # new periods are read instead
+                    if periods == self._periods:
+                        self._pages = {(row["user_id"], row["period"]): row["pages"] for row in rows}
+                        return
+        finally:
+            self._syncing = False
+
+    def _maybe_sync(self):
+        with self._lock:
+            if time.monotonic() - self._last_flushed_at < self.flush_interval_seconds:
+                return
+            self._start_sync()
+
+    def _start_sync(self):
+        # called with the lock held. waiting for the commit would hold up
+        # the request (and the event loop it's on) for a whole job store
+        # batch
+        if self._syncing:
+            return
+        self._syncing = True
+        threading.Thread(target=self.sync, name="quota-sync", daemon=True).start()
+
+    def _flush(self):
+        # changes are written rather than totals, so that workers
+        # counting the same user add up instead of overwriting each other
+        for (user_id, key), pages in self._pending.items():
+            if pages:
+                self.job_store.add_quota_usage(user_id, key, pages)
+                self._pages[(user_id, key)] = self._pages.get((user_id, key), 0) + pages
+        self._pending.clear()
+        self._last_flushed_at = time.monotonic()
+
+    def _used(self, user_id, key) -> int:
+        return max(0, self._pages.get((user_id, key), 0) + self._pending.get((user_id, key), 0))
+
+    def _roll_over(self, now):
+        """
+        makes sure the counters in memory are for the day and week now
+        falls in, starting the new ones from what's in memory and
+        reading other workers' pages in the background.
+        """
+        now = now or datetime.datetime.now()
+        periods = get_periods(now)
+        if periods != self._periods:
+            # the last day's pages are queued for the database before
+            # they're dropped
+            self._flush()
+            # the week usually carries over into the new day
+            keys = set(periods.values())
+            self._pages = {
+                (user_id, key): pages
+                for (user_id, key), pages in self._pages.items()
+                if key in keys
+            }
+            self._periods = periods
+            self._start_sync()
+        return now
+
+    def _check(self, user_id, pages, now):
+        for period, key in self._periods.items():
+            limit = self.limits[period]
+            used = self._used(user_id, key)
+            if limit and used + pages > limit:
+                metrics_handler.print_quota_rejections.labels(period=period).inc()
+                raise QuotaExceeded(period, limit, used, seconds_until_reset(period, now))
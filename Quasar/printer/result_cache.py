@@ -0,0 +1,72 @@
+import asyncio
+import collections
+import time
+
+
+class ResultCache:
+    """
+    remembers the results of recent work by key, so doing the same
+    thing again can reuse the result instead. a repeat that shows up
+    while the original is still running waits on it.
+
+    results are forgotten ttl_seconds after they're finished, and the
+    least recently used ones are dropped once there are more than
+    max_entries. this is only meant to be used from the event loop,
+    it isn't thread safe.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (future, finished at), finished at is None while the
+        # work is still running
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def reserve(self, key):
+        """
+        returns None if nobody has done this work recently, in which
+        case the caller has to do it and then call finish(). otherwise
+        returns a future for the result of whoever did.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            future, finished_at = entry
+            if finished_at is None or time.monotonic() - finished_at < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                return future
+            del self._entries[key]
+
+        self._entries[key] = (asyncio.get_running_loop().create_future(), None)
+        if len(self._entries) > self.max_entries:
+            self._evict()
+        return None
+
+    def finish(self, key, result):
+        """
+        hands the result to everyone waiting on key. None means the
+        work failed, and it isn't remembered so the next try does it
+        over again.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        future, _ = entry
+        if not future.done():
+            future.set_result(result)
+        if result is None:
+            del self._entries[key]
+        else:
+            self._entries[key] = (future, time.monotonic())
+
+    def _evict(self):
+        # work that's still running is skipped, otherwise whoever is
+        # waiting on it would never hear back
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                return
+            _, finished_at = self._entries[key]
+            if finished_at is not None:
+                del self._entries[key]
@@ -0,0 +1,196 @@
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+
+@dataclasses.dataclass
+class Printer:
+    # LEFT or RIGHT, the key under PRINTING in config.json
+    side: str
+    name: str
+    ip: str = None
+    enabled: bool = True
+    # i.e. lpd://192.168.1.2, what cups sends the printer's jobs to
+    lpd_url: str = None
+
+
+def load_printers(config_json_path) -> list:
+    """
+    reads the printers out of config.json. if the file can't be read,
+    falls back to the <SIDE>_PRINTER_NAME environment variables
+    for every enabled printer.
+    """
+    try:
+        config = json.loads(pathlib.Path(config_json_path).read_text())
+        printing = config.get("PRINTING", {})
+        return [
+            Printer(
+                side=side,
+                name=printer["NAME"],
+                ip=printer.get("IP"),
+                enabled=printer.get("ENABLED", False),
+                lpd_url=printer.get("LPD_URL"),
+            )
+            for side, printer in printing.items()
+        ]
+    except (OSError, ValueError):
+        logging.warning(
+            f"unable to read printers from {config_json_path}, using environment variables instead"
+        )
+        printers = []
+        for side in ("LEFT", "RIGHT"):
+            name = os.environ.get(f"{side}_PRINTER_NAME")
+            if name:
+                printers.append(Printer(side=side, name=name))
+        return printers
+
+
+class PrinterRouter:
+    """
+    picks the printer a job should go to. each enabled printer gets an
+    estimated drain time from how many jobs are in its cups queue and
+    how many pages we've sent it that haven't finished yet, and the
+    job goes to whichever would finish it soonest. printers the health
+    monitor says can't print (i.e. an empty tray) don't get jobs.
+    """
+
+    def __init__(
+        self,
+        printers,
+        backend=None,
+        seconds_per_page=2.3,
+        job_overhead_seconds=5,
+        queue_cache_seconds=2,
+        health_monitor=None,
+    ):
+        self.printers = printers
+        # when there's no backend (i.e. in development) we only go
+        # off of the jobs we've routed ourselves
+        self.backend = backend
+        self.seconds_per_page = seconds_per_page
+        self.job_overhead_seconds = job_overhead_seconds
+        self.queue_cache_seconds = queue_cache_seconds
+        # a PrinterHealthMonitor, without one every printer is assumed
+        # to be able to print
+        self.health_monitor = health_monitor
+
+        self._lock = threading.Lock()
+        # printer name -> {print_id: pages}
+        self._pages_in_flight = {printer.name: {} for printer in printers}
+        # printer name -> (fetched at, list of print ids)
+        self._queues = {}
+
+    def _get_queue(self, printer_name) -> list:
+        fetched_at, print_ids = self._queues.get(printer_name, (0, None))
+        if time.monotonic() - fetched_at < self.queue_cache_seconds:
+            return print_ids
+        try:
+            print_ids = [job.print_id for job in self.backend.get_queue(printer_name)]
+        except Exception:
+            logging.exception(f"failed to get print queue for {printer_name}")
+            print_ids = None
+        self._queues[printer_name] = (time.monotonic(), print_ids)
+        return print_ids
+
+    def estimate_drain_seconds(self, printer_name) -> float:
+        pages_in_flight = self._pages_in_flight[printer_name]
+        queue = self._get_queue(printer_name) if self.backend else None
+        if queue is not None:
+            # anything cups no longer lists has finished printing
+            for print_id in list(pages_in_flight):
+                if print_id not in queue:
+                    del pages_in_flight[print_id]
+            # jobs we didn't route, i.e. sent with lp by hand, count
+            # as a single page
+            depth = len(queue)
+            pages = sum(pages_in_flight.values()) + len(set(queue) - set(pages_in_flight))
+        else:
+            depth = len(pages_in_flight)
+            pages = sum(pages_in_flight.values())
+        return depth * self.job_overhead_seconds + pages * self.seconds_per_page
+
+    def rank_printers(self) -> list:
+        """
+        returns the names of printers that can take a job, the one
+        that would drain its queue soonest first. empty if none can.
+        """
+        enabled_printers = [
+            printer for printer in self.printers if printer.enabled and self._can_print(printer)
+        ]
+        if len(enabled_printers) <= 1:
+            # nothing to choose between, so don't bother asking cups
+            # how busy the printer is
+            return [printer.name for printer in enabled_printers]
+
+        estimates = []
+        with self._lock:
+            for printer in enabled_printers:
+                drain_seconds = self.estimate_drain_seconds(printer.name)
+                metrics_handler.printer_estimated_drain_seconds.labels(
+                    printer=printer.name
+                ).set(drain_seconds)
+                estimates.append((drain_seconds, printer.name))
+        return [name for _, name in sorted(estimates)]
+
+    def get_shortest_queue_depth(self) -> int:
+        """
+        returns how many jobs are in the cups queue of the least busy
+        printer that can take a job, or None if it isn't known (i.e. in
+        development, or cups didn't answer).
+        """
+        if self.backend is None:
+            return None
+        depths = []
+        with self._lock:
+            for printer in self.printers:
+                # not _can_print(), nothing is failing over here
+                if not printer.enabled or self._get_problem(printer) is not None:
+                    continue
+                queue = self._get_queue(printer.name)
+                if queue is None:
+                    return None
+                depths.append(len(queue))
+        return min(depths, default=None)
+
+    def _get_problem(self, printer) -> str:
+        """
+        returns why the printer can't print, or None if it can.
+        """
+        if self.health_monitor is None:
+            return None
+        health = self.health_monitor.get_snapshot().get(printer.name)
+        if health is None or health.can_print:
+            return None
+        return health.problems[0]
+
+    def _can_print(self, printer) -> bool:
+        problem = self._get_problem(printer)
+        if problem is None:
+            return True
+        # a job that would have gone here goes somewhere else, or
+        # nowhere if this was the last printer
+        metrics_handler.printer_failovers.labels(printer=printer.name, reason=problem).inc()
+        return False
+
+    def record_job(self, printer_name, print_id, pages):
+        metrics_handler.print_jobs_routed.labels(printer=printer_name).inc()
+        if not print_id:
+            return
+        with self._lock:
+            self._pages_in_flight[printer_name][print_id] = pages
+            # the cached queue doesn't have this job yet, without this
+            # the next estimate would think it already finished
+            self._queues.pop(printer_name, None)
+
+    def record_failover(self, printer_name, reason):
+        logging.warning(f"failing over from {printer_name}: {reason}")
+        metrics_handler.printer_failovers.labels(printer=printer_name, reason=reason).inc()
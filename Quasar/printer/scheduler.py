@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import dataclasses
+import itertools
+import math
+import time
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# upper bound of pages (copies included) -> size label of the
+# print_scheduler_wait_seconds histogram
+SIZE_BUCKETS = ((1, "1"), (5, "2-5"), (20, "6-20"), (100, "21-100"))
+LARGEST_SIZE = "101+"
+# an owner whose recent pages have decayed below this is forgotten
+MIN_RECENT_PAGES = 0.01
+
+
+def get_size_bucket(pages) -> str:
+    for most_pages, label in SIZE_BUCKETS:
+        if pages <= most_pages:
+            return label
+    return LARGEST_SIZE
+
+
+@dataclasses.dataclass
+class PendingJob:
+    job_id: str
+    # who the job counts against for fair share, the user id or the
+    # client's address
+    owner: str
+    # pages times copies
+    pages: int
+    submitted_at: float
+    # ties go to whoever came first
+    sequence: int
+    released: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+
+
+class PrintScheduler:
+    """
+    holds print jobs between /print and cups, so a 200 page thesis
+    doesn't make everyone who comes after it wait. a job is let through
+    once the shortest cups queue of the printers has fewer than
+    max_queue_depth jobs, counting the ones we've let through that
+    haven't been submitted yet. until then jobs wait here, and whichever
+    has the lowest priority() goes next:
+
+    - its pages (times copies), so short jobs go first
+    - plus fair_share_weight times the pages its owner has printed
+      recently, decaying by half every fair_share_half_life_seconds,
+      so one user can't crowd out the rest with lots of short jobs
+    - minus aging_pages_per_minute for every minute it's waited, so a
+      long job still gets its turn
+
+    a job that's waited max_wait_seconds goes to cups whether or not
+    there's room, so a synchronous /print isn't left hanging (holding
+    its admission) behind one long job until the proxy gives up on it.
+
+    get_queue_depth returns the depth of the shortest queue, or None
+    if it isn't known (i.e. in development), which lets everything
+    through. it may block, it's called off the event loop. a
+    max_queue_depth of 0 turns scheduling off, jobs go straight to cups
+    in the order they came in.
+    """
+
+    def __init__(
+        self,
+        get_queue_depth,
+        max_queue_depth=2,
+        aging_pages_per_minute=10,
+        fair_share_weight=0.5,
+        fair_share_half_life_seconds=600,
+        max_wait_seconds=30,
+        poll_interval_seconds=1,
+    ):
+        self.get_queue_depth = get_queue_depth
+        self.max_queue_depth = max_queue_depth
+        self.aging_pages_per_minute = aging_pages_per_minute
+        self.fair_share_weight = fair_share_weight
+        self.fair_share_half_life_seconds = fair_share_half_life_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self._pending = []
+        # let through, not submitted to cups yet
+        self._submitting = 0
+        self._dispatching = False
+        self._sequence = itertools.count()
+        # owner -> (pages, as of monotonic time)
+        self._recent_pages = {}
+
+    @contextlib.asynccontextmanager
+    async def turn(self, job_id, owner, pages):
+        """
+        waits until the job can go to cups. the job should be submitted
+        inside the block, leaving it tells the scheduler it's in the cups
+        queue (or failed).
+        """
+        if self.max_queue_depth <= 0:
+            yield
+            return
+        job = PendingJob(
+            job_id=job_id,
+            owner=owner or "",
+            pages=max(1, pages),
+            submitted_at=time.monotonic(),
+            sequence=next(self._sequence),
+        )
+        self._pending.append(job)
+        metrics_handler.print_scheduler_pending.inc()
+        try:
+            await self._wait(job)
+        except BaseException:
+            if not job.released.is_set():
+                self._pending.remove(job)
+                metrics_handler.print_scheduler_pending.dec()
+                raise
+            # released while being cancelled, the slot still has to be
+            # given back
+            self._submitting -= 1
+            raise
+        try:
+            yield
+        finally:
+            self._submitting -= 1
+
+    def priority(self, job, now) -> float:
+        waited_minutes = (now - job.submitted_at) / 60
+        return (
+            job.pages
+            + self.fair_share_weight * self.get_recent_pages(job.owner, now)
+            - self.aging_pages_per_minute * waited_minutes
+        )
+
+    def get_recent_pages(self, owner, now) -> float:
+        pages, as_of = self._recent_pages.get(owner, (0, now))
+        return pages * math.pow(0.5, (now - as_of) / self.fair_share_half_life_seconds)
+
+    async def _wait(self, job):
+        while not job.released.is_set():
+            if not self._dispatching:
+                self._dispatching = True
+                try:
+                    await self._dispatch()
+                finally:
+                    self._dispatching = False
+                if job.released.is_set():
+                    return
+            # woken early if another waiter's dispatch lets us through.
+            # otherwise the cups queue is full, check it again later
+            try:
+                await asyncio.wait_for(job.released.wait(), self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self):
+        if self.max_wait_seconds:
+            now = time.monotonic()
+            for job in list(self._pending):
+                if now - job.submitted_at >= self.max_wait_seconds:
+                    self._release(job, now)
+        while self._pending:
+            depth = await asyncio.to_thread(self.get_queue_depth)
+            if depth is not None and depth + self._submitting >= self.max_queue_depth:
+                return
+            now = time.monotonic()
+            job = min(self._pending, key=lambda job: (self.priority(job, now), job.sequence))
+            self._release(job, now)
+
+    def _release(self, job, now):
+        self._pending.remove(job)
+        self._submitting += 1
+        for owner in list(self._recent_pages):
+            if self.get_recent_pages(owner, now) < MIN_RECENT_PAGES:
+                del self._recent_pages[owner]
+        self._recent_pages[job.owner] = (self.get_recent_pages(job.owner, now) + job.pages, now)
+        metrics_handler.print_scheduler_pending.dec()
+        metrics_handler.print_scheduler_wait_seconds.labels(
+            size=get_size_bucket(job.pages)
+        ).observe(now - job.submitted_at)
+        job.released.set()
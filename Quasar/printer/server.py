@@ -1,36 +1,95 @@
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import json
 import logging
-import os
 import pathlib
-import subprocess
-import threading
 import time
+import typing
 import uuid
-import sqlite3
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
-import prometheus_client
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
 
-from metrics import MetricsHandler
+from admission import AdmissionController, AdmissionRejected
+import cups_setup
+import ipp
+from job_store import JobStore
+from job_tracker import CUPS_STATES, TERMINAL_STATES, JobTracker
+from leader import LeaderElection
+from metrics import MetricsHandler, prepare_multiprocess_directory
+import normalize
+import pdf
+import printer_backends
+from printer_health import PrinterHealth, PrinterHealthMonitor
+from queue_monitor import JobEventFollower, QueueMonitor
+from quota import QuotaExceeded, QuotaStore
+from result_cache import ResultCache
+import routing
+from scheduler import PrintScheduler
+from spool import SpoolManager
+import ssh_tunnel
 
 
 metrics_handler = MetricsHandler.instance()
-app = FastAPI()
+# startup times are measured from here when what.sh didn't say when
+# the container started
+IMPORTED_AT = time.time()
 
-#conn = sqlite3.connect("placeholder.db")
-#cursor = conn.cursor()
 
-#cursor.execute("""
-#CREATE TABLE IF NOT EXISTS job (
-    #id INTEGER PRIMARY KEY AUTOINCREMENT,
-    #id TEXT,
-    #time TEXT
-#)
-#""")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_event_follower = None
+    if args.workers > 1 and not args.development:
+        # started before the election so that a worker that wins it
+        # later doesn't miss the events from in between
+        job_event_follower = JobEventFollower(
+            job_store,
+            job_tracker.record_cups_state,
+            is_leader=lambda: election.is_leader,
+        )
+        job_event_follower.start()
+    election.start()
+    if not cups_readiness.is_ready:
+        cups_readiness.start()
+    yield
+    # jobs handed off by async requests still get sent to cups
+    await asyncio.gather(*background_print_tasks, return_exceptions=True)
+    if job_event_follower is not None:
+        job_event_follower.stop()
+    cups_readiness.stop()
+    if normalizer is not None:
+        normalizer.close()
+    spool_manager.stop()
+    queue_monitor.stop()
+    if tunnel is not None:
+        tunnel.stop()
+    election.stop()
+    quota_store.flush()
+    job_store.close()
+
+
+def start_background_tasks():
+    """
+    starts what only one worker should be running, called in whichever
+    worker is elected to run them.
+    """
+    if not args.development:
+        queue_monitor.start()
+        if tunnel is not None:
+            tunnel.start()
+    # the spool directory is shared, and sweeping it from two workers
+    # would have them deleting each other's files
+    spool_manager.start()
+
 
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -70,158 +129,1475 @@ def get_args() -> argparse.Namespace:
         default=False,
         help="specify if server should run in development. this means requests won't get sent to a printer but logger instead",
     )
+    parser.add_argument(
+        "--setup-cups",
+        action="store_true",
+        default=False,
+        help="wait for cups to start and add the enabled printers in config.json to it before taking jobs. until then /ready and print requests get a 503. what.sh passes this",
+    )
+    parser.add_argument(
+        "--ppd-path",
+        default="/etc/cups/ppd/HP-LaserJet-p2015dn.ppd",
+        help="driver the printers are added to cups with by --setup-cups. defaults to /etc/cups/ppd/HP-LaserJet-p2015dn.ppd",
+    )
     parser.add_argument(
         "--dont-delete-pdfs",
         action="store_true",
         default=False,
         help="specify if server should delete pdfs after printing",
     )
+    parser.add_argument(
+        "--max-kept-pdfs",
+        type=int,
+        default=100,
+        help="with --dont-delete-pdfs, how many of the newest uploads are kept. older ones are deleted. defaults to 100",
+    )
+    parser.add_argument(
+        "--spool-directory",
+        default="/tmp/spool",
+        help="directory uploads are written to until they're sent to cups. defaults to /tmp/spool",
+    )
+    parser.add_argument(
+        "--spool-max-age-seconds",
+        type=int,
+        default=24 * 60 * 60,
+        help="uploads left in the spool directory longer than this (i.e. after a crash) are deleted. 0 means never. defaults to 86400",
+    )
+    parser.add_argument(
+        "--spool-orphan-grace-seconds",
+        type=int,
+        default=15 * 60,
+        help="an upload in the spool directory that this worker didn't write is only swept once it hasn't changed for this long, with --workers it may be another worker's upload on its way to cups. defaults to 900",
+    )
+    parser.add_argument(
+        "--spool-max-mb",
+        type=int,
+        default=2048,
+        help="past this, the oldest uploads that aren't being printed are deleted from the spool directory. 0 means no limit. defaults to 2048",
+    )
+    parser.add_argument(
+        "--spool-sweep-interval-seconds",
+        type=float,
+        default=60,
+        help="how often the spool directory is checked against the limits above. defaults to 60",
+    )
+    parser.add_argument(
+        "--max-concurrent-print-jobs",
+        type=int,
+        default=4,
+        help="how many lp commands can run at once. requests past this limit wait for a free worker. defaults to 4",
+    )
+    parser.add_argument(
+        "--upload-chunk-size-kb",
+        type=int,
+        default=1024,
+        help="size of each chunk read from an upload while writing it to disk. defaults to 1024",
+    )
+    parser.add_argument(
+        "--max-upload-size-mb",
+        type=int,
+        default=250,
+        help="uploads larger than this are rejected with a 413. defaults to 250",
+    )
+    parser.add_argument(
+        "--job-database-path",
+        default="/app/data/jobs.db",
+        help="path to the sqlite database that records print jobs, quota usage and idempotency keys. docker-compose.yml keeps /app/data on a volume so it survives the container being recreated. defaults to /app/data/jobs.db",
+    )
+    parser.add_argument(
+        "--printer-backend",
+        choices=["lp", "ipp"],
+        default="lp",
+        help="lp forks the cups command line tools for every job. ipp talks to cups directly over pooled connections. defaults to lp",
+    )
+    parser.add_argument(
+        "--seconds-per-page",
+        type=float,
+        default=2.3,
+        help="how long a printer takes per page, used to pick the least busy printer. defaults to 2.3",
+    )
+    parser.add_argument(
+        "--job-overhead-seconds",
+        type=float,
+        default=5,
+        help="how long a printer spends on a job besides printing pages, used to pick the least busy printer. defaults to 5",
+    )
+    parser.add_argument(
+        "--collector-metrics-url",
+        default=None,
+        help="the snmp collector's /metrics url, i.e. http://snmp-collector:5000/metrics. if set, printers that can't print (empty tray, no toner, unreachable) don't get jobs",
+    )
+    parser.add_argument(
+        "--printer-health-ttl-seconds",
+        type=float,
+        default=30,
+        help="how long printer health fetched from the collector is used before it's fetched again. defaults to 30",
+    )
+    parser.add_argument(
+        "--printer-health-stale-after-seconds",
+        type=float,
+        default=600,
+        help="if the collector can't be reached for this long, printers are assumed to be able to print. defaults to 600",
+    )
+    parser.add_argument(
+        "--low-toner-percent",
+        type=float,
+        default=10,
+        help="below this much toner a printer is reported as degraded, it still gets jobs. defaults to 10",
+    )
+    parser.add_argument(
+        "--queue-monitor-min-interval-seconds",
+        type=float,
+        help="how often the print queues are checked while they have jobs in them. with --printer-backend lp every check forks lpstat once per printer, and lpstat can't tell pending from processing anyway. defaults to 1 with --printer-backend ipp, 5 otherwise",
+    )
+    parser.add_argument(
+        "--queue-monitor-max-interval-seconds",
+        type=float,
+        default=60,
+        help="the longest the queue monitor waits between checks once the queues are empty. defaults to 60",
+    )
+    parser.add_argument(
+        "--cups-url",
+        default="http://localhost:631",
+        help="where the ipp printer backend reaches cups. defaults to http://localhost:631",
+    )
+    parser.add_argument(
+        "--dedupe-window-seconds",
+        type=float,
+        default=60,
+        help="an upload identical to one the same user printed this many seconds ago, with the same copies and sides, gets the earlier print id back instead of printing again. uploads without a user_id are always printed. with --workers every worker only remembers its own uploads. 0 turns this off. defaults to 60",
+    )
+    parser.add_argument(
+        "--dedupe-max-entries",
+        type=int,
+        default=1024,
+        help="how many recent uploads are remembered for deduplication. defaults to 1024",
+    )
+    parser.add_argument(
+        "--idempotency-key-ttl-seconds",
+        type=float,
+        default=24 * 60 * 60,
+        help="how long the response to a /print request with an idempotency key is kept for retries. with --workers a retry is only recognized by the worker that printed it, or by any worker with --persist-idempotency-keys once the first request has finished. defaults to 86400",
+    )
+    parser.add_argument(
+        "--idempotency-max-entries",
+        type=int,
+        default=10000,
+        help="how many idempotency keys are kept in memory. defaults to 10000",
+    )
+    parser.add_argument(
+        "--persist-idempotency-keys",
+        action="store_true",
+        default=False,
+        help="also save idempotency keys to the job database, so retries are still recognized after a restart",
+    )
+    parser.add_argument(
+        "--max-batch-files",
+        type=int,
+        default=20,
+        help="the most files a single request to /print/batch can have. defaults to 20",
+    )
+    parser.add_argument(
+        "--max-pages-per-job",
+        type=int,
+        default=300,
+        help="pdfs that would print more pages than this, counting copies, are rejected with a 400. defaults to 300",
+    )
+    parser.add_argument(
+        "--normalize-format",
+        choices=["none", *normalize.FORMATS],
+        default="none",
+        help="convert pdf uploads to pcl or postscript with ghostscript before they're sent to cups, so the printer doesn't have to rasterize them itself. pdfs ghostscript can't read get a 400. defaults to none",
+    )
+    parser.add_argument(
+        "--normalize-workers",
+        type=int,
+        default=2,
+        help="how many conversions can run at once, each in its own process. defaults to 2",
+    )
+    parser.add_argument(
+        "--normalize-cache-directory",
+        default="/tmp/normalized",
+        help="where conversions are kept, so a pdf printed again isn't converted again. defaults to /tmp/normalized",
+    )
+    parser.add_argument(
+        "--normalize-cache-mb",
+        type=int,
+        default=1024,
+        help="past this the least recently used conversions are deleted. defaults to 1024",
+    )
+    parser.add_argument(
+        "--normalize-timeout-seconds",
+        type=float,
+        default=120,
+        help="conversions that take longer than this fail, and so does the print. defaults to 120",
+    )
+    parser.add_argument(
+        "--max-cups-queue-depth",
+        type=int,
+        default=2,
+        help="jobs wait in the server, shortest first, until the least busy printer's cups queue has fewer jobs than this. 0 sends every job to cups as soon as it comes in. defaults to 2",
+    )
+    parser.add_argument(
+        "--scheduler-aging-pages-per-minute",
+        type=float,
+        default=10,
+        help="how many pages shorter a waiting job counts as for every minute it's waited, so long jobs aren't held forever. defaults to 10",
+    )
+    parser.add_argument(
+        "--scheduler-fair-share-weight",
+        type=float,
+        default=0.5,
+        help="how many pages longer a job counts as for every page its user (or client, without a user id) printed recently. defaults to 0.5",
+    )
+    parser.add_argument(
+        "--scheduler-fair-share-half-life-seconds",
+        type=float,
+        default=600,
+        help="how quickly pages a user printed stop counting against their next jobs. defaults to 600",
+    )
+    parser.add_argument(
+        "--scheduler-max-wait-seconds",
+        type=float,
+        default=30,
+        help="a job that's waited this long is sent to cups even if its queue is full, so requests without Prefer: respond-async don't hang. 0 means no limit. defaults to 30",
+    )
+    parser.add_argument(
+        "--daily-page-quota",
+        type=int,
+        default=0,
+        help="how many pages a user (the user_id sent with a print request) can print per day, copies included. 0 means no limit. defaults to 0",
+    )
+    parser.add_argument(
+        "--weekly-page-quota",
+        type=int,
+        default=0,
+        help="how many pages a user can print per week, copies included. 0 means no limit. defaults to 0",
+    )
+    parser.add_argument(
+        "--quota-flush-interval-seconds",
+        type=float,
+        default=5,
+        help="how often page counts are saved to the job database. a crash loses at most this much counting. defaults to 5",
+    )
+    parser.add_argument(
+        "--max-admitted-jobs",
+        type=int,
+        default=32,
+        help="how many print requests can be uploading or waiting to print at once. past this they get a 503. defaults to 32",
+    )
+    parser.add_argument(
+        "--max-admitted-mb",
+        type=int,
+        default=1024,
+        help="how many MB of uploads can be in flight at once, going by Content-Length. past this requests get a 503. defaults to 1024",
+    )
+    parser.add_argument(
+        "--client-requests-per-minute",
+        type=float,
+        default=30,
+        help="how many print requests a single user_id can make per minute once its burst is used up. past this it gets a 429. requests without a user_id aren't limited, they all come from the ssh tunnel's localhost so there's no telling them apart. 0 turns this off. defaults to 30",
+    )
+    parser.add_argument(
+        "--client-burst",
+        type=int,
+        default=10,
+        help="how many print requests a single user_id can make back to back before --client-requests-per-minute kicks in. defaults to 10",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes. with more than one, metrics from all of them are added up in /metrics and only one runs the queue monitor and ssh tunnel watchdog. defaults to 1",
+    )
+    parser.add_argument(
+        "--background-lock-path",
+        default="/tmp/quasar-background.lock",
+        help="lock file the workers use to pick which of them runs the queue monitor and ssh tunnel watchdog. defaults to /tmp/quasar-background.lock",
+    )
+    parser.add_argument(
+        "--prometheus-multiproc-dir",
+        default="/tmp/quasar-metrics",
+        help="with --workers above 1, where the workers keep their metrics. emptied on startup. defaults to /tmp/quasar-metrics",
+    )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--ssh-tunnel-probe-url",
+        help="url requested to check the ssh tunnel works, i.e. http://core-v4:14000/healthcheck/tunnel. defaults to the forwarded port on HEALTH_CHECK.CORE_V4_IP from config.json. an empty string turns probing off, leaving only ssh exiting to go by",
+    )
+    parser.add_argument(
+        "--ssh-tunnel-probe-interval-seconds",
+        type=float,
+        default=15,
+        help="how often the ssh tunnel is probed. defaults to 15",
+    )
+    parser.add_argument(
+        "--ssh-tunnel-max-backoff-seconds",
+        type=float,
+        default=60,
+        help="the longest the ssh tunnel waits between attempts to reopen it. defaults to 60",
+    )
+
+    args = parser.parse_args()
+    if args.queue_monitor_min_interval_seconds is None:
+        args.queue_monitor_min_interval_seconds = 1 if args.printer_backend == "ipp" else 5
+    return args
 
 
 args = get_args()
+MAX_UPLOAD_SIZE_BYTES = args.max_upload_size_mb * 1024 * 1024
+job_store = JobStore(args.job_database_path)
+printer_backend = printer_backends.get_backend(
+    args.printer_backend,
+    cups_url=args.cups_url,
+    pool_size=args.max_concurrent_print_jobs,
+)
+printers = routing.load_printers(args.config_json_path)
+printer_health_monitor = None
+if args.collector_metrics_url:
+    printer_health_monitor = PrinterHealthMonitor(
+        printers,
+        args.collector_metrics_url,
+        ttl_seconds=args.printer_health_ttl_seconds,
+        stale_after_seconds=args.printer_health_stale_after_seconds,
+        low_toner_percent=args.low_toner_percent,
+    )
+printer_router = routing.PrinterRouter(
+    printers,
+    backend=None if args.development else printer_backend,
+    seconds_per_page=args.seconds_per_page,
+    job_overhead_seconds=args.job_overhead_seconds,
+    health_monitor=printer_health_monitor,
+)
+job_tracker = JobTracker()
+election = LeaderElection(args.background_lock_path, start_background_tasks)
+cups_readiness = cups_setup.CupsReadiness(
+    printers,
+    # with more than one worker they'd all be running lpadmin at once
+    should_register=lambda: election.is_leader,
+    ppd_path=args.ppd_path,
+    started_at=cups_setup.get_started_at(IMPORTED_AT),
+)
+if args.development or not args.setup_cups:
+    # nothing to wait for, in development there's no cups and otherwise
+    # it's up to whoever started us to have it running
+    cups_readiness.set_ready()
+queue_monitor = QueueMonitor(
+    [printer.name for printer in printers if printer.enabled],
+    printer_backend,
+    job_store=job_store,
+    min_interval_seconds=args.queue_monitor_min_interval_seconds,
+    max_interval_seconds=args.queue_monitor_max_interval_seconds,
+    on_transition=job_tracker.record_cups_state,
+)
+# the event loop only keeps weak references to tasks, these are the
+# prints of async requests that have already been responded to
+background_print_tasks = set()
+# how often a comment is sent down an idle /jobs/{id}/events stream so
+# proxies don't close it
+SSE_KEEPALIVE_SECONDS = 15
 
+# content hash + options + user id -> print id of recent uploads, so a student
+# double clicking print or retrying after a slow response doesn't
+# print the same thing twice
+recent_prints = ResultCache(
+    max_entries=args.dedupe_max_entries,
+    ttl_seconds=args.dedupe_window_seconds,
+)
 
-def maybe_reopen_ssh_tunnel():
-    """
-    if we havent recieved a health check ping in over 1 min then
-    we rerun the script to open the ssh tunnel.
-    """
-    while 1:
-        time.sleep(60)
-        now_epoch_seconds = int(time.time())
-        last_health_check = metrics_handler.last_health_check_request._value.get()
-        if now_epoch_seconds - last_health_check > 120:
-            metrics_handler.ssh_tunnel_last_opened.set(int(time.time()))
-            logging.warning(
-                f"now_epoch_seconds - last_health_check = {now_epoch_seconds - last_health_check}, reopening SSH tunnel"
-            )
-            subprocess.Popen(
-                "./what.sh --tunnel-only",
-                shell=True,
-                stderr=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL,
-            )
+spool_manager = SpoolManager(
+    args.spool_directory,
+    max_age_seconds=args.spool_max_age_seconds,
+    max_bytes=args.spool_max_mb * 1024 * 1024,
+    keep_files=args.max_kept_pdfs if args.dont_delete_pdfs else 0,
+    sweep_interval_seconds=args.spool_sweep_interval_seconds,
+    orphan_grace_seconds=args.spool_orphan_grace_seconds,
+)
+quota_store = QuotaStore(
+    job_store,
+    daily_pages=args.daily_page_quota,
+    weekly_pages=args.weekly_page_quota,
+    flush_interval_seconds=args.quota_flush_interval_seconds,
+)
+quota_store.load()
 
+# sha256 of an upload -> its page count
+page_counter = pdf.PageCounter()
 
-def send_file_to_printer(
-    file_path: str, num_copies: int, page_range: str = None, sides: str = "one-sided"
-) -> str:
-    maybe_page_range = ""
-    if page_range:
-        # to speciy page ranges, we can do:
-        # `-o page-ranges=<whatever user sent>` OR `-P <whatever user sent>`
-        maybe_page_range = f"-o page-ranges={page_range}"
+normalizer = None
+if args.normalize_format != "none":
+    normalizer = normalize.Normalizer(
+        args.normalize_format,
+        args.normalize_cache_directory,
+        max_cache_bytes=args.normalize_cache_mb * 1024 * 1024,
+        workers=args.normalize_workers,
+        timeout_seconds=args.normalize_timeout_seconds,
+    )
+
+# idempotency key -> response of requests to /print that sent one
+idempotency_keys = ResultCache(
+    max_entries=args.idempotency_max_entries,
+    ttl_seconds=args.idempotency_key_ttl_seconds,
+)
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# what /print/batch accepts, these go into the lp command as is
+SIDES = ("one-sided", "two-sided-long-edge", "two-sided-short-edge")
+MAX_COPIES = 100
+
+admission_controller = AdmissionController(
+    max_jobs=args.max_admitted_jobs,
+    max_bytes=args.max_admitted_mb * 1024 * 1024,
+    client_rate_per_second=args.client_requests_per_minute / 60,
+    client_burst=args.client_burst,
+)
+
+core_v4_ip = ssh_tunnel.load_core_v4_ip(args.config_json_path)
+tunnel = None
+if core_v4_ip is not None:
+    probe_url = args.ssh_tunnel_probe_url
+    if probe_url is None:
+        probe_url = f"http://{core_v4_ip}:{ssh_tunnel.CORE_V4_PORT}/healthcheck/tunnel"
+    tunnel = ssh_tunnel.SshTunnel(
+        ssh_tunnel.get_ssh_command(core_v4_ip, quasar_port=args.port),
+        probe_url=probe_url or None,
+        probe_interval_seconds=args.ssh_tunnel_probe_interval_seconds,
+        max_backoff_seconds=args.ssh_tunnel_max_backoff_seconds,
+    )
+
+# lp can take seconds to spool a large pdf, so it runs on this pool
+# instead of the event loop. otherwise /healthcheck/printer and
+# /metrics would stall behind every print job.
+print_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.max_concurrent_print_jobs,
+    thread_name_prefix="lp",
+)
+
+
+print_scheduler = PrintScheduler(
+    printer_router.get_shortest_queue_depth,
+    max_queue_depth=args.max_cups_queue_depth,
+    aging_pages_per_minute=args.scheduler_aging_pages_per_minute,
+    fair_share_weight=args.scheduler_fair_share_weight,
+    fair_share_half_life_seconds=args.scheduler_fair_share_half_life_seconds,
+    max_wait_seconds=args.scheduler_max_wait_seconds,
+)
 
-    # only the right printer works right now, so we default to it
-    PRINTER_NAME = os.environ.get("RIGHT_PRINTER_NAME")
-    command = f"lp -n {num_copies} {maybe_page_range} -o sides={sides} -o media=na_letter_8.5x11in -d {PRINTER_NAME} {file_path}"
 
-    #command_time = f"lpstat -o {PRINTER_NAME}"
+def send_file_to_printer(
+    file_path: str,
+    num_copies: int,
+    page_range: str = None,
+    sides: str = "one-sided",
+    pages: int = None,
+    printer_names: list = None,
+    raw: bool = False,
+) -> tuple:
+    """
+    sends the file to whichever printer would get through it soonest,
+    moving on to the next one if cups won't take the job. returns the
+    print id and the name of the printer it went to. printer_names, if
+    given, is the order to try the printers in instead. raw files skip
+    cups' filters.
+    """
     metrics_handler.print_jobs_recieved.inc()
+    # when we don't know how long the document is (i.e. it isn't a
+    # pdf), it's weighted as one page per copy
+    estimated_pages = (pages or 1) * num_copies
+
+    if printer_names is None:
+        printer_names = printer_router.rank_printers()
+    if not printer_names:
+        logging.error("no printers are enabled or able to print")
+        return None, None
+
     if args.development:
-        logging.warning(
-            f"server is in development mode, command would've been `{command}`"
+        description = printer_backend.describe(
+            file_path, printer_names[0], num_copies, page_range, sides, raw=raw
         )
-        return None
- 
-    print_job.wait()
+        logging.warning(f"server is in development mode, {description}")
+        printer_router.record_job(printer_names[0], None, estimated_pages)
+        return None, printer_names[0]
 
-    if print_job.returncode != 0:
-        logging.error(
-            f"command returned code {print_job.returncode} stderr: {print_job.stderr.read()} stdout: {print_job.stdout.read()}"
+    for printer_name in printer_names:
+        with metrics_handler.print_submission_seconds.labels(
+            printer=printer_name
+        ).time():
+            print_id = printer_backend.submit(
+                file_path, printer_name, num_copies, page_range, sides, raw=raw
+            )
+        if print_id is not None:
+            printer_router.record_job(printer_name, print_id, estimated_pages)
+            # the monitor may have backed off while the queue was empty
+            queue_monitor.wake()
+            return print_id, printer_name
+        printer_router.record_failover(printer_name, "submit_failed")
+    return None, None
+
+
+async def write_upload_to_disk(file: UploadFile, file_path: str, hasher=None) -> int:
+    """
+    copies the upload to file_path one chunk at a time, so a large pdf
+    never has to fit in memory. returns the number of bytes written.
+    if hasher (i.e. hashlib.sha256()) is given it's updated with every
+    chunk, which saves reading the file back to hash it.
+    """
+    chunk_size = args.upload_chunk_size_kb * 1024
+    bytes_written = 0
+    with open(file_path, "wb") as f:
+        while chunk := await file.read(chunk_size):
+            bytes_written += len(chunk)
+            if bytes_written > MAX_UPLOAD_SIZE_BYTES:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            f.write(chunk)
+    if bytes_written > MAX_UPLOAD_SIZE_BYTES:
+        # clients that don't send a Content-Length get past the
+        # middleware check, so we catch them here instead
+        pathlib.Path(file_path).unlink(missing_ok=True)
+        metrics_handler.print_errors.labels(kind="upload_too_large").inc()
+        raise HTTPException(
+            status_code=413,
+            detail=f"file is larger than {args.max_upload_size_mb} MB",
         )
-        return None
+    return bytes_written
+
+
+def maybe_delete_pdf(file_path):
+    # kept instead if --dont-delete-pdfs is set
+    spool_manager.release(file_path)
+
+
+# registered first so it runs last, after oversized uploads have
+# already been turned away
+@app.middleware("http")
+async def admit_print_requests(request: Request, call_next):
+    if request.method != "POST" or not request.url.path.startswith("/print"):
+        return await call_next(request)
+    content_length = request.headers.get("content-length", "")
+    size_bytes = int(content_length) if content_length.isdigit() else 0
     try:
-        print_id = print_job.stdout.read().strip().split(" ")[3]
-        logging.info(f"extracted print id is {print_id}")
-        #cursor.execute("INSERT INTO job (id, time) VALUES (?, ?)", (print_id, TIMETBD))
-        return print_id
-    except Exception:
-        logging.exception(
-            f"failed to extract print id from stdout: {print_job.stdout.read()}"
+        admission_controller.admit(size_bytes)
+    except AdmissionRejected as e:
+        logging.warning(f"turning away print request: {e.reason}")
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"detail": f"server is busy ({e.reason}), try again later"},
+            headers={"Retry-After": str(e.retry_after_seconds)},
         )
-        # need to find a better value to return when the command exited
-        # with code 0 but the output could not be parsed for a job id.
-        return ''
+    # a request that hands its job off to a background task takes this
+    # with it, and the task releases the admission once it's done
+    request.state.release_admission = functools.partial(
+        admission_controller.release, size_bytes
+    )
+    try:
+        return await call_next(request)
+    finally:
+        if request.state.release_admission is not None:
+            request.state.release_admission()
 
 
-def maybe_delete_pdf(file_path):
-    if args.dont_delete_pdfs:
-        logging.info(
-            f"--dont-delete-pdfs is set, skipping deletion of file {file_path}"
+@app.middleware("http")
+async def reject_large_uploads(request: Request, call_next):
+    # checking Content-Length up front lets us turn away an oversized
+    # upload before its body is read at all
+    content_length = request.headers.get("content-length", "")
+    if (
+        request.url.path.startswith("/print")
+        and content_length.isdigit()
+        and int(content_length) > MAX_UPLOAD_SIZE_BYTES
+    ):
+        metrics_handler.print_errors.labels(kind="upload_too_large").inc()
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"file is larger than {args.max_upload_size_mb} MB"},
         )
-        return
-    #pathlib.Path(file_path).unlink()
+    return await call_next(request)
+
+
+# registered after reject_large_uploads so it wraps it, and rejected
+# uploads show up in the latency and in-flight metrics too
+@app.middleware("http")
+async def track_print_requests(request: Request, call_next):
+    if not request.url.path.startswith("/print"):
+        return await call_next(request)
+    request.state.started_at = time.perf_counter()
+    with metrics_handler.print_requests_in_flight.track_inprogress():
+        with metrics_handler.print_request_seconds.time():
+            return await call_next(request)
+
+
+def get_printer_health() -> dict:
+    """
+    returns the health of every enabled printer by name, see
+    printer_health.PrinterHealth. without --collector-metrics-url
+    there's nothing to go on, so they're all unknown.
+    """
+    snapshot = printer_health_monitor.get_snapshot() if printer_health_monitor else {}
+    return {
+        printer.name: snapshot.get(printer.name, PrinterHealth())
+        for printer in printers
+        if printer.enabled
+    }
 
 
 @app.get("/healthcheck/printer")
 def api():
     metrics_handler.last_health_check_request.set(int(time.time()))
+    health = get_printer_health()
+    if health and not any(printer.can_print for printer in health.values()):
+        problems = "; ".join(
+            f"{name}: {', '.join(printer.problems)}" for name, printer in health.items()
+        )
+        return JSONResponse(status_code=503, content=f"no printer can print, {problems}")
     return "printer is up!"
 
 
+@app.get("/live")
+def live():
+    """
+    answers as long as the server is running, even while it's waiting
+    for cups. for a liveness probe, restarting us won't make cups start
+    any faster.
+    """
+    return "alive"
+
+
+@app.get("/ready")
+def ready():
+    """
+    200 once cups is up and at least one printer is in it, i.e. print
+    requests will work. 503 until then. the body lists any printers cups
+    still isn't accepting jobs for.
+    """
+    if not cups_readiness.is_ready:
+        return JSONResponse(
+            status_code=503,
+            content=f"waiting for {cups_readiness.waiting_for}",
+            headers={"Retry-After": "1"},
+        )
+    if cups_readiness.missing_printers:
+        return f"ready, not accepting jobs for {', '.join(cups_readiness.missing_printers)}"
+    return "ready"
+
+
+@app.get("/healthcheck/tunnel")
+def tunnel_health_check():
+    """
+    what the ssh tunnel probes, through the tunnel.
+    """
+    return "tunnel is up!"
+
+
+@app.get("/healthcheck/printers")
+def get_printers_health():
+    """
+    returns the health snapshot of every enabled printer, i.e.
+    {"HP_P2015_DN": {"status": "down", "problems": ["tray_empty"], ...}}
+    """
+    return {
+        name: {**dataclasses.asdict(health), "can_print": health.can_print}
+        for name, health in get_printer_health().items()
+    }
+
+
 @app.get("/metrics", response_class=PlainTextResponse)
 def metrics():
-    return prometheus_client.generate_latest()
+    return metrics_handler.generate_latest()
+
+
+@app.get("/jobs")
+def get_jobs(since: float = 0, limit: int = 100):
+    """
+    returns jobs recorded at or after `since`, an epoch timestamp in
+    seconds, i.e. /jobs?since=1735718400
+    """
+    return {"jobs": job_store.get_jobs(since=since, limit=limit)}
+
+
+def job_from_store(job_id):
+    """
+    rebuilds a job the tracker doesn't know about, i.e. from before a
+    restart or from another worker, out of the job database. jobs in
+    cups that haven't finished are handed back to the tracker so it
+    follows them from here on.
+    """
+    row = job_store.get_job(job_id)
+    if row is None:
+        return None
+    states = []
+    if row["state"] == "queued":
+        # another worker still has it, there's nothing to follow until
+        # it's gone to cups
+        state = "queued"
+    elif row["print_id"] is None or row["state"] == "failed":
+        state = "failed"
+    else:
+        states = job_store.get_job_states(row["print_id"])
+        state = CUPS_STATES.get(states[-1]["state"], "spooled") if states else "spooled"
+    if state not in TERMINAL_STATES and state != "queued":
+        job_tracker.set_state(
+            job_id, state, print_id=row["print_id"], printer=row["printer"]
+        )
+    return {
+        "job_id": job_id,
+        "state": state,
+        "print_id": row["print_id"],
+        "printer": row["printer"],
+        "pages": row["pages"],
+        "updated_at": states[-1]["time"] if states else row["time"],
+    }
+
+
+@app.get("/quota/{user_id}")
+def get_quota(user_id: str):
+    """
+    returns how many pages the user has printed today and this week,
+    and their limits (null if there's none).
+    """
+    return quota_store.get_usage(user_id)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    returns the state of a job handed out by /print, one of queued,
+    spooled, printing, completed or failed.
+    """
+    job = job_tracker.get(job_id) or job_from_store(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"no job with id {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    """
+    streams the job as a server-sent event every time its state
+    changes, starting with the state it's in now. the stream ends once
+    the job has completed or failed.
+    """
+    if job_tracker.get(job_id) is None and await asyncio.to_thread(job_from_store, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"no job with id {job_id}")
+    return StreamingResponse(
+        stream_job_events(job_id), media_type="text/event-stream"
+    )
+
+
+async def stream_job_events(job_id):
+    # subscribe before reading the current state so no change can slip
+    # in between the two
+    queue = job_tracker.subscribe(job_id)
+    try:
+        job = job_tracker.get(job_id) or await asyncio.to_thread(job_from_store, job_id)
+        yield f"event: state\ndata: {json.dumps(job)}\n\n"
+        while job["state"] not in TERMINAL_STATES:
+            try:
+                job = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if job["state"] == "queued" and job_tracker.get(job_id) is None:
+                    # another worker's job, which we only hear about
+                    # through the job database. once it's in cups the
+                    # tracker follows it and the queue gets the update
+                    job = await asyncio.to_thread(job_from_store, job_id) or job
+                    if job["state"] in TERMINAL_STATES:
+                        yield f"event: state\ndata: {json.dumps(job)}\n\n"
+                        continue
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: state\ndata: {json.dumps(job)}\n\n"
+    finally:
+        job_tracker.unsubscribe(job_id, queue)
+
+
+async def wait_for_earlier_result(cache: ResultCache, key: str):
+    """
+    returns the result of an earlier request with the same key, waiting
+    on it if it's still running. returns None once the caller holds key
+    in the cache and has to do the work (and call cache.finish) itself.
+    """
+    while (earlier := cache.reserve(key)) is not None:
+        result = await earlier
+        if result is not None:
+            return result
+        # the earlier request failed. whoever loops around first takes
+        # over the key and everyone else waits on them instead
+    return None
 
 
 @app.post("/print")
 async def read_item(
-    file: UploadFile = File(...), copies: str = Form(...), sides: str = Form(...)
+    request: Request,
+    file: UploadFile = File(...),
+    copies: str = Form(...),
+    sides: str = Form(...),
+    idempotency_key: str = Form(None),
+    user_id: str = Form(None),
 ):
     """
     incoming request to print looks like
     {
       "file": file data
-      "copies": integer or whatever, we insert this into the lp command,
-      "sides": string value from user input on clark frontend; we insert this into the lp command,
+      "copies": integer from 1 to 100,
+      "sides": one-sided, two-sided-long-edge or two-sided-short-edge,
+      "idempotency_key": optional, can also be sent as the Idempotency-Key header. a retry with the same key gets the first request's response instead of printing again,
+      "user_id": optional, who's printing. their pages count toward --daily-page-quota and --weekly-page-quota,
     }
+    the response is {"print_id": ...} once the job is in cups. if the
+    request has a `Prefer: respond-async` header it instead comes back
+    as soon as the file is on disk, as
+    {"job_id": ..., "status_url": "/jobs/<job_id>", "events_url": "/jobs/<job_id>/events"}
+    """
+    # by the time we get here the whole multipart body has been read
+    metrics_handler.print_upload_receive_seconds.observe(
+        time.perf_counter() - request.state.started_at
+    )
+    copies, sides, _ = validate_print_options(copies, sides, "")
+    return await respond_idempotently(
+        request.headers.get("idempotency-key") or idempotency_key,
+        functools.partial(print_upload, request, file, copies, sides, user_id),
+    )
+
+
+@app.post("/print/batch")
+async def print_batch(
+    request: Request,
+    files: typing.List[UploadFile] = File(...),
+    copies: typing.List[str] = Form(...),
+    sides: typing.List[str] = Form(...),
+    page_range: typing.List[str] = Form(None),
+    idempotency_key: str = Form(None),
+    user_id: str = Form(None),
+):
     """
+    prints several files in one request, i.e. a club's handouts. every
+    field but idempotency_key is repeated once per file, in the same
+    order as the files
+    {
+      "files": file data,
+      "copies": integer,
+      "sides": one-sided, two-sided-long-edge or two-sided-short-edge,
+      "page_range": optional, i.e. "1-3,5". leave it empty to print every page,
+      "idempotency_key": optional, same as /print,
+      "user_id": optional, same as /print,
+    }
+    the files all go to the same printer one after the other, so they
+    come out together. the response is {"print_ids": [...]} in the same
+    order as the files, with null for any that failed. with a
+    `Prefer: respond-async` header it's {"job_ids": [...]} instead.
+    """
+    metrics_handler.print_upload_receive_seconds.observe(
+        time.perf_counter() - request.state.started_at
+    )
+    if len(files) > args.max_batch_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"a batch can't have more than {args.max_batch_files} files",
+        )
+    page_range = page_range or [""] * len(files)
+    if not len(files) == len(copies) == len(sides) == len(page_range):
+        raise HTTPException(
+            status_code=400,
+            detail="copies, sides and page_range need one value per file",
+        )
+    options = [
+        validate_print_options(*file_options)
+        for file_options in zip(copies, sides, page_range)
+    ]
+    return await respond_idempotently(
+        request.headers.get("idempotency-key") or idempotency_key,
+        functools.partial(print_uploads, request, files, options, user_id),
+    )
+
+
+def validate_print_options(copies: str, sides: str, page_range: str) -> tuple:
+    """
+    checks options that end up in the lp command, raising a 400 if
+    they don't look right. returns them cleaned up, with the page range
+    as None if every page should be printed.
+    """
+    if not copies.isdigit() or not 1 <= int(copies) <= MAX_COPIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"copies has to be a number from 1 to {MAX_COPIES}",
+        )
+    if sides not in SIDES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"sides has to be one of {', '.join(SIDES)}",
+        )
+    if not page_range.strip():
+        return int(copies), sides, None
     try:
-        base = pathlib.Path("/tmp")
-        file_id = str(uuid.uuid4())
-        file_path = str(base / file_id)
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-        print_id = send_file_to_printer(
-            str(file_path),
-            copies,
+        ranges = ipp.parse_page_ranges(page_range)
+    except ValueError:
+        ranges = None
+    if not ranges or any(first < 1 or last < first for first, last in ranges):
+        raise HTTPException(
+            status_code=400,
+            detail=f"page range {page_range} should look like 1-3,5",
+        )
+    # rebuilt from the parsed numbers so nothing else makes it into
+    # the lp command
+    return int(copies), sides, ",".join(f"{first}-{last}" for first, last in ranges)
+
+
+async def respond_idempotently(idempotency_key, respond):
+    """
+    awaits respond() for the response to a print request, unless a
+    request with the same idempotency key already got one.
+    """
+    if not idempotency_key:
+        return await respond()
+    if len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"idempotency key can't be longer than {MAX_IDEMPOTENCY_KEY_LENGTH} characters",
+        )
+
+    response = await wait_for_earlier_result(idempotency_keys, idempotency_key)
+    if response is None and args.persist_idempotency_keys:
+        # the key may be from before a restart
+        response = await asyncio.to_thread(
+            job_store.get_idempotency_key,
+            idempotency_key,
+            since=time.time() - args.idempotency_key_ttl_seconds,
+        )
+        if response is not None:
+            idempotency_keys.finish(idempotency_key, response)
+    if response is not None:
+        logging.info(f"idempotency key {idempotency_key} was seen before, returning its response")
+        metrics_handler.print_idempotent_replays.inc()
+        return response
+
+    try:
+        response = await respond()
+    finally:
+        # failures return an HTTPException, those aren't remembered so
+        # a retry gets to try again
+        result = response if isinstance(response, dict) else None
+        idempotency_keys.finish(idempotency_key, result)
+        if result is not None and args.persist_idempotency_keys:
+            job_store.record_idempotency_key(idempotency_key, result)
+            job_store.expire_idempotency_keys(
+                before=time.time() - args.idempotency_key_ttl_seconds
+            )
+    return response
+
+
+async def save_upload(file: UploadFile) -> tuple:
+    """
+    writes the upload to a new file in the spool directory and returns
+    its file id, which doubles as the job id, its path and its sha256
+    hex digest.
+    """
+    file_id = str(uuid.uuid4())
+    job_tracker.set_state(file_id, "queued")
+    file_path = spool_manager.new_file(file_id)
+    hasher = hashlib.sha256()
+    try:
+        with metrics_handler.print_disk_write_seconds.time():
+            bytes_written = await write_upload_to_disk(file, file_path, hasher)
+    except Exception:
+        job_tracker.set_state(file_id, "failed")
+        spool_manager.discard(file_path)
+        raise
+    spool_manager.finish_writing(file_path, bytes_written)
+    metrics_handler.print_bytes_received.inc(bytes_written)
+    return file_id, file_path, hasher.hexdigest()
+
+
+async def preflight(file_id, file_path, digest, copies, page_range=None):
+    """
+    returns how many pages of the upload will print, not counting
+    copies, or None if we can't tell (i.e. it isn't a pdf). raises a
+    400 if it's a pdf we can't count the pages of, the page range runs
+    past the end of the document or the job would print more than
+    --max-pages-per-job pages.
+    """
+    try:
+        with metrics_handler.pdf_preflight_seconds.time():
+            page_count = await asyncio.to_thread(page_counter.count_pages, file_path, digest)
+    except pdf.PdfError as e:
+        reject_upload(file_id, file_path, f"unable to count the pages of the pdf: {e}")
+    if page_count is None:
+        return None
+
+    pages = page_count
+    if page_range:
+        ranges = ipp.parse_page_ranges(page_range)
+        if any(last > page_count for _, last in ranges):
+            reject_upload(
+                file_id,
+                file_path,
+                f"page range {page_range} goes past the end of the {page_count} page document",
+            )
+        pages = len({page for first, last in ranges for page in range(first, last + 1)})
+    total_pages = pages * copies
+    if total_pages > args.max_pages_per_job:
+        reject_upload(
+            file_id,
+            file_path,
+            f"job would print {total_pages} pages, the limit is {args.max_pages_per_job}",
+        )
+    return pages
+
+
+async def normalize_upload(file_id, file_path, digest, page_range=None, sides="one-sided"):
+    """
+    with --normalize-format, converts a pdf upload to what the printer
+    takes and returns the path of the conversion, or None if there's
+    nothing to convert. raises a 400 if the pdf is too broken to convert,
+    it would only have gotten stuck in cups.
+    """
+    if normalizer is None or not await asyncio.to_thread(pdf.is_pdf, file_path):
+        return None
+    try:
+        return await normalizer.normalize(file_path, digest, page_range, sides)
+    except normalize.ConversionError as e:
+        reject_upload(file_id, file_path, f"unable to read the pdf, {e}", kind="normalize_failed")
+
+
+def reject_upload(file_id, file_path, detail, status_code=400, headers=None, kind="preflight_rejected"):
+    logging.warning(f"rejecting {file_id}: {detail}")
+    metrics_handler.print_errors.labels(kind=kind).inc()
+    job_tracker.set_state(file_id, "failed")
+    maybe_delete_pdf(file_path)
+    raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+
+def get_dedupe_key(user_id, digest, copies, sides, page_range=None) -> str:
+    """
+    returns what an upload is deduplicated by, or None if it shouldn't
+    be. every request comes through the ssh tunnel from localhost, so
+    only the user id tells two students printing the same handout apart.
+    """
+    if not user_id:
+        return None
+    return f"{digest}:{copies}:{sides}:{page_range}:{user_id}"
+
+
+def quota_exceeded(user_id, e: QuotaExceeded) -> HTTPException:
+    logging.warning(f"{user_id} is over their quota: {e}")
+    return HTTPException(
+        status_code=429,
+        detail=f"print quota exceeded, {e}",
+        headers={"Retry-After": str(e.retry_after_seconds)},
+    )
+
+
+async def check_printers_can_print():
+    """
+    turns a print request away with a 503 if cups isn't up yet or every
+    printer is down, rather than leaving the job to pile up in cups.
+    """
+    if not cups_readiness.is_ready:
+        metrics_handler.print_errors.labels(kind="not_ready").inc()
+        raise HTTPException(
+            status_code=503,
+            detail=f"server is starting up, waiting for {cups_readiness.waiting_for}",
+            headers={"Retry-After": "1"},
+        )
+    health = await asyncio.to_thread(get_printer_health)
+    if not health or any(printer.can_print for printer in health.values()):
+        return
+    metrics_handler.print_errors.labels(kind="no_printer_can_print").inc()
+    problems = sorted({problem for printer in health.values() for problem in printer.problems})
+    raise HTTPException(
+        status_code=503,
+        detail=f"no printer can print right now ({', '.join(problems)})",
+        headers={"Retry-After": str(int(args.printer_health_ttl_seconds))},
+    )
+
+
+def check_rate_limit(user_id):
+    """
+    turns away a user who's sending print requests faster than
+    --client-requests-per-minute, before their upload is written to disk.
+    """
+    if not user_id:
+        return
+    try:
+        admission_controller.take_token(user_id)
+    except AdmissionRejected as e:
+        logging.warning(f"turning away print request from {user_id}: {e.reason}")
+        raise HTTPException(
+            status_code=e.status_code,
+            detail="too many print requests, try again later",
+            headers={"Retry-After": str(e.retry_after_seconds)},
+        )
+
+
+def check_quota(user_id):
+    """
+    turns away a user who's already used up their quota, before their
+    upload is written to disk.
+    """
+    if not user_id:
+        return
+    try:
+        quota_store.check(user_id)
+    except QuotaExceeded as e:
+        metrics_handler.print_errors.labels(kind="quota_exceeded").inc()
+        raise quota_exceeded(user_id, e)
+
+
+def reserve_quota(user_id, saved_files, pages):
+    """
+    counts the pages of the saved files against the user's quota, all
+    or nothing. if they don't fit, the files are rejected.
+    """
+    if not user_id:
+        return
+    try:
+        quota_store.reserve(user_id, sum(pages))
+    except QuotaExceeded as e:
+        error = quota_exceeded(user_id, e)
+        for file_id, file_path, _ in saved_files[1:]:
+            job_tracker.set_state(file_id, "failed")
+            maybe_delete_pdf(file_path)
+        file_id, file_path, _ = saved_files[0]
+        reject_upload(
+            file_id, file_path, error.detail, 429, error.headers, kind="quota_exceeded"
+        )
+
+
+def wants_async_response(request: Request) -> bool:
+    return "respond-async" in request.headers.get("prefer", "")
+
+
+def print_in_background(request: Request, print_files):
+    """
+    awaits print_files() in a task that outlives the request. the
+    request's admission is handed to the task, so the job still counts
+    toward the limits until it's been sent to cups.
+    """
+    release_admission = getattr(request.state, "release_admission", None)
+    request.state.release_admission = None
+
+    async def run():
+        try:
+            await print_files()
+        finally:
+            if release_admission is not None:
+                release_admission()
+
+    task = asyncio.create_task(run())
+    background_print_tasks.add(task)
+    task.add_done_callback(background_print_tasks.discard)
+
+
+def job_handle(job_id) -> dict:
+    return {
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/jobs/{job_id}/events",
+    }
+
+
+async def print_upload(
+    request: Request, file: UploadFile, copies: int, sides: str, user_id: str = None
+):
+    """
+    writes the upload to disk and sends it to a printer, returning the
+    response for /print.
+    """
+    await check_printers_can_print()
+    check_rate_limit(user_id)
+    check_quota(user_id)
+    try:
+        file_id, file_path, digest = await save_upload(file)
+    except HTTPException:
+        raise
+    except Exception:
+        logging.exception("printing failed!")
+        metrics_handler.print_errors.labels(kind="write_failed").inc()
+        return HTTPException(
+            status_code=500,
+            detail="printing failed, check logs",
+        )
+
+    pages = await preflight(file_id, file_path, digest, copies)
+    normalized_path = await normalize_upload(file_id, file_path, digest, sides=sides)
+    # anything we couldn't count the pages of counts as one page
+    quota_pages = (pages or 1) * copies
+    try:
+        reserve_quota(user_id, [(file_id, file_path, digest)], [quota_pages])
+    except HTTPException:
+        release_normalized([normalized_path])
+        raise
+    client = request.client.host if request.client else None
+    # so every worker can answer /jobs/{job_id} while it waits
+    job_store.record_job(
+        print_id=None,
+        file_id=file_id,
+        copies=copies,
+        sides=sides,
+        pages=pages,
+        client=client,
+        user_id=user_id,
+        state="queued",
+    )
+    print_file = functools.partial(
+        print_saved_file,
+        file_id,
+        file_path,
+        get_dedupe_key(user_id, digest, copies, sides),
+        copies,
+        sides,
+        client,
+        pages=pages,
+        user_id=user_id,
+        quota_pages=quota_pages,
+        normalized_path=normalized_path,
+    )
+    if not wants_async_response(request):
+        return await print_file()
+    print_in_background(request, print_file)
+    return job_handle(file_id)
+
+
+async def print_uploads(request: Request, files: list, options: list, user_id: str = None):
+    """
+    writes every file of a batch to disk, then sends them one after
+    the other to the same printer. returns the response for
+    /print/batch.
+    """
+    await check_printers_can_print()
+    check_rate_limit(user_id)
+    check_quota(user_id)
+    saved_files = []
+    try:
+        for file in files:
+            saved_files.append(await save_upload(file))
+    except HTTPException:
+        raise
+    except Exception:
+        logging.exception("printing batch failed!")
+        metrics_handler.print_errors.labels(kind="write_failed").inc()
+        return HTTPException(
+            status_code=500,
+            detail="printing failed, check logs",
+        )
+
+    normalized_paths = []
+    try:
+        pages = [
+            await preflight(file_id, file_path, digest, copies, page_range)
+            for (file_id, file_path, digest), (copies, _, page_range) in zip(
+                saved_files, options
+            )
+        ]
+        for (file_id, file_path, digest), (_, sides, page_range) in zip(saved_files, options):
+            normalized_paths.append(
+                await normalize_upload(file_id, file_path, digest, page_range, sides)
+            )
+    except HTTPException:
+        # one bad file fails the whole batch, nothing's been printed yet
+        release_normalized(normalized_paths)
+        for file_id, file_path, _ in saved_files:
+            job_tracker.set_state(file_id, "failed")
+            maybe_delete_pdf(file_path)
+        raise
+    quota_pages = [
+        (file_pages or 1) * copies
+        for file_pages, (copies, _, _) in zip(pages, options)
+    ]
+    try:
+        reserve_quota(user_id, saved_files, quota_pages)
+    except HTTPException:
+        release_normalized(normalized_paths)
+        raise
+    client = request.client.host if request.client else None
+    for (file_id, _, _), (copies, sides, page_range), file_pages in zip(saved_files, options, pages):
+        job_store.record_job(
+            print_id=None,
+            file_id=file_id,
+            copies=copies,
             sides=sides,
+            page_range=page_range,
+            pages=file_pages,
+            client=client,
+            user_id=user_id,
+            state="queued",
+        )
+
+    async def print_files():
+        print_ids = []
+        # print_saved_file releases the conversions of the files it's
+        # been handed, the rest are released here if we never get to them
+        handed_over = 0
+        try:
+            # the batch waits for one turn as a whole, so nobody else's
+            # job ends up between its files
+            async with print_scheduler.turn(saved_files[0][0], user_id or client, sum(quota_pages)):
+                # ranked once for the whole batch, so every file goes to
+                # the same printer unless it refuses one
+                loop = asyncio.get_running_loop()
+                printer_names = await loop.run_in_executor(
+                    print_executor, printer_router.rank_printers
+                )
+                for (
+                    (file_id, file_path, digest),
+                    (copies, sides, page_range),
+                    file_pages,
+                    file_quota_pages,
+                    normalized_path,
+                ) in zip(saved_files, options, pages, quota_pages, normalized_paths):
+                    handed_over += 1
+                    response = await print_saved_file(
+                        file_id,
+                        file_path,
+                        get_dedupe_key(user_id, digest, copies, sides, page_range),
+                        copies,
+                        sides,
+                        client,
+                        page_range=page_range,
+                        printer_names=printer_names,
+                        pages=file_pages,
+                        user_id=user_id,
+                        quota_pages=file_quota_pages,
+                        normalized_path=normalized_path,
+                        has_turn=True,
+                    )
+                    print_ids.append(response.get("print_id") if isinstance(response, dict) else None)
+        finally:
+            release_normalized(normalized_paths[handed_over:])
+        return print_ids
+
+    if wants_async_response(request):
+        print_in_background(request, print_files)
+        return {"job_ids": [file_id for file_id, _, _ in saved_files]}
+    print_ids = await print_files()
+    if not args.development and not any(print_ids):
+        return HTTPException(
+            status_code=500,
+            detail="printing failed, check logs",
+        )
+    return {"print_ids": print_ids}
+
+
+async def print_saved_file(
+    file_id,
+    file_path,
+    dedupe_key,
+    copies,
+    sides,
+    client,
+    page_range=None,
+    printer_names=None,
+    pages=None,
+    user_id=None,
+    quota_pages=0,
+    normalized_path=None,
+    has_turn=False,
+):
+    """
+    sends a saved upload to cups once the scheduler lets it through,
+    unless has_turn says the caller (i.e. a batch) already waited for
+    one.
+    """
+    print_id = None
+    dedupe_key_owned = False
+    try:
+        if args.dedupe_window_seconds > 0 and dedupe_key is not None:
+            earlier_print_id = await wait_for_earlier_result(recent_prints, dedupe_key)
+            if earlier_print_id is not None:
+                logging.info(f"{file_id} is a duplicate of {earlier_print_id}, not printing it again")
+                metrics_handler.print_duplicates_skipped.inc()
+                maybe_delete_pdf(file_path)
+                # the duplicate follows the state of the job it duplicates
+                job_tracker.set_state(
+                    file_id,
+                    job_tracker.get_state_of_print(earlier_print_id) or "spooled",
+                    print_id=earlier_print_id,
+                )
+                job_store.record_job_sent(file_id, earlier_print_id)
+                if user_id:
+                    quota_store.refund(user_id, quota_pages)
+                return {"print_id": earlier_print_id}
+            dedupe_key_owned = True
+
+        print_path, print_page_range, raw = str(file_path), page_range, False
+        if normalized_path is not None:
+            # the page range (and with pcl, sides) is in the conversion
+            print_path, print_page_range, raw = str(normalized_path), None, normalizer.is_raw
+        loop = asyncio.get_running_loop()
+        # short jobs go ahead of long ones, see PrintScheduler
+        turn = (
+            contextlib.nullcontext()
+            if has_turn
+            else print_scheduler.turn(file_id, user_id or client, quota_pages)
         )
+        async with turn:
+            print_id, printer_name = await loop.run_in_executor(
+                print_executor,
+                functools.partial(
+                    send_file_to_printer,
+                    print_path,
+                    copies,
+                    page_range=print_page_range,
+                    sides=sides,
+                    pages=pages,
+                    printer_names=printer_names,
+                    raw=raw,
+                ),
+            )
+        job_store.record_job_sent(file_id, print_id, printer=printer_name)
 
         maybe_delete_pdf(file_path)
 
         if not args.development and print_id is None:
             raise Exception("unable to extract print id from print request")
+        # in development nothing was sent anywhere, so there's nothing
+        # left to wait on
+        if print_id and pages is not None:
+            metrics_handler.print_pages_submitted.labels(printer=printer_name).inc(
+                pages * copies
+            )
+        job_tracker.set_state(
+            file_id,
+            "completed" if args.development else "spooled",
+            print_id=print_id,
+            printer=printer_name,
+            pages=pages,
+        )
         return {"print_id": print_id}
     except Exception:
         logging.exception("printing failed!")
+        metrics_handler.print_errors.labels(kind="print_failed").inc()
+        job_tracker.set_state(file_id, "failed")
+        job_store.record_job_failed(file_id)
+        maybe_delete_pdf(file_path)
+        if user_id:
+            # nothing was printed, so it doesn't count
+            quota_store.refund(user_id, quota_pages)
         return HTTPException(
             status_code=500,
             detail="printing failed, check logs",
         )
+    finally:
+        # anyone waiting on this upload hears back even if we failed
+        if dedupe_key_owned:
+            recent_prints.finish(dedupe_key, print_id)
+        release_normalized([normalized_path])
 
 
-# we have a separate __name__ check here due to how FastAPI starts
-# a server. the file is first ran (where __name__ == "__main__")
-# and then calls `uvicorn.run`. the call to run() reruns the file,
-# this time __name__ == "server". the separate __name__ if statement
-# is so the thread references the same instance as the global
-# metrics_handler referenced by the rest of the file. otherwise,
-# the thread interacts with an instance different than the one the
-# server uses
-if __name__ == "server":
-    if not args.development:
-        # set the last time we opened an ssh tunnel to now because
-        # when the script runs for the first time, we did so in what.sh
-        metrics_handler.ssh_tunnel_last_opened.set(int(time.time()))
-        t = threading.Thread(
-            target=maybe_reopen_ssh_tunnel,
-            daemon=True,
-        )
-        t.start()
+def release_normalized(normalized_paths):
+    """
+    lets the normalizer evict conversions once their jobs have gone to
+    cups, or won't.
+    """
+    for normalized_path in normalized_paths:
+        if normalized_path is not None:
+            normalizer.release(normalized_path)
+
 
 if __name__ == "__main__":
-    uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
+    if args.workers > 1:
+        # uvicorn's workers are started with this environment, so they
+        # all write their metrics to the same place
+        prepare_multiprocess_directory(args.prometheus_multiproc_dir)
+        uvicorn.run("server:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run("server:app", host=args.host, port=args.port, reload=args.development)
@@ -0,0 +1,250 @@
+import collections
+import dataclasses
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# a file that's being written or hasn't been sent to cups yet
+IN_USE = "in_use"
+# a file --dont-delete-pdfs is holding on to
+KEPT = "kept"
+# a file found in the directory that we don't know about, i.e. left
+# behind by a crash or kept by another worker
+ORPHANED = "orphaned"
+STATES = (IN_USE, KEPT, ORPHANED)
+
+
+@dataclasses.dataclass
+class SpoolFile:
+    size_bytes: int
+    created_at: float
+    state: str
+
+
+def is_spool_file_name(name) -> bool:
+    # uploads are named after their uuid, anything else in the
+    # directory isn't ours to delete
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+class SpoolManager:
+    """
+    owns the directory uploads are written to before they're sent to
+    cups. cups copies a job into its own spool when lp accepts it, so
+    an upload is deleted as soon as release() is called.
+
+    with keep_files set (--dont-delete-pdfs), released uploads are kept
+    instead, but only the newest keep_files of them.
+
+    a background thread sweeps the directory every
+    sweep_interval_seconds. files not in use are deleted once they're
+    older than max_age_seconds, and the oldest of them are deleted
+    while the directory holds more than max_bytes. a limit of 0 turns
+    it off.
+
+    with --workers only the leader sweeps, and the other workers'
+    uploads look like orphans to it. so a file we didn't write is only
+    taken as an orphan once it hasn't been modified for
+    orphan_grace_seconds, longer than an upload takes to get to cups.
+    orphans that are gone from the directory (their worker deleted
+    them) stop counting on the next sweep.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_age_seconds=24 * 60 * 60,
+        max_bytes=0,
+        keep_files=0,
+        sweep_interval_seconds=60,
+        orphan_grace_seconds=15 * 60,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.keep_files = keep_files
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.orphan_grace_seconds = orphan_grace_seconds
+        self._lock = threading.Lock()
+        # path -> SpoolFile, oldest first
+        self._files = collections.OrderedDict()
+        # paths of kept files, oldest first
+        self._kept = collections.deque()
+        # running totals of _files, so the metrics don't have to walk it
+        self._total_bytes = 0
+        self._counts = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def new_file(self, file_id) -> str:
+        """
+        returns the path to write the upload with the given id to. the
+        file won't be swept until it's released.
+        """
+        file_path = str(self.directory / file_id)
+        with self._lock:
+            self._track(file_path, SpoolFile(0, time.time(), IN_USE))
+            self._update_metrics()
+        return file_path
+
+    def finish_writing(self, file_path, size_bytes):
+        with self._lock:
+            spool_file = self._files.get(file_path)
+            if spool_file is not None:
+                self._total_bytes += size_bytes - spool_file.size_bytes
+                spool_file.size_bytes = size_bytes
+                self._update_metrics()
+
+    def release(self, file_path):
+        """
+        called once the upload isn't needed anymore, either because
+        cups accepted it or because it was rejected. releasing a file
+        twice does nothing.
+        """
+        with self._lock:
+            spool_file = self._files.get(file_path)
+            if spool_file is None or spool_file.state != IN_USE:
+                return
+            if not self.keep_files:
+                self._delete(file_path)
+                self._update_metrics()
+                return
+            logging.info(f"--dont-delete-pdfs is set, keeping {file_path}")
+            self._counts[IN_USE] -= 1
+            self._counts[KEPT] += 1
+            spool_file.state = KEPT
+            self._kept.append(file_path)
+            while len(self._kept) > self.keep_files:
+                self._delete(self._kept.popleft(), reason="keep_limit")
+            self._update_metrics()
+
+    def discard(self, file_path):
+        """
+        deletes whatever was written of an upload that failed to save.
+        it's never kept, there's nothing there worth debugging.
+        """
+        with self._lock:
+            if file_path not in self._files:
+                return
+            self._untrack(file_path)
+            self._update_metrics()
+        if os.path.exists(file_path):
+            pathlib.Path(file_path).unlink(missing_ok=True)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="spool-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception(f"unable to sweep {self.directory}")
+            self._stop_event.wait(self.sweep_interval_seconds)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        orphans = []
+        present_paths = set()
+        with self._lock:
+            known_paths = set(self._files)
+        for entry in os.scandir(self.directory):
+            if not is_spool_file_name(entry.name):
+                continue
+            present_paths.add(entry.path)
+            if entry.path in known_paths:
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > now - self.orphan_grace_seconds:
+                # maybe another worker's upload that's on its way to cups
+                continue
+            orphans.append((stat.st_mtime, entry.path, stat.st_size))
+
+        with self._lock:
+            for file_path, spool_file in list(self._files.items()):
+                if spool_file.state == ORPHANED and file_path not in present_paths:
+                    self._untrack(file_path)
+            for created_at, file_path, size_bytes in orphans:
+                if file_path not in self._files:
+                    self._track(file_path, SpoolFile(size_bytes, created_at, ORPHANED))
+            if orphans:
+                logging.info(f"found {len(orphans)} uploads we didn't write in {self.directory}")
+                # orphans are usually older than anything we wrote, this
+                # puts them in the order they're swept in
+                self._files = collections.OrderedDict(
+                    sorted(self._files.items(), key=lambda item: item[1].created_at)
+                )
+
+            if self.max_age_seconds:
+                for file_path, spool_file in list(self._files.items()):
+                    if spool_file.created_at > now - self.max_age_seconds:
+                        break
+                    if spool_file.state != IN_USE:
+                        self._delete(file_path, reason="max_age")
+
+            if self.max_bytes:
+                total_bytes = self._total_bytes
+                for file_path, spool_file in list(self._files.items()):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    if spool_file.state != IN_USE:
+                        total_bytes -= spool_file.size_bytes
+                        self._delete(file_path, reason="max_bytes")
+                if total_bytes > self.max_bytes:
+                    logging.warning(
+                        f"{self.directory} holds {total_bytes} bytes of uploads that are still in use, more than the {self.max_bytes} allowed"
+                    )
+            self._update_metrics()
+
+    def _track(self, file_path, spool_file):
+        self._files[file_path] = spool_file
+        self._total_bytes += spool_file.size_bytes
+        self._counts[spool_file.state] += 1
+
+    def _untrack(self, file_path) -> SpoolFile:
+        spool_file = self._files.pop(file_path)
+        self._total_bytes -= spool_file.size_bytes
+        self._counts[spool_file.state] -= 1
+        return spool_file
+
+    def _delete(self, file_path, reason=None):
+        spool_file = self._untrack(file_path)
+        if spool_file.state == KEPT and reason != "keep_limit":
+            self._kept.remove(file_path)
+        try:
+            pathlib.Path(file_path).unlink(missing_ok=True)
+        except OSError:
+            logging.exception(f"unable to delete {file_path}")
+        if reason is not None:
+            logging.info(f"swept {file_path} ({reason})")
+            metrics_handler.spool_files_swept.labels(reason=reason).inc()
+
+    def _update_metrics(self):
+        for state in STATES:
+            metrics_handler.spool_files.labels(state=state).set(self._counts[state])
+        metrics_handler.spool_bytes.set(self._total_bytes)
@@ -0,0 +1,230 @@
+import json
+import logging
+import pathlib
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from metrics import MetricsHandler
+
+
+metrics_handler = MetricsHandler.instance()
+
+# the port on core-v4 that's forwarded to us, core-v4 sends its health
+# checks to localhost:CORE_V4_PORT
+CORE_V4_PORT = 14000
+
+
+def load_core_v4_ip(config_json_path):
+    """
+    returns HEALTH_CHECK.CORE_V4_IP from config.json, or None if there
+    isn't one.
+    """
+    try:
+        config = json.loads(pathlib.Path(config_json_path).read_text())
+        return config["HEALTH_CHECK"]["CORE_V4_IP"]
+    except (OSError, ValueError, KeyError, TypeError):
+        logging.warning(f"no HEALTH_CHECK.CORE_V4_IP in {config_json_path}, not opening the ssh tunnel")
+        return None
+
+
+def get_ssh_command(
+    core_v4_ip,
+    core_v4_port=CORE_V4_PORT,
+    quasar_port=9000,
+    known_hosts_path="/app/known_hosts",
+    ssh_key_path="/app/ssh_key",
+) -> list:
+    """
+    the same tunnel what.sh opens (see open_ssh_tunnel there), except
+    ssh stays in the foreground so its exit can be noticed, and gives
+    up instead of hanging around when the forward or the connection
+    is broken.
+    """
+    return [
+        "ssh",
+        "-o", f"UserKnownHostsFile={known_hosts_path}",
+        "-o", "StrictHostKeyChecking=no",
+        # without these a dead connection or a port core-v4 won't give
+        # us keeps ssh running, looking fine
+        "-o", "ExitOnForwardFailure=yes",
+        "-o", "ServerAliveInterval=15",
+        "-o", "ServerAliveCountMax=3",
+        "-i", ssh_key_path,
+        "-g", "-N",
+        "-R", f"0.0.0.0:{core_v4_port}:localhost:{quasar_port}",
+        f"sce@{core_v4_ip}",
+    ]
+
+
+class SshTunnel:
+    """
+    keeps the ssh tunnel to core-v4 open. the ssh process is a child of
+    ours, so its exit is noticed right away. while it runs, probe_url
+    (the forwarded port on core-v4, which comes back to us through the
+    tunnel) is requested every probe_interval_seconds, and after
+    max_probe_failures failed probes in a row ssh is killed and
+    restarted. any http response counts as the tunnel working.
+
+    restarts wait a jittered, exponentially growing delay between
+    min_backoff_seconds and max_backoff_seconds, so a core-v4 that's
+    down isn't hammered. a tunnel that stayed up stable_after_seconds
+    starts over from the shortest delay.
+
+    until a probe has gotten through once, failed probes are taken to
+    mean the port can't be reached from here (i.e. a firewall), and
+    the tunnel is judged by the ssh process alone.
+    """
+
+    def __init__(
+        self,
+        command,
+        probe_url=None,
+        probe_interval_seconds=15,
+        probe_timeout_seconds=5,
+        max_probe_failures=3,
+        min_backoff_seconds=1,
+        max_backoff_seconds=60,
+        stable_after_seconds=60,
+    ):
+        self.command = command
+        self.probe_url = probe_url
+        self.probe_interval_seconds = probe_interval_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+        self.max_probe_failures = max_probe_failures
+        self.min_backoff_seconds = min_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.stable_after_seconds = stable_after_seconds
+        self.is_up = False
+        self._probe_works = False
+        self._process = None
+        self._process_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ssh-tunnel", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        # wakes the thread, which is waiting on ssh to exit
+        self._kill_process()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_backoff_seconds(self, failures) -> float:
+        longest = min(self.max_backoff_seconds, self.min_backoff_seconds * 2**failures)
+        # half fixed, half random, so the first retry still waits a bit
+        return random.uniform(longest / 2, longest)
+
+    def probe(self) -> bool:
+        try:
+            with urllib.request.urlopen(self.probe_url, timeout=self.probe_timeout_seconds):
+                pass
+        except urllib.error.HTTPError:
+            # whatever answered did so through the tunnel
+            pass
+        except (OSError, ValueError) as e:
+            # a probe that has never worked would warn every interval
+            log = logging.warning if self._probe_works else logging.debug
+            log(f"ssh tunnel probe of {self.probe_url} failed: {e}")
+            return False
+        return True
+
+    def _run(self):
+        failures = 0
+        went_down_at = time.monotonic()
+        while not self._stop_event.is_set():
+            started_at = time.monotonic()
+            reason = self._run_process(went_down_at)
+            self._set_up(False)
+            if self._stop_event.is_set():
+                return
+            went_down_at = time.monotonic()
+            if went_down_at - started_at >= self.stable_after_seconds:
+                failures = 0
+            delay = self.get_backoff_seconds(failures)
+            failures += 1
+            metrics_handler.ssh_tunnel_reconnects.labels(reason=reason).inc()
+            logging.warning(f"ssh tunnel {reason}, reopening it in {delay:.1f} seconds")
+            self._stop_event.wait(delay)
+
+    def _run_process(self, went_down_at) -> str:
+        """
+        starts ssh and watches it until it has to be restarted. returns
+        why.
+        """
+        with self._process_lock:
+            if self._stop_event.is_set():
+                return "stopped"
+            try:
+                self._process = subprocess.Popen(
+                    self.command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except OSError as e:
+                logging.error(f"unable to start ssh tunnel: {e}")
+                return "start_failed"
+        metrics_handler.ssh_tunnel_last_opened.set(int(time.time()))
+        probe_failures = 0
+        # checked soon after starting so a reconnect is noticed quickly,
+        # then every probe_interval_seconds
+        wait_seconds = min(1, self.probe_interval_seconds)
+        try:
+            while True:
+                try:
+                    returncode = self._process.wait(timeout=wait_seconds)
+                    if self._stop_event.is_set():
+                        return "stopped"
+                    logging.warning(f"ssh tunnel exited with {returncode}")
+                    return "exited"
+                except subprocess.TimeoutExpired:
+                    pass
+                if self.is_up:
+                    wait_seconds = self.probe_interval_seconds
+                else:
+                    wait_seconds = min(wait_seconds * 2, self.probe_interval_seconds)
+
+                if self.probe_url is None:
+                    self._set_up(True, went_down_at)
+                    continue
+                if self.probe():
+                    probe_failures = 0
+                    self._probe_works = True
+                    self._set_up(True, went_down_at)
+                    continue
+                probe_failures += 1
+                if not self._probe_works:
+                    self._set_up(True, went_down_at)
+                elif probe_failures >= self.max_probe_failures:
+                    return "probe_failed"
+        finally:
+            self._kill_process()
+
+    def _kill_process(self):
+        with self._process_lock:
+            process = self._process
+            if process is None or process.poll() is not None:
+                return
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _set_up(self, is_up, went_down_at=None):
+        if is_up == self.is_up:
+            return
+        self.is_up = is_up
+        metrics_handler.ssh_tunnel_up.set(int(is_up))
+        if is_up:
+            metrics_handler.ssh_tunnel_connected_at.set(int(time.time()))
+            metrics_handler.ssh_tunnel_reconnect_seconds.observe(time.monotonic() - went_down_at)
+            logging.info("ssh tunnel is up")
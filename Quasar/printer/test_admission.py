@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+from admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmissionController(unittest.TestCase):
+    def assertRejected(self, controller, status_code, reason, size_bytes=0, user_id=None):
+        with self.assertRaises(AdmissionRejected) as context:
+            if user_id is None:
+                controller.admit(size_bytes)
+            else:
+                controller.take_token(user_id)
+        self.assertEqual(context.exception.status_code, status_code)
+        self.assertEqual(context.exception.reason, reason)
+        return context.exception
+
+    def test_too_many_jobs(self):
+        controller = AdmissionController(max_jobs=2, client_rate_per_second=0)
+        controller.admit()
+        controller.admit()
+        self.assertRejected(controller, 503, "too_many_jobs")
+
+        controller.release()
+        controller.admit()
+        self.assertEqual(controller.jobs, 2)
+
+    def test_too_many_bytes(self):
+        controller = AdmissionController(max_bytes=100, client_rate_per_second=0)
+        controller.admit(60)
+        self.assertRejected(controller, 503, "too_many_bytes", size_bytes=60)
+        controller.admit(40)
+
+        controller.release(60)
+        controller.release(40)
+        # a request bigger than the limit still gets in on its own
+        controller.admit(500)
+
+    def test_client_rate_limit(self):
+        controller = AdmissionController(client_rate_per_second=0.5, client_burst=2)
+        with mock.patch("admission.time.monotonic", return_value=1000):
+            controller.take_token("a")
+            controller.take_token("a")
+            rejected = self.assertRejected(controller, 429, "client_rate_limited", user_id="a")
+            self.assertEqual(rejected.retry_after_seconds, 2)
+            # other users have their own bucket
+            controller.take_token("b")
+        with mock.patch("admission.time.monotonic", return_value=1002):
+            controller.take_token("a")
+
+
+if __name__ == "__main__":
+    unittest.main()
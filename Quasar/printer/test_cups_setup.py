@@ -0,0 +1,129 @@
+import os
+import pathlib
+import stat
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import cups_setup
+from metrics import MetricsHandler
+from routing import Printer
+
+
+metrics_handler = MetricsHandler.instance()
+
+# stand ins for the cups client tools. cups is "up" once the cups-up
+# file exists, and lpadmin marks a printer as added with a file.
+FAKE_LPSTAT = """#!/bin/sh
+[ -f "{directory}/cups-up" ] || {{ echo "scheduler is not running"; exit 1; }}
+case "$1" in
+    -r) echo "scheduler is running" ;;
+    -a) shift; for name; do [ -f "{directory}/added-$name" ] && echo "$name accepting requests since Fri 17 Jul 2025 02:40:12 PM UTC"; done ;;
+esac
+exit 0
+"""
+FAKE_LPADMIN = """#!/bin/sh
+echo "$@" >> "{directory}/lpadmin.log"
+touch "{directory}/added-$2"
+"""
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting")
+        time.sleep(0.01)
+
+
+class TestCupsReadiness(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.directory = pathlib.Path(temporary_directory.name)
+        for name, script in [("lpstat", FAKE_LPSTAT), ("lpadmin", FAKE_LPADMIN)]:
+            path = self.directory / name
+            path.write_text(script.format(directory=self.directory))
+            path.chmod(path.stat().st_mode | stat.S_IEXEC)
+        path_patch = mock.patch.dict(
+            os.environ, {"PATH": f"{self.directory}{os.pathsep}{os.environ['PATH']}"}
+        )
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+        self.printers = [
+            Printer(side="LEFT", name="left-printer", lpd_url="lpd://10.0.0.1"),
+            Printer(side="RIGHT", name="right-printer", lpd_url="lpd://10.0.0.2"),
+            Printer(side="MIDDLE", name="disabled-printer", enabled=False, lpd_url="lpd://10.0.0.3"),
+        ]
+
+    def start(self, **kwargs) -> cups_setup.CupsReadiness:
+        readiness = cups_setup.CupsReadiness(
+            self.printers,
+            ppd_path="/tmp/printer.ppd",
+            started_at=time.time(),
+            interval_seconds=0.01,
+            max_interval_seconds=0.05,
+            **kwargs,
+        )
+        readiness.start()
+        self.addCleanup(readiness.stop)
+        return readiness
+
+    def test_waits_for_cups_then_adds_printers(self):
+        readiness = self.start(should_register=lambda: True)
+        time.sleep(0.1)
+        self.assertFalse(readiness.is_ready)
+        self.assertEqual(readiness.waiting_for, "cups scheduler")
+
+        (self.directory / "cups-up").touch()
+        wait_for(lambda: readiness.is_ready)
+        self.assertEqual(
+            (self.directory / "lpadmin.log").read_text().splitlines(),
+            [
+                "-p left-printer -v lpd://10.0.0.1 -P /tmp/printer.ppd -E",
+                "-p right-printer -v lpd://10.0.0.2 -P /tmp/printer.ppd -E",
+            ],
+        )
+        self.assertGreater(
+            metrics_handler.server_startup_seconds.labels(phase="ready")._value.get(), 0
+        )
+
+    def test_waits_for_the_leader_to_add_printers(self):
+        (self.directory / "cups-up").touch()
+        readiness = self.start()
+        wait_for(lambda: readiness.waiting_for == "printers left-printer, right-printer")
+
+        (self.directory / "added-left-printer").touch()
+        (self.directory / "added-right-printer").touch()
+        wait_for(lambda: readiness.is_ready)
+        self.assertFalse((self.directory / "lpadmin.log").exists())
+
+    def test_ready_without_a_printer_lpadmin_failed_for(self):
+        (self.directory / "cups-up").touch()
+        readiness = self.start(max_missing_interval_seconds=0.05)
+        (self.directory / "added-right-printer").touch()
+        wait_for(lambda: readiness.is_ready)
+        self.assertEqual(readiness.missing_printers, ["left-printer"])
+
+        # i.e. added by hand later
+        (self.directory / "added-left-printer").touch()
+        wait_for(lambda: readiness.missing_printers == [])
+
+    def test_accepting_printers(self):
+        (self.directory / "cups-up").touch()
+        (self.directory / "added-right-printer").touch()
+        self.assertEqual(
+            cups_setup.get_accepting_printers(["left-printer", "right-printer"]),
+            {"right-printer"},
+        )
+
+    def test_started_at(self):
+        with mock.patch.dict(os.environ, {cups_setup.STARTED_AT_VARIABLE: "1700000000.25"}):
+            self.assertEqual(cups_setup.get_started_at(5), 1700000000.25)
+        with mock.patch.dict(os.environ, {cups_setup.STARTED_AT_VARIABLE: ""}):
+            self.assertEqual(cups_setup.get_started_at(5), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
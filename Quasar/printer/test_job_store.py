@@ -0,0 +1,153 @@
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from job_store import JobStore
+
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.database_path = str(pathlib.Path(temporary_directory.name) / "jobs.db")
+        self.job_store = JobStore(self.database_path, flush_interval_seconds=0.01)
+        self.addCleanup(self.job_store.close)
+
+    def test_database_uses_wal_mode(self):
+        conn = sqlite3.connect(self.database_path)
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        conn.close()
+        self.assertEqual(journal_mode, "wal")
+
+    def test_indexes_exist(self):
+        conn = sqlite3.connect(self.database_path)
+        indexes = {
+            row[0]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+        conn.close()
+        self.assertIn("job_print_id", indexes)
+        self.assertIn("job_time", indexes)
+
+    def test_get_jobs_since(self):
+        self.job_store.record_job("printer-1", "file-1", copies=1, created_at=100)
+        self.job_store.record_job("printer-2", "file-2", copies=3, created_at=200)
+        self.job_store.flush()
+
+        jobs = self.job_store.get_jobs(since=150)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["print_id"], "printer-2")
+        self.assertEqual(jobs[0]["copies"], 3)
+        self.assertEqual(len(self.job_store.get_jobs()), 2)
+
+    def test_get_job_by_file_id(self):
+        self.job_store.record_job("printer-1", "file-1", copies=2, created_at=100)
+        self.job_store.flush()
+
+        self.assertEqual(self.job_store.get_job("file-1")["print_id"], "printer-1")
+        self.assertIsNone(self.job_store.get_job("file-2"))
+
+    def test_old_database_gets_new_columns(self):
+        database_path = str(pathlib.Path(self.database_path).with_name("old.db"))
+        conn = sqlite3.connect(database_path)
+        conn.execute(
+            "CREATE TABLE job (id INTEGER PRIMARY KEY AUTOINCREMENT, print_id TEXT, file_id TEXT, "
+            "time REAL NOT NULL, copies INTEGER, sides TEXT, page_range TEXT, printer TEXT, client TEXT)"
+        )
+        conn.commit()
+        conn.close()
+
+        job_store = JobStore(database_path, flush_interval_seconds=0.01)
+        self.addCleanup(job_store.close)
+        job_store.record_job("printer-1", "file-1", pages=12)
+        job_store.flush()
+        self.assertEqual(job_store.get_job("file-1")["pages"], 12)
+
+    def test_queued_job_is_updated_once_sent(self):
+        self.job_store.record_job(None, "file-1", copies=2, created_at=100, state="queued")
+        self.job_store.record_job(None, "file-2", copies=1, created_at=100, state="queued")
+        self.job_store.record_job_sent("file-1", "printer-1", printer="printer")
+        self.job_store.record_job_failed("file-2")
+        self.job_store.flush()
+
+        job = self.job_store.get_job("file-1")
+        self.assertEqual(
+            (job["print_id"], job["printer"], job["copies"], job["state"]),
+            ("printer-1", "printer", 2, "sent"),
+        )
+        self.assertEqual(self.job_store.get_job("file-2")["state"], "failed")
+
+    def test_writes_are_batched(self):
+        for i in range(250):
+            self.job_store.record_job(f"printer-{i}", f"file-{i}", created_at=i)
+        self.job_store.flush()
+
+        jobs = self.job_store.get_jobs(limit=1000)
+        self.assertEqual([job["print_id"] for job in jobs], [f"printer-{i}" for i in range(250)])
+
+    def test_failed_write_does_not_stop_writer(self):
+        self.job_store.execute_later("INSERT INTO missing_table VALUES (?)", (1,))
+        self.job_store.flush()
+        self.job_store.record_job("printer-1", "file-1", created_at=1)
+        self.job_store.flush()
+        self.assertEqual(len(self.job_store.get_jobs()), 1)
+
+    def test_failed_write_does_not_lose_its_batch(self):
+        job_store = JobStore(self.database_path, flush_interval_seconds=60)
+        job_store.record_job("printer-1", "file-1", created_at=1)
+        job_store.execute_later("INSERT INTO missing_table VALUES (?)", (1,))
+        job_store.record_job("printer-2", "file-2", created_at=2)
+        job_store.close()
+        self.assertEqual(
+            [job["print_id"] for job in self.job_store.get_jobs()], ["printer-1", "printer-2"]
+        )
+
+    def test_job_states(self):
+        self.job_store.record_job_state("printer-1", "pending", 1)
+        self.job_store.record_job_state("printer-2", "pending", 2)
+        self.job_store.record_job_state("printer-1", "completed", 3)
+        self.job_store.flush()
+
+        self.assertEqual(
+            self.job_store.get_job_states("printer-1"),
+            [{"state": "pending", "time": 1}, {"state": "completed", "time": 3}],
+        )
+
+    def test_get_unfinished_print_ids(self):
+        self.job_store.record_job("printer-1", "file-1", printer="printer", created_at=100)
+        self.job_store.record_job("printer-2", "file-2", printer="printer", created_at=200)
+        self.job_store.record_job("printer-3", "file-3", printer="printer", created_at=200)
+        self.job_store.record_job("", "file-4", printer="printer", created_at=200)
+        self.job_store.record_job_state("printer-2", "processing", 201)
+        self.job_store.record_job_state("printer-3", "canceled", 202)
+        self.job_store.flush()
+
+        self.assertEqual(
+            self.job_store.get_unfinished_print_ids(since=150, before=300),
+            [("printer-2", "printer")],
+        )
+
+    def test_close_commits_queued_writes(self):
+        job_store = JobStore(self.database_path, flush_interval_seconds=60)
+        job_store.record_job("printer-1", "file-1", created_at=1)
+        job_store.close()
+        self.assertEqual(len(self.job_store.get_jobs()), 1)
+
+    def test_idempotency_keys(self):
+        self.job_store.record_idempotency_key("key-1", {"print_id": "printer-1"}, created_at=100)
+        self.job_store.record_idempotency_key("key-2", {"print_id": "printer-2"}, created_at=200)
+        self.job_store.flush()
+
+        self.assertEqual(self.job_store.get_idempotency_key("key-1"), {"print_id": "printer-1"})
+        self.assertIsNone(self.job_store.get_idempotency_key("key-1", since=150))
+        self.assertIsNone(self.job_store.get_idempotency_key("key-3"))
+
+        self.job_store.expire_idempotency_keys(before=150)
+        self.job_store.flush()
+        self.assertIsNone(self.job_store.get_idempotency_key("key-1"))
+        self.assertEqual(self.job_store.get_idempotency_key("key-2"), {"print_id": "printer-2"})
+
+
+if __name__ == "__main__":
+    unittest.main()
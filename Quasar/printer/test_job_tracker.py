@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import unittest
+
+from job_tracker import JobTracker
+
+
+class TestJobTracker(unittest.TestCase):
+    def test_cups_states_are_mapped_by_print_id(self):
+        tracker = JobTracker()
+        tracker.set_state("job-1", "queued")
+        tracker.set_state("job-1", "spooled", print_id="right-printer-1", printer="right-printer")
+
+        tracker.record_cups_state("right-printer-1", "processing")
+        self.assertEqual(tracker.get("job-1")["state"], "printing")
+        tracker.record_cups_state("right-printer-1", "completed")
+        self.assertEqual(tracker.get("job-1")["state"], "completed")
+        self.assertEqual(tracker.get("job-1")["printer"], "right-printer")
+
+        # jobs someone sent with lp by hand aren't ours
+        tracker.record_cups_state("right-printer-2", "processing")
+        self.assertIsNone(tracker.get_state_of_print("right-printer-2"))
+
+    def test_finished_jobs_stay_finished(self):
+        tracker = JobTracker()
+        tracker.set_state("job-1", "failed")
+        tracker.set_state("job-1", "spooled", print_id="right-printer-1")
+        self.assertEqual(tracker.get("job-1")["state"], "failed")
+
+    def test_duplicates_follow_the_same_print(self):
+        tracker = JobTracker()
+        tracker.set_state("job-1", "spooled", print_id="right-printer-1")
+        tracker.set_state("job-2", "spooled", print_id="right-printer-1")
+
+        tracker.record_cups_state("right-printer-1", "completed")
+        self.assertEqual(tracker.get("job-1")["state"], "completed")
+        self.assertEqual(tracker.get("job-2")["state"], "completed")
+
+    def test_oldest_jobs_are_evicted(self):
+        tracker = JobTracker(max_jobs=2)
+        for i in range(3):
+            tracker.set_state(f"job-{i}", "spooled", print_id=f"right-printer-{i}")
+
+        self.assertIsNone(tracker.get("job-0"))
+        self.assertIsNone(tracker.get_state_of_print("right-printer-0"))
+        self.assertEqual(tracker.get("job-2")["state"], "spooled")
+
+    def test_subscribers_get_updates_from_other_threads(self):
+        tracker = JobTracker()
+        tracker.set_state("job-1", "spooled", print_id="right-printer-1")
+
+        async def run():
+            queue = tracker.subscribe("job-1")
+            # the queue monitor calls in from its own thread
+            thread = threading.Thread(
+                target=tracker.record_cups_state, args=("right-printer-1", "processing")
+            )
+            thread.start()
+            update = await asyncio.wait_for(queue.get(), 1)
+            thread.join()
+            tracker.unsubscribe("job-1", queue)
+            return update
+
+        update = asyncio.run(run())
+        self.assertEqual(update["state"], "printing")
+        self.assertEqual(update["print_id"], "right-printer-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import pathlib
+import tempfile
+import unittest
+
+from leader import LeaderElection
+
+
+class TestLeaderElection(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.lock_path = str(pathlib.Path(temporary_directory.name) / "background.lock")
+        self.elected = []
+
+    def election(self, name) -> LeaderElection:
+        election = LeaderElection(
+            self.lock_path,
+            lambda: self.elected.append(name),
+            retry_interval_seconds=0.01,
+        )
+        self.addCleanup(election.stop)
+        return election
+
+    def test_only_one_leader(self):
+        first = self.election("first")
+        second = self.election("second")
+        first.start()
+        second.start()
+
+        self.assertTrue(first.is_leader)
+        self.assertFalse(second.is_leader)
+        self.assertEqual(self.elected, ["first"])
+
+    def test_takes_over_when_the_leader_stops(self):
+        first = self.election("first")
+        second = self.election("second")
+        first.start()
+        second.start()
+        # i.e. the leading worker exited
+        first.stop()
+        second._thread.join(timeout=5)
+
+        self.assertTrue(second.is_leader)
+        self.assertEqual(self.elected, ["first", "second"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import pathlib
+import stat
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import normalize
+from normalize import ConversionError, Normalizer
+
+
+# stands in for ghostscript, "converts" by copying the input and fails
+# on anything with BROKEN in it
+FAKE_GS = """#!/bin/sh
+echo "$@" >> "{directory}/gs.log"
+for arg; do
+    case "$arg" in -sOutputFile=*) output="${{arg#-sOutputFile=}}" ;; esac
+    input="$arg"
+done
+if grep -q BROKEN "$input"; then
+    echo "**** Error: Cannot find a 'startxref' anywhere in the file." >&2
+    exit 1
+fi
+cp "$input" "$output"
+"""
+
+
+def install_fake_gs(directory) -> pathlib.Path:
+    """
+    puts the fake gs first on PATH until the test is over, returns the
+    file every call to it is logged to.
+    """
+    directory = pathlib.Path(directory)
+    path = directory / "gs"
+    path.write_text(FAKE_GS.format(directory=directory))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return directory / "gs.log"
+
+
+class TestNormalizer(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.directory = pathlib.Path(temporary_directory.name)
+        self.gs_log = install_fake_gs(self.directory)
+        path_patch = mock.patch.dict(
+            os.environ, {"PATH": f"{self.directory}{os.pathsep}{os.environ['PATH']}"}
+        )
+        path_patch.start()
+        self.addCleanup(path_patch.stop)
+        self.normalizer = Normalizer("pcl", self.directory / "cache", max_cache_bytes=1000, workers=1)
+        self.addCleanup(self.normalizer.close)
+
+    def write_upload(self, name, content) -> pathlib.Path:
+        path = self.directory / name
+        path.write_bytes(content)
+        return path
+
+    def gs_calls(self) -> int:
+        return len(self.gs_log.read_text().splitlines()) if self.gs_log.exists() else 0
+
+    def test_command(self):
+        self.assertEqual(
+            normalize.get_command("in.pdf", "out.pcl", "pcl", "1-3", "two-sided-short-edge"),
+            [
+                "gs", "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=pxlmono",
+                "-sOutputFile=out.pcl", "-sPageList=1-3", "-r600", "-dDuplex=true",
+                "-dTumble=true", "in.pdf",
+            ],
+        )
+        # cups takes care of sides for postscript
+        self.assertEqual(
+            normalize.get_command("in.pdf", "out.ps", "ps", sides="two-sided-long-edge")[-2:],
+            ["-sOutputFile=out.ps", "in.pdf"],
+        )
+
+    def test_repeated_uploads_are_converted_once(self):
+        upload = self.write_upload("upload", b"%PDF-1.4 handout")
+        first = asyncio.run(self.normalizer.normalize(upload, "digest", "1-2", "one-sided"))
+        second = asyncio.run(self.normalizer.normalize(upload, "digest", "1-2", "one-sided"))
+        self.assertEqual(first, second)
+        self.assertEqual(first.read_bytes(), b"%PDF-1.4 handout")
+        self.assertEqual(self.gs_calls(), 1)
+
+        # other options are another conversion
+        asyncio.run(self.normalizer.normalize(upload, "digest", None, "one-sided"))
+        self.assertEqual(self.gs_calls(), 2)
+
+    def test_broken_pdf(self):
+        upload = self.write_upload("upload", b"%PDF-1.4 BROKEN")
+        with self.assertRaises(ConversionError) as e:
+            asyncio.run(self.normalizer.normalize(upload, "digest"))
+        self.assertIn("startxref", str(e.exception))
+        self.assertEqual(list((self.directory / "cache").iterdir()), [])
+
+    def test_least_recently_used_are_evicted(self):
+        paths = []
+        for i, name in enumerate(["old", "used", "new"]):
+            upload = self.write_upload(name, bytes(400))
+            paths.append(asyncio.run(self.normalizer.normalize(upload, name)))
+            self.normalizer.release(paths[-1])
+            # mtimes a second apart, some filesystems don't go finer
+            os.utime(paths[-1], (time.time() - 10 + i, time.time() - 10 + i))
+        # the newest one pushed the cache over 1000 bytes
+        self.assertFalse(paths[0].exists())
+
+        os.utime(paths[1])
+        newest = asyncio.run(self.normalizer.normalize(self.write_upload("newest", bytes(400)), "newest"))
+        self.assertTrue(paths[1].exists())
+        self.assertFalse(paths[2].exists())
+        self.assertTrue(newest.exists())
+
+    def test_pinned_conversions_are_not_evicted(self):
+        waiting = asyncio.run(self.normalizer.normalize(self.write_upload("waiting", bytes(600)), "waiting"))
+        os.utime(waiting, (time.time() - 10, time.time() - 10))
+        # the oldest, but its job hasn't been sent to cups yet
+        newer = asyncio.run(self.normalizer.normalize(self.write_upload("newer", bytes(600)), "newer"))
+        self.normalizer.release(newer)
+        self.assertTrue(waiting.exists())
+
+        self.normalizer.release(waiting)
+        self.normalizer.evict()
+        self.assertFalse(waiting.exists())
+        self.assertTrue(newer.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import pathlib
+import tempfile
+import unittest
+import zlib
+
+import pdf
+
+
+def make_pdf(page_count, incremental_update_pages=None) -> bytes:
+    """
+    builds a pdf with a classic xref table. if incremental_update_pages
+    is given, an update is appended that changes the page count, like
+    an editor saving over the file would.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R /PageLabels << /Nums [0 << /S /D >>] >> >>",
+        b"<< /Type /Pages /Kids [] /Count %d >>" % page_count,
+    ]
+    data = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref_offset = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % offset
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, xref_offset,
+    )
+
+    if incremental_update_pages is not None:
+        update_offset = len(data)
+        data += b"2 0 obj\n<< /Type /Pages /Kids [] /Count %d >>\nendobj\n" % incremental_update_pages
+        update_xref_offset = len(data)
+        data += b"xref\n2 1\n%010d 00000 n \n" % update_offset
+        data += b"trailer\n<< /Size 3 /Root 1 0 R /Prev %d >>\nstartxref\n%d\n%%%%EOF\n" % (
+            xref_offset, update_xref_offset,
+        )
+    return bytes(data)
+
+
+def make_compressed_pdf(page_count) -> bytes:
+    """
+    builds a pdf 1.5 style file, where the catalog and page tree are
+    packed in an object stream and the xref is a png predicted stream.
+    """
+    catalog = b"<< /Type /Catalog /Pages 2 0 R >>"
+    pages = b"<< /Type /Pages /Kids [] /Count %d >>" % page_count
+    header = b"1 0 2 %d " % (len(catalog) + 1)
+    object_stream = zlib.compress(header + catalog + b" " + pages)
+
+    data = bytearray(b"%PDF-1.5\n")
+    object_stream_offset = len(data)
+    data += b"3 0 obj\n<< /Type /ObjStm /N 2 /First %d /Filter /FlateDecode /Length %d >>\nstream\n" % (
+        len(header), len(object_stream),
+    )
+    data += object_stream + b"\nendstream\nendobj\n"
+    xref_offset = len(data)
+
+    # type, field 2, field 3 with widths 1 2 1, for objects 0 to 4
+    rows = [
+        (0, 0, 255),
+        (2, 3, 0),
+        (2, 3, 1),
+        (1, object_stream_offset, 0),
+        (1, xref_offset, 0),
+    ]
+    predicted = bytearray()
+    previous = bytes(4)
+    for kind, field, generation in rows:
+        row = bytes([kind]) + field.to_bytes(2, "big") + bytes([generation])
+        # png "up" filter, every byte is stored as the difference from
+        # the byte above it
+        predicted += b"\x02" + bytes((a - b) & 0xFF for a, b in zip(row, previous))
+        previous = row
+    xref_stream = zlib.compress(bytes(predicted))
+    data += (
+        b"4 0 obj\n<< /Type /XRef /Size 5 /W [1 2 1] /Root 1 0 R /Filter /FlateDecode "
+        b"/DecodeParms << /Predictor 12 /Columns 4 >> /Length %d >>\nstream\n" % len(xref_stream)
+    )
+    data += xref_stream + b"\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_offset
+    return bytes(data)
+
+
+class TestCountPages(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.directory = pathlib.Path(temporary_directory.name)
+
+    def write(self, content, name="test.pdf") -> str:
+        path = self.directory / name
+        path.write_bytes(content)
+        return str(path)
+
+    def test_xref_table(self):
+        self.assertEqual(pdf.count_pages(self.write(make_pdf(12))), 12)
+
+    def test_incremental_update_wins(self):
+        self.assertEqual(pdf.count_pages(self.write(make_pdf(12, incremental_update_pages=13))), 13)
+
+    def test_xref_stream_and_object_stream(self):
+        self.assertEqual(pdf.count_pages(self.write(make_compressed_pdf(500))), 500)
+
+    def test_not_a_pdf(self):
+        self.assertIsNone(pdf.count_pages(self.write(b"just some text\n")))
+        self.assertIsNone(pdf.count_pages(self.write(b"")))
+
+    def test_broken_pdf(self):
+        with self.assertRaises(pdf.PdfError):
+            pdf.count_pages(self.write(make_pdf(12)[:-40]))
+
+    def test_broken_pdf_pages_are_scanned_for(self):
+        content = make_pdf(2).replace(b"/Kids []", b"/Kids [3 0 R 4 0 R]")
+        content += b"3 0 obj\n<< /Type /Page /Parent 2 0 R >>\nendobj\n"
+        content += b"4 0 obj\n<</Type/Page/Parent 2 0 R>>\nendobj\n"
+        # no startxref left
+        content = content.replace(b"startxref", b"")
+        self.assertEqual(pdf.count_pages(self.write(content)), 2)
+
+    def test_page_counter_caches_by_digest(self):
+        counter = pdf.PageCounter()
+        path = self.write(make_pdf(3))
+        self.assertEqual(counter.count_pages(path, "digest"), 3)
+
+        # same content hash, so the file isn't looked at again
+        pathlib.Path(path).unlink()
+        self.assertEqual(counter.count_pages(path, "digest"), 3)
+        self.assertIsNone(counter.count_pages(path, "other-digest"))
+
+    def test_page_counter_remembers_broken_pdfs(self):
+        counter = pdf.PageCounter()
+        path = self.write(b"%PDF-1.4 BROKEN")
+        with self.assertRaises(pdf.PdfError):
+            counter.count_pages(path, "digest")
+        pathlib.Path(path).unlink()
+        with self.assertRaises(pdf.PdfError):
+            counter.count_pages(path, "digest")
+
+
+if __name__ == "__main__":
+    unittest.main()
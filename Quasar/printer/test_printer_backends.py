@@ -0,0 +1,215 @@
+import http.server
+import pathlib
+import tempfile
+import threading
+import unittest
+
+import ipp
+from ipp import GroupTag, Operation, ValueTag
+import printer_backends
+
+
+class FakeCupsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    stands in for cups' IPP endpoint. it accepts Print-Job and Get-Jobs
+    and remembers every job it was sent.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        request = ipp.decode_message(body)
+        printer_name = self.path.rsplit("/", 1)[-1]
+
+        if printer_name == "missing-printer":
+            response = ipp.encode_message(0x0406, request.request_id, [
+                (GroupTag.OPERATION, [
+                    (ValueTag.CHARSET, "attributes-charset", "utf-8"),
+                    (ValueTag.NATURAL_LANGUAGE, "attributes-natural-language", "en"),
+                    (ValueTag.TEXT, "status-message", "The printer does not exist."),
+                ]),
+            ])
+        elif request.code == Operation.PRINT_JOB:
+            job_id = len(self.server.jobs) + 1
+            self.server.jobs.append({
+                "job-id": job_id,
+                "printer": printer_name,
+                "user": request.get(GroupTag.OPERATION, "requesting-user-name"),
+                "document-format": request.get(GroupTag.OPERATION, "document-format"),
+                "attributes": request.get_groups(GroupTag.JOB)[0],
+                "data": request.data,
+            })
+            response = ipp.encode_message(0x0000, request.request_id, [
+                (GroupTag.OPERATION, [
+                    (ValueTag.CHARSET, "attributes-charset", "utf-8"),
+                    (ValueTag.NATURAL_LANGUAGE, "attributes-natural-language", "en"),
+                ]),
+                (GroupTag.JOB, [
+                    (ValueTag.INTEGER, "job-id", job_id),
+                    (ValueTag.ENUM, "job-state", ipp.JobState.PENDING),
+                ]),
+            ])
+        else:
+            groups = [(GroupTag.OPERATION, [
+                (ValueTag.CHARSET, "attributes-charset", "utf-8"),
+                (ValueTag.NATURAL_LANGUAGE, "attributes-natural-language", "en"),
+            ])]
+            for job in self.server.jobs:
+                groups.append((GroupTag.JOB, [
+                    (ValueTag.INTEGER, "job-id", job["job-id"]),
+                    (ValueTag.ENUM, "job-state", ipp.JobState.PROCESSING),
+                    (ValueTag.NAME, "job-originating-user-name", job["user"]),
+                    (ValueTag.INTEGER, "job-k-octets", 1),
+                    (ValueTag.INTEGER, "time-at-creation", 1735718400),
+                ]))
+            response = ipp.encode_message(0x0000, request.request_id, groups)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/ipp")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        # cups closes keep-alive connections that sit idle too long,
+        # this simulates that without telling the client
+        if self.server.drop_connections:
+            self.close_connection = True
+
+
+class TestIpp(unittest.TestCase):
+    def test_encode_decode_round_trip(self):
+        message = ipp.encode_message(Operation.GET_JOBS, 7, [
+            (GroupTag.OPERATION, [
+                (ValueTag.CHARSET, "attributes-charset", "utf-8"),
+                (ValueTag.KEYWORD, "requested-attributes", ["job-id", "job-state"]),
+            ]),
+            (GroupTag.JOB, [
+                (ValueTag.INTEGER, "copies", 2),
+                (ValueTag.RANGE_OF_INTEGER, "page-ranges", [(1, 3), (5, 5)]),
+                (ValueTag.BOOLEAN, "some-flag", True),
+            ]),
+        ]) + b"document"
+
+        decoded = ipp.decode_message(message)
+        self.assertEqual(decoded.code, Operation.GET_JOBS)
+        self.assertEqual(decoded.request_id, 7)
+        self.assertEqual(
+            decoded.get_groups(GroupTag.OPERATION)[0]["requested-attributes"],
+            ["job-id", "job-state"],
+        )
+        self.assertEqual(decoded.get(GroupTag.JOB, "copies"), 2)
+        self.assertEqual(
+            decoded.get_groups(GroupTag.JOB)[0]["page-ranges"], [(1, 3), (5, 5)]
+        )
+        self.assertEqual(decoded.get(GroupTag.JOB, "some-flag"), True)
+        self.assertEqual(decoded.data, b"document")
+
+    def test_parse_page_ranges(self):
+        self.assertEqual(ipp.parse_page_ranges("1-3, 5"), [(1, 3), (5, 5)])
+
+    def test_decode_rejects_truncated_message(self):
+        with self.assertRaises(ipp.IppError):
+            ipp.decode_message(b"\x01\x01")
+
+
+class TestIppBackend(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeCupsHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.jobs = []
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.backend = printer_backends.IppBackend(
+            f"http://127.0.0.1:{self.server.server_port}", pool_size=2
+        )
+        self.addCleanup(self.backend.client.close)
+
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.file_path = pathlib.Path(temporary_directory.name) / "test.pdf"
+        self.file_path.write_bytes(b"%PDF-1.4 dummy file content")
+
+    def test_submit(self):
+        print_id = self.backend.submit(
+            str(self.file_path), "right-printer", 2, page_range="1-3,5", sides="two-sided-long-edge"
+        )
+
+        self.assertEqual(print_id, "right-printer-1")
+        job = self.server.jobs[0]
+        self.assertEqual(job["printer"], "right-printer")
+        self.assertEqual(job["data"], b"%PDF-1.4 dummy file content")
+        self.assertEqual(job["attributes"]["copies"], [2])
+        self.assertEqual(job["attributes"]["sides"], ["two-sided-long-edge"])
+        self.assertEqual(job["attributes"]["media"], ["na_letter_8.5x11in"])
+        self.assertEqual(job["attributes"]["page-ranges"], [(1, 3), (5, 5)])
+
+    def test_submit_raw(self):
+        self.backend.submit(str(self.file_path), "right-printer", 1, raw=True)
+        self.backend.submit(str(self.file_path), "right-printer", 1)
+
+        self.assertEqual(self.server.jobs[0]["document-format"], "application/vnd.cups-raw")
+        self.assertIsNone(self.server.jobs[1]["document-format"])
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.backend.submit(str(self.file_path), "right-printer", 1)
+        self.backend.get_queue("right-printer")
+
+        self.assertEqual(len(self.server.jobs), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_pooled_connection_is_retried(self):
+        self.server.drop_connections = True
+        self.assertEqual(self.backend.submit(str(self.file_path), "right-printer", 1), "right-printer-1")
+        self.assertEqual(self.backend.submit(str(self.file_path), "right-printer", 1), "right-printer-2")
+
+        self.assertEqual(self.server.jobs[1]["data"], b"%PDF-1.4 dummy file content")
+
+    def test_error_status_returns_none(self):
+        self.assertIsNone(self.backend.submit(str(self.file_path), "missing-printer", 1))
+
+    def test_get_queue(self):
+        self.backend.submit(str(self.file_path), "right-printer", 1)
+
+        jobs = self.backend.get_queue("right-printer")
+        self.assertEqual(
+            jobs,
+            [
+                printer_backends.QueuedJob(
+                    print_id="right-printer-1",
+                    printer="right-printer",
+                    state="processing",
+                    user="quasar",
+                    size_bytes=1024,
+                    created_at=1735718400,
+                )
+            ],
+        )
+
+
+class TestLpBackend(unittest.TestCase):
+    def test_parse_lpstat_output(self):
+        jobs = printer_backends.parse_lpstat_output(
+            "right-printer-53 sce 1024 Wed Jan  1 00:00:00 2025\n"
+            "right-printer-54 sce 2048 Wed Jan  1 00:01:00 2025\n",
+            "right-printer",
+        )
+
+        self.assertEqual([job.print_id for job in jobs], ["right-printer-53", "right-printer-54"])
+        self.assertEqual([job.size_bytes for job in jobs], [1024, 2048])
+        self.assertEqual(jobs[1].created_at - jobs[0].created_at, 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
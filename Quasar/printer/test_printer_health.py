@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+import printer_health
+from printer_health import DEGRADED, DOWN, HEALTHY, UNKNOWN, PrinterHealthMonitor
+from routing import Printer
+
+
+COLLECTOR_METRICS = """# HELP snmp_metric ex: Number of pages printed
+# TYPE snmp_metric gauge
+snmp_metric{ip="10.0.0.1",name="ink_level"} 800.0
+snmp_metric{ip="10.0.0.1",name="ink_capacity"} 1000.0
+snmp_metric{ip="10.0.0.1",name="page_count"} 12345.0
+snmp_metric{ip="10.0.0.2",name="ink_level"} 50.0
+snmp_metric{ip="10.0.0.2",name="ink_capacity"} 1000.0
+snmp_metric{ip="10.0.0.3",name="ink_level"} 0.0
+snmp_metric{ip="10.0.0.3",name="ink_capacity"} 1000.0
+# HELP snmp_error Error metrics
+# TYPE snmp_error gauge
+snmp_error{ip="10.0.0.1",name="tray_empty"} 0.0
+snmp_error{ip="10.0.0.2",name="tray_empty_2"} 0.0
+snmp_error{ip="10.0.0.4",name="tray_empty_2"} 1.0
+# HELP device_unreachable set to 1 when the last request to the device got no response
+# TYPE device_unreachable gauge
+device_unreachable{ip="10.0.0.1"} 0.0
+device_unreachable{ip="10.0.0.5"} 1.0
+# HELP snmp_last_success_timestamp epoch time of the last response from the device
+# TYPE snmp_last_success_timestamp gauge
+snmp_last_success_timestamp{ip="10.0.0.1"} 1.7e+09
+"""
+
+PRINTERS = [
+    Printer(side="A", name="healthy", ip="10.0.0.1"),
+    Printer(side="B", name="low-toner", ip="10.0.0.2"),
+    Printer(side="C", name="no-toner", ip="10.0.0.3"),
+    Printer(side="D", name="no-paper", ip="10.0.0.4"),
+    Printer(side="E", name="unreachable", ip="10.0.0.5"),
+    Printer(side="F", name="not-scraped", ip="10.0.0.6"),
+]
+
+
+class TestPrinterHealth(unittest.TestCase):
+    @mock.patch("printer_health.time.monotonic", return_value=1000)
+    @mock.patch("printer_health.requests.get")
+    def test_snapshot(self, mock_get, _):
+        mock_get.return_value.text = COLLECTOR_METRICS
+        snapshot = PrinterHealthMonitor(PRINTERS, "http://collector:5000/metrics").get_snapshot()
+
+        self.assertEqual(
+            {name: (health.status, health.problems) for name, health in snapshot.items()},
+            {
+                "healthy": (HEALTHY, []),
+                "low-toner": (DEGRADED, ["low_toner"]),
+                "no-toner": (DOWN, ["out_of_toner"]),
+                "no-paper": (DOWN, ["tray_empty"]),
+                "unreachable": (DOWN, ["unreachable"]),
+                "not-scraped": (UNKNOWN, []),
+            },
+        )
+        self.assertEqual(snapshot["healthy"].toner_percent, 80)
+        self.assertEqual(snapshot["healthy"].page_count, 12345)
+        self.assertEqual(snapshot["healthy"].last_seen_at, 1.7e9)
+        self.assertTrue(snapshot["low-toner"].can_print)
+        self.assertFalse(snapshot["no-paper"].can_print)
+
+    @mock.patch("printer_health.time.monotonic")
+    @mock.patch("printer_health.requests.get")
+    def test_snapshot_is_cached_until_it_goes_stale(self, mock_get, mock_monotonic):
+        mock_get.return_value.text = COLLECTOR_METRICS
+        monitor = PrinterHealthMonitor(
+            PRINTERS, "http://collector:5000/metrics", ttl_seconds=30, stale_after_seconds=600
+        )
+        mock_monotonic.return_value = 1000
+        self.assertEqual(monitor.get_snapshot()["no-paper"].status, DOWN)
+        mock_monotonic.return_value = 1010
+        monitor.get_snapshot()
+        mock_get.assert_called_once()
+
+        # the collector went away, the last snapshot is used for now
+        mock_get.side_effect = printer_health.requests.ConnectionError()
+        mock_monotonic.return_value = 1100
+        self.assertEqual(monitor.get_snapshot()["no-paper"].status, DOWN)
+        self.assertEqual(mock_get.call_count, 2)
+
+        # but not forever, an old snapshot shouldn't stop printing
+        mock_monotonic.return_value = 1700
+        self.assertEqual(monitor.get_snapshot()["no-paper"].status, UNKNOWN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from job_store import JobStore
+from printer_backends import QueuedJob
+from queue_monitor import JobEventFollower, QueueMonitor
+
+
+class FakeBackend:
+    def __init__(self):
+        self.queue = []
+        self.finished = []
+        self.error = None
+
+    def get_queue(self, printer_name):
+        if self.error:
+            raise self.error
+        return list(self.queue)
+
+    def get_finished_jobs(self, printer_name):
+        if self.error:
+            raise self.error
+        return list(self.finished)
+
+
+class TestQueueMonitor(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.job_store = mock.MagicMock()
+        self.job_store.get_unfinished_print_ids.return_value = []
+        self.monitor = QueueMonitor(
+            ["right-printer"],
+            self.backend,
+            job_store=self.job_store,
+            min_interval_seconds=1,
+            max_interval_seconds=8,
+        )
+
+    def recorded_states(self):
+        return [
+            (call.args[0], call.args[1])
+            for call in self.job_store.record_job_state.call_args_list
+        ]
+
+    def test_only_transitions_are_recorded(self):
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer", state="pending")]
+        self.monitor.poll()
+        self.monitor.poll()
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer", state="processing")]
+        self.monitor.poll()
+        self.monitor.poll()
+        self.backend.queue = []
+        self.monitor.poll()
+        self.monitor.poll()
+
+        self.assertEqual(
+            self.recorded_states(),
+            [
+                ("right-printer-1", "pending"),
+                ("right-printer-1", "processing"),
+                ("right-printer-1", "completed"),
+            ],
+        )
+
+    def test_job_without_state_is_queued(self):
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer")]
+        self.monitor.poll()
+        self.assertEqual(self.recorded_states(), [("right-printer-1", "queued")])
+
+    def test_interval_backs_off_while_idle(self):
+        intervals = []
+        for _ in range(5):
+            self.monitor.poll()
+            intervals.append(self.monitor.interval_seconds)
+        self.assertEqual(intervals, [2, 4, 8, 8, 8])
+
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer")]
+        self.monitor.poll()
+        self.assertEqual(self.monitor.interval_seconds, 1)
+
+    def test_failed_poll_keeps_jobs(self):
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer")]
+        self.monitor.poll()
+        self.backend.error = RuntimeError("lpstat exploded")
+        self.monitor.poll()
+        self.backend.error = None
+        self.monitor.poll()
+
+        self.assertEqual(self.recorded_states(), [("right-printer-1", "queued")])
+
+    def test_canceled_job_is_not_completed(self):
+        self.backend.queue = [QueuedJob("right-printer-1", "right-printer", state="pending")]
+        self.monitor.poll()
+        self.backend.queue = []
+        self.backend.finished = [QueuedJob("right-printer-1", "right-printer", state="canceled")]
+        self.monitor.poll()
+
+        self.assertEqual(
+            self.recorded_states(),
+            [("right-printer-1", "pending"), ("right-printer-1", "canceled")],
+        )
+
+    def test_job_finished_between_polls_is_reconciled(self):
+        # sent by another worker, and out of the queue before we looked
+        self.job_store.get_unfinished_print_ids.return_value = [
+            ("right-printer-1", "right-printer"),
+            ("right-printer-2", "right-printer"),
+            ("left-printer-1", "left-printer"),
+        ]
+        self.backend.finished = [QueuedJob("right-printer-2", "right-printer", state="aborted")]
+        self.monitor.poll()
+        # until the job database catches up
+        self.monitor.poll()
+
+        self.assertEqual(
+            self.recorded_states(),
+            [("right-printer-1", "completed"), ("right-printer-2", "aborted")],
+        )
+
+    def test_unfinished_jobs_keep_interval_at_minimum(self):
+        self.monitor.interval_seconds = 8
+        self.job_store.get_unfinished_print_ids.return_value = [("right-printer-1", "right-printer")]
+        self.backend.error = RuntimeError("lpstat exploded")
+        self.monitor.poll()
+        self.assertEqual(self.monitor.interval_seconds, 1)
+        self.assertEqual(self.recorded_states(), [])
+
+    def test_wake_resets_interval(self):
+        self.monitor.max_interval_seconds = 3600
+        self.monitor.interval_seconds = 3600
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+        self.monitor.wake()
+        # after waking, the monitor polls again and goes back to
+        # backing off from the minimum interval
+        for _ in range(100):
+            if self.monitor.interval_seconds < 3600:
+                break
+            self.monitor._stop_event.wait(0.01)
+        self.assertLess(self.monitor.interval_seconds, 3600)
+
+
+class TestJobEventFollower(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.job_store = JobStore(
+            str(pathlib.Path(temporary_directory.name) / "jobs.db"), flush_interval_seconds=0.01
+        )
+        self.addCleanup(self.job_store.close)
+        self.transitions = []
+        self.follower = JobEventFollower(
+            self.job_store,
+            lambda print_id, state: self.transitions.append((print_id, state)),
+            is_leader=lambda: False,
+        )
+
+    def test_follows_events_recorded_after_start(self):
+        self.job_store.record_job_state("right-printer-1", "pending")
+        self.job_store.flush()
+        self.follower.last_event_id = self.job_store.get_last_job_event_id()
+
+        # recorded by the leader's queue monitor
+        self.job_store.record_job_state("right-printer-1", "processing")
+        self.job_store.record_job_state("right-printer-2", "pending")
+        self.job_store.flush()
+        self.follower.poll()
+        self.follower.poll()
+
+        self.assertEqual(
+            self.transitions,
+            [("right-printer-1", "processing"), ("right-printer-2", "pending")],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import datetime
+import pathlib
+import tempfile
+import time
+import unittest
+
+from job_store import JobStore
+from quota import QuotaExceeded, QuotaStore, get_periods, seconds_until_reset
+
+
+# a wednesday
+NOW = datetime.datetime(2025, 1, 8, 12, 0, 0)
+
+
+class TestQuotaStore(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.database_path = str(pathlib.Path(temporary_directory.name) / "jobs.db")
+        self.job_store = self.open_job_store()
+
+    def open_job_store(self) -> JobStore:
+        job_store = JobStore(self.database_path, flush_interval_seconds=0.01)
+        self.addCleanup(job_store.close)
+        return job_store
+
+    def test_periods(self):
+        self.assertEqual(get_periods(NOW), {"day": "2025-01-08", "week": "2025-W02"})
+        self.assertEqual(seconds_until_reset("day", NOW), 12 * 60 * 60)
+        # the week resets at midnight between sunday and monday
+        self.assertEqual(seconds_until_reset("week", NOW), (12 + 4 * 24) * 60 * 60)
+
+    def test_reserve_until_the_limit(self):
+        quota_store = QuotaStore(self.job_store, daily_pages=10)
+        quota_store.reserve("student", 6, now=NOW)
+        quota_store.check("student", 4, now=NOW)
+
+        with self.assertRaises(QuotaExceeded) as e:
+            quota_store.reserve("student", 5, now=NOW)
+        self.assertEqual(e.exception.period, "day")
+        self.assertEqual(e.exception.retry_after_seconds, 12 * 60 * 60)
+        # a rejected reservation doesn't count
+        self.assertEqual(quota_store.get_usage("student", now=NOW)["day"], {"used": 6, "limit": 10})
+        # other users have their own pages
+        quota_store.reserve("other-student", 10, now=NOW)
+
+    def test_refund(self):
+        quota_store = QuotaStore(self.job_store, daily_pages=10)
+        quota_store.reserve("student", 10, now=NOW)
+        quota_store.refund("student", 4, now=NOW)
+        quota_store.reserve("student", 4, now=NOW)
+        with self.assertRaises(QuotaExceeded):
+            quota_store.check("student", now=NOW)
+
+    def test_week_carries_over_to_the_next_day(self):
+        quota_store = QuotaStore(self.job_store, daily_pages=10, weekly_pages=15)
+        quota_store.reserve("student", 10, now=NOW)
+
+        tomorrow = NOW + datetime.timedelta(days=1)
+        quota_store.reserve("student", 5, now=tomorrow)
+        with self.assertRaises(QuotaExceeded) as e:
+            quota_store.check("student", now=tomorrow)
+        self.assertEqual(e.exception.period, "week")
+
+        next_monday = NOW + datetime.timedelta(days=5)
+        quota_store.reserve("student", 10, now=next_monday)
+
+    def test_usage_survives_a_restart(self):
+        quota_store = QuotaStore(self.job_store, daily_pages=10, flush_interval_seconds=60)
+        quota_store.reserve("student", 7, now=NOW)
+        # not flushed yet, a crash now would lose these pages
+        quota_store.flush()
+        self.job_store.close()
+
+        quota_store = QuotaStore(self.open_job_store(), daily_pages=10)
+        quota_store.load(now=NOW)
+        self.assertEqual(quota_store.get_usage("student", now=NOW)["day"]["used"], 7)
+        self.assertEqual(quota_store.get_usage("student", now=NOW)["week"]["used"], 7)
+
+    def test_workers_add_up(self):
+        # two workers, each with its own store on the same database
+        first = QuotaStore(self.job_store, daily_pages=10)
+        second = QuotaStore(self.open_job_store(), daily_pages=10)
+        first.reserve("student", 4, now=NOW)
+        second.reserve("student", 5, now=NOW)
+        second.refund("student", 1, now=NOW)
+        first.sync()
+        second.sync()
+        # the second sync read back both workers' pages, the first one
+        # only its own
+        self.assertEqual(second.get_usage("student", now=NOW)["day"]["used"], 8)
+        first.sync()
+        self.assertEqual(first.get_usage("student", now=NOW)["day"]["used"], 8)
+        with self.assertRaises(QuotaExceeded):
+            first.check("student", 3, now=NOW)
+
+    def test_roll_over_reads_the_database_in_the_background(self):
+        first = QuotaStore(self.job_store, weekly_pages=15)
+        second = QuotaStore(self.open_job_store(), weekly_pages=15)
+        second.load(now=NOW)
+        first.reserve("student", 10, now=NOW)
+        first.sync()
+
+        # the new day starts from what the second worker counted, the
+        # first worker's pages show up once they've been read
+        tomorrow = NOW + datetime.timedelta(days=1)
+        for _ in range(100):
+            if second.get_usage("student", now=tomorrow)["week"]["used"] == 10:
+                break
+            time.sleep(0.01)
+        self.assertEqual(second.get_usage("student", now=tomorrow)["week"]["used"], 10)
+        self.assertEqual(second.get_usage("student", now=tomorrow)["day"]["used"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
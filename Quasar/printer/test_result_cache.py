@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def test_finished_result_is_reused(self):
+        async def run():
+            cache = ResultCache()
+            self.assertIsNone(cache.reserve("a"))
+            cache.finish("a", "right-printer-1")
+            return await cache.reserve("a")
+
+        self.assertEqual(asyncio.run(run()), "right-printer-1")
+
+    def test_repeat_waits_on_running_work(self):
+        async def run():
+            cache = ResultCache()
+            self.assertIsNone(cache.reserve("a"))
+            waiter = asyncio.ensure_future(cache.reserve("a"))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            cache.finish("a", "right-printer-1")
+            return await waiter
+
+        self.assertEqual(asyncio.run(run()), "right-printer-1")
+
+    def test_failed_work_is_not_remembered(self):
+        async def run():
+            cache = ResultCache()
+            cache.reserve("a")
+            waiter = cache.reserve("a")
+            cache.finish("a", None)
+            self.assertIsNone(await waiter)
+            # the next try has to do the work itself
+            self.assertIsNone(cache.reserve("a"))
+
+        asyncio.run(run())
+
+    def test_results_expire(self):
+        async def run():
+            cache = ResultCache(ttl_seconds=60)
+            with mock.patch("result_cache.time.monotonic", return_value=1000):
+                cache.reserve("a")
+                cache.finish("a", "right-printer-1")
+            with mock.patch("result_cache.time.monotonic", return_value=1059):
+                self.assertIsNotNone(cache.reserve("a"))
+            with mock.patch("result_cache.time.monotonic", return_value=1061):
+                self.assertIsNone(cache.reserve("a"))
+
+        asyncio.run(run())
+
+    def test_least_recently_used_is_evicted(self):
+        async def run():
+            cache = ResultCache(max_entries=2)
+            for key in ("a", "b"):
+                cache.reserve(key)
+                cache.finish(key, key)
+            # using "a" makes "b" the oldest
+            cache.reserve("a")
+            cache.reserve("c")
+
+            self.assertEqual(len(cache), 2)
+            self.assertIsNotNone(cache.reserve("a"))
+            self.assertIsNone(cache.reserve("b"))
+
+        asyncio.run(run())
+
+    def test_running_work_is_not_evicted(self):
+        async def run():
+            cache = ResultCache(max_entries=1)
+            cache.reserve("a")
+            cache.reserve("b")
+            waiter = cache.reserve("a")
+            cache.finish("a", "right-printer-1")
+            return await waiter
+
+        self.assertEqual(asyncio.run(run()), "right-printer-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
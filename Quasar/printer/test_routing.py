@@ -0,0 +1,131 @@
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from printer_backends import QueuedJob
+from printer_health import DOWN, HEALTHY, PrinterHealth
+import routing
+
+
+class FakeBackend:
+    def __init__(self, queues):
+        # printer name -> list of print ids
+        self.queues = queues
+
+    def get_queue(self, printer_name):
+        return [
+            QueuedJob(print_id=print_id, printer=printer_name)
+            for print_id in self.queues[printer_name]
+        ]
+
+
+class FakeHealthMonitor:
+    def __init__(self, snapshot):
+        # printer name -> PrinterHealth
+        self.snapshot = snapshot
+
+    def get_snapshot(self):
+        return self.snapshot
+
+
+class TestLoadPrinters(unittest.TestCase):
+    def test_load_from_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = pathlib.Path(directory) / "config.json"
+            config_path.write_text(json.dumps({
+                "PRINTING": {
+                    "LEFT": {"ENABLED": False, "NAME": "left-printer", "IP": "10.0.0.1"},
+                    "RIGHT": {"ENABLED": True, "NAME": "right-printer", "IP": "10.0.0.2"},
+                }
+            }))
+            printers = routing.load_printers(str(config_path))
+
+        self.assertEqual(
+            printers,
+            [
+                routing.Printer("LEFT", "left-printer", "10.0.0.1", False),
+                routing.Printer("RIGHT", "right-printer", "10.0.0.2", True),
+            ],
+        )
+
+    @mock.patch.dict(os.environ, {"RIGHT_PRINTER_NAME": "right-printer"})
+    def test_missing_config_falls_back_to_environment(self):
+        os.environ.pop("LEFT_PRINTER_NAME", None)
+        printers = routing.load_printers("/does/not/exist.json")
+        self.assertEqual(printers, [routing.Printer("RIGHT", "right-printer")])
+
+
+class TestPrinterRouter(unittest.TestCase):
+    def setUp(self):
+        self.printers = [
+            routing.Printer("LEFT", "left-printer", "10.0.0.1"),
+            routing.Printer("RIGHT", "right-printer", "10.0.0.2"),
+        ]
+
+    def test_shortest_queue_is_first(self):
+        backend = FakeBackend({
+            "left-printer": ["left-printer-1", "left-printer-2"],
+            "right-printer": [],
+        })
+        router = routing.PrinterRouter(self.printers, backend=backend)
+        self.assertEqual(router.rank_printers(), ["right-printer", "left-printer"])
+
+    def test_pages_in_flight_are_counted(self):
+        backend = FakeBackend({
+            "left-printer": ["left-printer-1"],
+            "right-printer": ["right-printer-1"],
+        })
+        router = routing.PrinterRouter(self.printers, backend=backend, queue_cache_seconds=0)
+        router.record_job("left-printer", "left-printer-1", 1)
+        router.record_job("right-printer", "right-printer-1", 50)
+        self.assertEqual(router.rank_printers(), ["left-printer", "right-printer"])
+
+        # once cups stops listing the long job, it no longer counts
+        backend.queues["right-printer"] = []
+        self.assertEqual(router.rank_printers(), ["right-printer", "left-printer"])
+
+    def test_routes_by_own_jobs_without_backend(self):
+        router = routing.PrinterRouter(self.printers)
+        router.record_job("left-printer", "left-printer-1", 10)
+        self.assertEqual(router.rank_printers(), ["right-printer", "left-printer"])
+
+    def test_disabled_printer_is_skipped(self):
+        self.printers[1].enabled = False
+        router = routing.PrinterRouter(self.printers)
+        self.assertEqual(router.rank_printers(), ["left-printer"])
+
+    def test_printers_that_cant_print_are_skipped(self):
+        health_monitor = FakeHealthMonitor({
+            "left-printer": PrinterHealth(status=DOWN, problems=["tray_empty"]),
+            "right-printer": PrinterHealth(status=HEALTHY),
+        })
+        router = routing.PrinterRouter(self.printers, health_monitor=health_monitor)
+        self.assertEqual(router.rank_printers(), ["right-printer"])
+
+        # jobs shouldn't pile up in cups while every printer is jammed
+        health_monitor.snapshot["right-printer"] = PrinterHealth(status=DOWN, problems=["unreachable"])
+        self.assertEqual(router.rank_printers(), [])
+
+    def test_shortest_queue_depth(self):
+        backend = FakeBackend({
+            "left-printer": ["left-printer-1"],
+            "right-printer": ["right-printer-1", "right-printer-2"],
+        })
+        health_monitor = FakeHealthMonitor({})
+        router = routing.PrinterRouter(
+            self.printers, backend=backend, queue_cache_seconds=0, health_monitor=health_monitor
+        )
+        self.assertEqual(router.get_shortest_queue_depth(), 1)
+
+        # a printer that can't print doesn't have room
+        health_monitor.snapshot["left-printer"] = PrinterHealth(status=DOWN, problems=["tray_empty"])
+        self.assertEqual(router.get_shortest_queue_depth(), 2)
+
+        # and without cups there's nothing to go by
+        self.assertIsNone(routing.PrinterRouter(self.printers).get_shortest_queue_depth())
+
+if __name__ == "__main__":
+    unittest.main()
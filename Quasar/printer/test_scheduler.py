@@ -0,0 +1,210 @@
+import asyncio
+import unittest
+
+from metrics import MetricsHandler
+import scheduler
+from scheduler import PrintScheduler
+
+
+metrics_handler = MetricsHandler.instance()
+
+
+class FakeCups:
+    """
+    a cups queue as deep as the test says, printed has the ids of the
+    jobs let through in order
+    """
+
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.printed = []
+
+    def get_queue_depth(self):
+        return self.depth
+
+
+class TestPrintScheduler(unittest.TestCase):
+    def setUp(self):
+        self.cups = FakeCups()
+
+    def get_scheduler(self, **kwargs):
+        kwargs.setdefault("max_queue_depth", 1)
+        kwargs.setdefault("aging_pages_per_minute", 0)
+        kwargs.setdefault("fair_share_weight", 0)
+        return PrintScheduler(self.cups.get_queue_depth, poll_interval_seconds=0.01, **kwargs)
+
+    async def print_job(self, print_scheduler, job_id, owner, pages):
+        async with print_scheduler.turn(job_id, owner, pages):
+            self.cups.printed.append(job_id)
+
+    async def print_jobs_while_cups_is_full(self, print_scheduler, jobs, delay_seconds=0):
+        """
+        submits jobs, a list of (job id, owner, pages), while the cups
+        queue is full, then lets them through.
+        """
+        self.cups.depth = print_scheduler.max_queue_depth
+        printed_before = list(self.cups.printed)
+        tasks = []
+        for job_id, owner, pages in jobs:
+            tasks.append(asyncio.create_task(self.print_job(print_scheduler, job_id, owner, pages)))
+            await asyncio.sleep(delay_seconds)
+        # everything is waiting on the scheduler
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.cups.printed, printed_before)
+        self.cups.depth = 0
+        await asyncio.gather(*tasks)
+
+    def test_shortest_job_first(self):
+        print_scheduler = self.get_scheduler()
+        asyncio.run(self.print_jobs_while_cups_is_full(
+            print_scheduler,
+            [("thesis", "a", 200), ("handout", "b", 10), ("resume", "c", 1), ("flyer", "d", 1)],
+        ))
+        # ties go to whoever came first
+        self.assertEqual(self.cups.printed, ["resume", "flyer", "handout", "thesis"])
+
+    def test_long_jobs_age(self):
+        # 0.1 seconds is worth 100 pages
+        print_scheduler = self.get_scheduler(aging_pages_per_minute=60000)
+        asyncio.run(self.print_jobs_while_cups_is_full(
+            print_scheduler,
+            [("thesis", "a", 50), ("resume", "b", 1)],
+            delay_seconds=0.1,
+        ))
+        self.assertEqual(self.cups.printed, ["thesis", "resume"])
+
+    def test_fair_share(self):
+        print_scheduler = self.get_scheduler(fair_share_weight=1)
+
+        async def print_all():
+            await self.print_job(print_scheduler, "first", "a", 20)
+            await self.print_jobs_while_cups_is_full(
+                print_scheduler,
+                [("second", "a", 1), ("other", "b", 5)],
+            )
+
+        asyncio.run(print_all())
+        # a's 20 pages count against its next job
+        self.assertEqual(self.cups.printed, ["first", "other", "second"])
+
+        # and stop counting once they're old enough
+        print_scheduler.fair_share_half_life_seconds = 0.001
+        self.cups.printed = []
+        asyncio.run(self.print_jobs_while_cups_is_full(
+            print_scheduler,
+            [("other", "b", 5), ("second", "a", 1)],
+        ))
+        self.assertEqual(self.cups.printed, ["second", "other"])
+
+    def test_only_released_while_cups_has_room(self):
+        print_scheduler = self.get_scheduler(max_queue_depth=2)
+        self.cups.depth = 1
+        entered = asyncio.Event()
+        leave = asyncio.Event()
+
+        async def slow_lp(job_id):
+            async with print_scheduler.turn(job_id, "a", 1):
+                self.cups.printed.append(job_id)
+                entered.set()
+                await leave.wait()
+
+        async def run():
+            first = asyncio.create_task(slow_lp("first"))
+            second = asyncio.create_task(self.print_job(print_scheduler, "second", "b", 1))
+            await entered.wait()
+            await asyncio.sleep(0.05)
+            # the first is still being submitted, which counts as in
+            # the queue
+            self.assertEqual(self.cups.printed, ["first"])
+            leave.set()
+            await asyncio.gather(first, second)
+
+        asyncio.run(run())
+        self.assertEqual(self.cups.printed, ["first", "second"])
+
+    def test_jobs_go_through_after_max_wait(self):
+        print_scheduler = self.get_scheduler(max_wait_seconds=0.1)
+        self.cups.depth = 1
+
+        async def run():
+            task = asyncio.create_task(self.print_job(print_scheduler, "thesis", "a", 200))
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.cups.printed, [])
+            await asyncio.wait_for(task, 1)
+
+        asyncio.run(run())
+        self.assertEqual(self.cups.printed, ["thesis"])
+
+    def test_idle_owners_are_forgotten(self):
+        print_scheduler = self.get_scheduler(fair_share_half_life_seconds=0.001)
+
+        async def run():
+            await self.print_job(print_scheduler, "first", "a", 20)
+            await asyncio.sleep(0.05)
+            await self.print_job(print_scheduler, "second", "b", 1)
+
+        asyncio.run(run())
+        self.assertEqual(list(print_scheduler._recent_pages), ["b"])
+
+    def test_unknown_depth_lets_everything_through(self):
+        print_scheduler = self.get_scheduler()
+        self.cups.get_queue_depth = lambda: None
+
+        async def run():
+            await asyncio.gather(*[
+                self.print_job(print_scheduler, f"job-{i}", "a", 1) for i in range(3)
+            ])
+
+        asyncio.run(run())
+        self.assertEqual(len(self.cups.printed), 3)
+
+    def test_turned_off(self):
+        print_scheduler = self.get_scheduler(max_queue_depth=0)
+        self.cups.depth = 100
+
+        async def run():
+            await self.print_job(print_scheduler, "thesis", "a", 200)
+            await self.print_job(print_scheduler, "resume", "a", 1)
+
+        asyncio.run(run())
+        self.assertEqual(self.cups.printed, ["thesis", "resume"])
+
+    def test_cancelled_while_waiting(self):
+        print_scheduler = self.get_scheduler()
+        self.cups.depth = 1
+        pending_before = metrics_handler.print_scheduler_pending._value.get()
+
+        async def run():
+            task = asyncio.create_task(self.print_job(print_scheduler, "gone", "a", 1))
+            await asyncio.sleep(0.05)
+            self.assertEqual(metrics_handler.print_scheduler_pending._value.get(), pending_before + 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(metrics_handler.print_scheduler_pending._value.get(), pending_before)
+        self.assertEqual(print_scheduler._pending, [])
+
+    def test_wait_is_recorded_by_size(self):
+        histogram = metrics_handler.print_scheduler_wait_seconds
+        sums_before = {
+            size: histogram.labels(size=size)._sum.get() for size in ("1", "21-100")
+        }
+        print_scheduler = self.get_scheduler()
+        asyncio.run(self.print_jobs_while_cups_is_full(
+            print_scheduler,
+            [("thesis", "a", 50), ("resume", "b", 1)],
+        ))
+        for size in ("1", "21-100"):
+            self.assertGreater(histogram.labels(size=size)._sum.get(), sums_before[size])
+
+    def test_size_buckets(self):
+        self.assertEqual(
+            [scheduler.get_size_bucket(pages) for pages in (1, 2, 5, 6, 20, 21, 100, 101, 1000)],
+            ["1", "2-5", "2-5", "6-20", "6-20", "21-100", "21-100", "101+", "101+"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,72 @@
+import asyncio
+import datetime
 import importlib
 import io
+import json
 import os
+import pathlib
 import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 from unittest import mock
 
 
+from fastapi import HTTPException, UploadFile
 from fastapi.testclient import TestClient
 
+from metrics import Metrics
+from printer_health import DOWN, PrinterHealth
+import quota
+import routing
 import server
+import test_normalize
+import test_pdf
+
+
+class ZeroStream(io.RawIOBase):
+    """
+    file-like object that produces `size` zero bytes without ever
+    holding them all in memory, used to fake very large uploads.
+    """
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.remaining
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return bytes(size)
 
 
 class TestFastAPI(unittest.TestCase):
+    def setUp(self):
+        # each reload of the server opens a new job store that holds
+        # its database open, so leftover wal files are expected
+        self.temporary_directory = tempfile.TemporaryDirectory(
+            ignore_cleanup_errors=True
+        )
+        self.addCleanup(self.temporary_directory.cleanup)
+
     def load_server_with_args(self, argv=[]):
-        argv_to_use = ["server.py"]
+        database_path = pathlib.Path(self.temporary_directory.name) / "jobs.db"
+        self.spool_directory = pathlib.Path(self.temporary_directory.name) / "spool"
+        argv_to_use = [
+            "server.py",
+            f"--job-database-path={database_path}",
+            f"--spool-directory={self.spool_directory}",
+            f"--background-lock-path={pathlib.Path(self.temporary_directory.name) / 'background.lock'}",
+            # the scheduler would ask the mocked lpstat how busy the
+            # printer is before every job, see test_scheduler.py
+            "--max-cups-queue-depth=0",
+        ]
         argv_to_use.extend(argv)
 
         os.environ["RIGHT_PRINTER_NAME"] = "HP_P2015_DN"
@@ -29,8 +82,57 @@ class TestFastAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.text, '"printer is up!"')
 
+    @mock.patch("printer_backends.subprocess.Popen")
+    def test_not_ready_until_cups_is_set_up(self, mock_popen):
+        client = self.load_server_with_args(["--setup-cups"])
+        self.assertEqual(client.get("/live").status_code, 200)
+        response = client.get("/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), "waiting for cups scheduler")
+
+        response = client.post(
+            "/print",
+            files={"file": ("test.txt", io.BytesIO(b"dummy file content"), "text/plain")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        mock_popen.assert_not_called()
+
+        server.cups_readiness.set_ready()
+        self.assertEqual(client.get("/ready").status_code, 200)
+
+        server.cups_readiness.missing_printers = ["left-printer"]
+        response = client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), "ready, not accepting jobs for left-printer")
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_printers_that_cant_print_get_no_jobs(self, mock_open_func, mock_popen):
+        client = self.load_server_with_args(["--collector-metrics-url=http://collector:5000/metrics"])
+        snapshot = {"HP_P2015_DN": PrinterHealth(status=DOWN, problems=["tray_empty"])}
+
+        with mock.patch.object(server.printer_health_monitor, "get_snapshot", return_value=snapshot):
+            health_check = client.get("/healthcheck/printer")
+            health = client.get("/healthcheck/printers")
+            response = client.post(
+                "/print",
+                files={"file": ("test.txt", io.BytesIO(b"dummy file content"), "text/plain")},
+                data={"copies": "1", "sides": "one-sided"},
+            )
+
+        self.assertEqual(health_check.status_code, 503)
+        self.assertIn("tray_empty", health_check.json())
+        self.assertEqual(health.json()["HP_P2015_DN"]["status"], "down")
+        self.assertFalse(health.json()["HP_P2015_DN"]["can_print"])
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        mock_open_func.assert_not_called()
+        mock_popen.assert_not_called()
+
     @mock.patch("server.uuid.uuid4", return_value="test-id")
-    @mock.patch("server.subprocess.Popen")
+    @mock.patch("printer_backends.subprocess.Popen")
     @mock.patch("builtins.open", new_callable=mock.mock_open)
     @mock.patch("pathlib.Path.unlink")
     def test_print_endpoint(self, mock_pathlib_unlink, mock_open_func, mock_popen, _):
@@ -60,7 +162,7 @@ class TestFastAPI(unittest.TestCase):
             },
         )
 
-        mock_open_func.assert_called_once_with("/tmp/test-id", "wb")
+        mock_open_func.assert_called_once_with(f"{self.spool_directory}/test-id", "wb")
 
         mock_open_func().write.assert_called_once()
         self.assertEqual(
@@ -72,7 +174,7 @@ class TestFastAPI(unittest.TestCase):
         self.assertEqual(
             mock_popen.call_args_list[0],
             mock.call(
-                "lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN /tmp/test-id",
+                f"lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/test-id",
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -83,7 +185,7 @@ class TestFastAPI(unittest.TestCase):
         mock_pathlib_unlink.assert_called_once()
 
     @mock.patch("server.uuid.uuid4", return_value="test-id")
-    @mock.patch("server.subprocess.Popen")
+    @mock.patch("printer_backends.subprocess.Popen")
     @mock.patch("builtins.open", new_callable=mock.mock_open)
     @mock.patch("pathlib.Path.unlink")
     def test_print_endpoint_dont_delete_pdf(
@@ -114,7 +216,7 @@ class TestFastAPI(unittest.TestCase):
             },
         )
 
-        mock_open_func.assert_called_once_with("/tmp/test-id", "wb")
+        mock_open_func.assert_called_once_with(f"{self.spool_directory}/test-id", "wb")
 
         mock_open_func().write.assert_called_once()
         self.assertEqual(
@@ -126,7 +228,7 @@ class TestFastAPI(unittest.TestCase):
         self.assertEqual(
             mock_popen.call_args_list[0],
             mock.call(
-                "lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN /tmp/test-id",
+                f"lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/test-id",
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -136,7 +238,7 @@ class TestFastAPI(unittest.TestCase):
 
         mock_pathlib_unlink.assert_not_called()
 
-    @mock.patch("server.subprocess.Popen")
+    @mock.patch("printer_backends.subprocess.Popen")
     @mock.patch("builtins.open", side_effect=FileNotFoundError("sorry!"))
     @mock.patch("pathlib.Path.unlink")
     def test_print_endpoint_file_not_found(self, mock_pathlib_unlink, _, mock_popen):
@@ -162,7 +264,7 @@ class TestFastAPI(unittest.TestCase):
         mock_pathlib_unlink.assert_not_called()
 
     @mock.patch("server.uuid.uuid4", return_value="test-id")
-    @mock.patch("server.subprocess.Popen")
+    @mock.patch("printer_backends.subprocess.Popen")
     @mock.patch("builtins.open", new_callable=mock.mock_open)
     @mock.patch("pathlib.Path.unlink")
     def test_print_endpoint_nonzero_returncode(
@@ -178,7 +280,7 @@ class TestFastAPI(unittest.TestCase):
         response = client.post(
             "/print",
             files={"file": ("test.txt", test_file, "text/plain")},
-            data={"copies": "1", "sides": "dark-side"},
+            data={"copies": "1", "sides": "one-sided"},
         )
 
         self.assertEqual(response.status_code, 200)
@@ -191,7 +293,7 @@ class TestFastAPI(unittest.TestCase):
             },
         )
 
-        mock_open_func.assert_called_once_with("/tmp/test-id", "wb")
+        mock_open_func.assert_called_once_with(f"{self.spool_directory}/test-id", "wb")
 
         mock_open_func().write.assert_called_once()
         self.assertEqual(
@@ -203,7 +305,7 @@ class TestFastAPI(unittest.TestCase):
         self.assertEqual(
             mock_popen.call_args_list[0],
             mock.call(
-                "lp -n 1  -o sides=dark-side -o media=na_letter_8.5x11in -d HP_P2015_DN /tmp/test-id",
+                f"lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/test-id",
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -214,7 +316,7 @@ class TestFastAPI(unittest.TestCase):
         mock_pathlib_unlink.assert_called_once()
 
     @mock.patch("server.uuid.uuid4", return_value="test-id")
-    @mock.patch("server.subprocess.Popen")
+    @mock.patch("printer_backends.subprocess.Popen")
     @mock.patch("builtins.open", new_callable=mock.mock_open)
     @mock.patch("pathlib.Path.unlink")
     def test_junk_print_id(self, mock_pathlib_unlink, mock_open_func, mock_popen, _):
@@ -240,7 +342,7 @@ class TestFastAPI(unittest.TestCase):
             },
         )
 
-        mock_open_func.assert_called_once_with("/tmp/test-id", "wb")
+        mock_open_func.assert_called_once_with(f"{self.spool_directory}/test-id", "wb")
 
         mock_open_func().write.assert_called_once()
         self.assertEqual(
@@ -252,7 +354,7 @@ class TestFastAPI(unittest.TestCase):
         self.assertEqual(
             mock_popen.call_args_list[0],
             mock.call(
-                "lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN /tmp/test-id",
+                f"lp -n 1  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/test-id",
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -262,6 +364,653 @@ class TestFastAPI(unittest.TestCase):
 
         mock_pathlib_unlink.assert_called_once()
 
+    @mock.patch("server.uuid.uuid4", return_value="test-id")
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_print_is_recorded_in_job_store(self, _, __, mock_popen, ___):
+        client = self.load_server_with_args()
+
+        mock_popen_result = mock.MagicMock()
+        mock_popen_result.returncode = 0
+        mock_popen_result.stdout.read.return_value = (
+            "request id is HP_LaserJet_p2015dn_Right-53 (1 file(s))"
+        )
+        mock_popen.return_value = mock_popen_result
+
+        response = client.post(
+            "/print",
+            files={"file": ("test.txt", io.BytesIO(b"dummy file content"), "text/plain")},
+            data={"copies": "2", "sides": "one-sided"},
+        )
+        self.assertEqual(response.status_code, 200)
+        server.job_store.flush()
+
+        response = client.get("/jobs", params={"since": 0})
+        self.assertEqual(response.status_code, 200)
+        jobs = response.json()["jobs"]
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["print_id"], "HP_LaserJet_p2015dn_Right-53")
+        self.assertEqual(jobs[0]["file_id"], "test-id")
+        self.assertEqual(jobs[0]["copies"], 2)
+
+        response = client.get("/jobs", params={"since": jobs[0]["time"] + 1})
+        self.assertEqual(response.json(), {"jobs": []})
+
+    @mock.patch("server.uuid.uuid4", return_value="test-id")
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_print_request_metrics(self, _, __, mock_popen, ___):
+        client = self.load_server_with_args()
+        mock_popen_result = mock.MagicMock()
+        mock_popen_result.returncode = 1
+        mock_popen.return_value = mock_popen_result
+
+        def get_sample(name, **labels):
+            # REGISTRY.get_sample_value would also run the process
+            # collector, which reads /proc with the mocked open()
+            for metric in Metrics:
+                for family in getattr(server.metrics_handler, metric.title).collect():
+                    for sample in family.samples:
+                        if sample.name == name and sample.labels == labels:
+                            return sample.value
+            return 0
+
+        names = (
+            "print_request_seconds_count",
+            "print_upload_receive_seconds_count",
+            "print_disk_write_seconds_count",
+            "print_bytes_received_total",
+        )
+        before = {name: get_sample(name) for name in names}
+        submissions_before = get_sample(
+            "print_submission_seconds_count", printer="HP_P2015_DN"
+        )
+        errors_before = get_sample("print_errors_total", kind="print_failed")
+
+        client.post(
+            "/print",
+            files={"file": ("test.txt", io.BytesIO(b"dummy file content"), "text/plain")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+
+        for name in names[:-1]:
+            self.assertEqual(get_sample(name), before[name] + 1, name)
+        self.assertEqual(
+            get_sample("print_bytes_received_total"),
+            before["print_bytes_received_total"] + len(b"dummy file content"),
+        )
+        self.assertEqual(
+            get_sample("print_submission_seconds_count", printer="HP_P2015_DN"),
+            submissions_before + 1,
+        )
+        self.assertEqual(
+            get_sample("print_errors_total", kind="print_failed"), errors_before + 1
+        )
+        self.assertEqual(get_sample("print_requests_in_flight"), 0)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_duplicate_upload_is_not_printed_again(self, _, __, mock_popen):
+        client = self.load_server_with_args()
+        mock_popen_result = mock.MagicMock()
+        mock_popen_result.returncode = 0
+        mock_popen_result.stdout.read.return_value = (
+            "request id is HP_LaserJet_p2015dn_Right-53 (1 file(s))"
+        )
+        mock_popen.return_value = mock_popen_result
+
+        def post(content, copies="1", user_id="student"):
+            data = {"copies": copies, "sides": "one-sided"}
+            if user_id:
+                data["user_id"] = user_id
+            return client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(content), "application/pdf")},
+                data=data,
+            ).json()
+
+        self.assertEqual(post(b"dummy file content"), {"print_id": "HP_LaserJet_p2015dn_Right-53"})
+        self.assertEqual(post(b"dummy file content"), {"print_id": "HP_LaserJet_p2015dn_Right-53"})
+        self.assertEqual(mock_popen.call_count, 1)
+
+        # a different file or different options are printed as usual
+        post(b"other file content")
+        post(b"dummy file content", copies="2")
+        self.assertEqual(mock_popen.call_count, 3)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_print_options_are_validated(self, mock_open_func, mock_popen):
+        client = self.load_server_with_args()
+
+        def post(copies, sides="one-sided"):
+            return client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                data={"copies": copies, "sides": sides, "user_id": "student"},
+            )
+
+        # " 10" would have printed 10 copies and counted as 1 toward
+        # the quota
+        for copies in [" 10", "0", "101", "1; rm -rf /", "-1"]:
+            self.assertEqual(post(copies).status_code, 400, copies)
+        self.assertEqual(post("1", sides="dark-side").status_code, 400)
+        mock_open_func.assert_not_called()
+        mock_popen.assert_not_called()
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_same_upload_from_different_users_is_printed(self, _, __, mock_popen):
+        client = self.load_server_with_args()
+        self.mock_successful_lp(mock_popen)
+
+        def post(user_id=None):
+            data = {"copies": "1", "sides": "one-sided"}
+            if user_id:
+                data["user_id"] = user_id
+            response = client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                data=data,
+            )
+            self.assertEqual(response.status_code, 200)
+
+        # they all come from the ssh tunnel's 127.0.0.1
+        post("student")
+        post("other-student")
+        self.assertEqual(mock_popen.call_count, 2)
+
+        # without a user id there's no telling who sent it
+        post()
+        post()
+        self.assertEqual(mock_popen.call_count, 4)
+
+    def mock_successful_lp(self, mock_popen):
+        mock_popen_result = mock.MagicMock()
+        mock_popen_result.returncode = 0
+        mock_popen_result.stdout.read.return_value = (
+            "request id is HP_LaserJet_p2015dn_Right-53 (1 file(s))"
+        )
+        mock_popen.return_value = mock_popen_result
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_idempotency_key_retries_are_not_printed_again(self, _, __, mock_popen):
+        client = self.load_server_with_args(["--dedupe-window-seconds=0"])
+        self.mock_successful_lp(mock_popen)
+
+        def post(headers={}, data={}):
+            return client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                data={"copies": "1", "sides": "one-sided", **data},
+                headers=headers,
+            ).json()
+
+        expected = {"print_id": "HP_LaserJet_p2015dn_Right-53"}
+        self.assertEqual(post(headers={"Idempotency-Key": "key-1"}), expected)
+        self.assertEqual(post(headers={"Idempotency-Key": "key-1"}), expected)
+        self.assertEqual(mock_popen.call_count, 1)
+
+        self.assertEqual(post(data={"idempotency_key": "key-2"}), expected)
+        self.assertEqual(post(data={"idempotency_key": "key-2"}), expected)
+        self.assertEqual(mock_popen.call_count, 2)
+
+        # without a key every request prints
+        post()
+        self.assertEqual(mock_popen.call_count, 3)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("pathlib.Path.unlink")
+    def test_failed_request_with_idempotency_key_can_be_retried(self, _, mock_popen):
+        client = self.load_server_with_args(["--dedupe-window-seconds=0"])
+        mock_popen_result = mock.MagicMock()
+        mock_popen_result.returncode = 1
+        mock_popen.return_value = mock_popen_result
+
+        def post():
+            with mock.patch("builtins.open", new_callable=mock.mock_open):
+                return client.post(
+                    "/print",
+                    files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                    data={"copies": "1", "sides": "one-sided"},
+                    headers={"Idempotency-Key": "key-1"},
+                ).json()
+
+        self.assertEqual(post()["status_code"], 500)
+        self.mock_successful_lp(mock_popen)
+        self.assertEqual(post(), {"print_id": "HP_LaserJet_p2015dn_Right-53"})
+        self.assertEqual(mock_popen.call_count, 2)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("pathlib.Path.unlink")
+    def test_persisted_idempotency_keys_survive_a_restart(self, _, mock_popen):
+        self.mock_successful_lp(mock_popen)
+
+        def post(client):
+            with mock.patch("builtins.open", new_callable=mock.mock_open):
+                return client.post(
+                    "/print",
+                    files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                    data={"copies": "1", "sides": "one-sided"},
+                    headers={"Idempotency-Key": "key-1"},
+                ).json()
+
+        client = self.load_server_with_args(["--persist-idempotency-keys"])
+        post(client)
+        server.job_store.flush()
+
+        client = self.load_server_with_args(["--persist-idempotency-keys"])
+        self.assertEqual(post(client), {"print_id": "HP_LaserJet_p2015dn_Right-53"})
+        self.assertEqual(mock_popen.call_count, 1)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_print_requests_past_the_user_limit_are_rejected(self, _, __, mock_popen):
+        client = self.load_server_with_args(
+            ["--client-burst=2", "--dedupe-window-seconds=0"]
+        )
+        self.mock_successful_lp(mock_popen)
+
+        def post(user_id=None):
+            data = {"copies": "1", "sides": "one-sided"}
+            if user_id:
+                data["user_id"] = user_id
+            return client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                data=data,
+            )
+
+        responses = [post("student") for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(responses[2].headers["Retry-After"], "2")
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertEqual(server.admission_controller.jobs, 0)
+
+        # everyone comes from the ssh tunnel's 127.0.0.1, so other users
+        # and requests without a user id aren't held back by it
+        self.assertEqual(post("other-student").status_code, 200)
+        self.assertEqual([post().status_code for _ in range(3)], [200, 200, 200])
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_print_requests_past_the_job_limit_are_rejected(self, mock_open_func, mock_popen):
+        client = self.load_server_with_args(["--max-admitted-jobs=1"])
+        # stands in for a request that's still uploading
+        server.admission_controller.admit()
+
+        response = client.post(
+            "/print",
+            files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        mock_open_func.assert_not_called()
+        mock_popen.assert_not_called()
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("pathlib.Path.unlink")
+    def test_async_print_returns_a_job_handle(self, _, mock_popen):
+        self.load_server_with_args()
+        self.mock_successful_lp(mock_popen)
+
+        with TestClient(server.app) as client:
+            with mock.patch("builtins.open", new_callable=mock.mock_open):
+                response = client.post(
+                    "/print",
+                    files={"file": ("test.pdf", io.BytesIO(b"dummy file content"), "application/pdf")},
+                    data={"copies": "1", "sides": "one-sided"},
+                    headers={"Prefer": "respond-async"},
+                )
+            self.assertEqual(response.status_code, 200)
+            job_id = response.json()["job_id"]
+            self.assertEqual(response.json()["status_url"], f"/jobs/{job_id}")
+
+            # the job finishes getting sent to cups in the background
+            for task in list(server.background_print_tasks):
+                client.portal.call(asyncio.wait_for, task, 5)
+            job = client.get(f"/jobs/{job_id}").json()
+            self.assertEqual(job["state"], "spooled")
+            self.assertEqual(job["print_id"], "HP_LaserJet_p2015dn_Right-53")
+            self.assertEqual(server.admission_controller.jobs, 0)
+
+            server.job_tracker.record_cups_state("HP_LaserJet_p2015dn_Right-53", "completed")
+            with client.stream("GET", f"/jobs/{job_id}/events") as response:
+                body = "".join(response.iter_text())
+            self.assertEqual(body.count("event: state"), 1)
+            self.assertIn('"state": "completed"', body)
+
+        self.assertEqual(client.get("/jobs/not-a-job").status_code, 404)
+
+    def test_job_events_stream_until_the_job_finishes(self):
+        client = self.load_server_with_args()
+        server.job_tracker.set_state("test-id", "spooled", print_id="right-printer-1")
+
+        def finish_printing():
+            time.sleep(0.2)
+            server.job_tracker.record_cups_state("right-printer-1", "processing")
+            server.job_tracker.record_cups_state("right-printer-1", "completed")
+
+        threading.Thread(target=finish_printing).start()
+        with client.stream("GET", "/jobs/test-id/events") as response:
+            states = [
+                json.loads(line.removeprefix("data: "))["state"]
+                for line in response.iter_lines()
+                if line.startswith("data: ")
+            ]
+
+        self.assertEqual(states, ["spooled", "printing", "completed"])
+
+    def test_job_state_is_read_back_from_the_database(self):
+        client = self.load_server_with_args()
+        server.job_store.record_job("right-printer-1", "old-job", copies=1)
+        server.job_store.record_job_state("right-printer-1", "processing")
+        server.job_store.record_job(None, "failed-job", copies=1)
+        # waiting on another worker's scheduler
+        server.job_store.record_job(None, "queued-job", copies=1, state="queued")
+        server.job_store.flush()
+
+        self.assertEqual(client.get("/jobs/old-job").json()["state"], "printing")
+        self.assertEqual(client.get("/jobs/failed-job").json()["state"], "failed")
+        self.assertEqual(client.get("/jobs/queued-job").json()["state"], "queued")
+        server.job_store.record_job_sent("queued-job", "right-printer-2", printer="right-printer")
+        server.job_store.flush()
+        self.assertEqual(client.get("/jobs/queued-job").json()["state"], "spooled")
+        # unfinished jobs are picked back up by the tracker
+        server.job_tracker.record_cups_state("right-printer-1", "completed")
+        self.assertEqual(client.get("/jobs/old-job").json()["state"], "completed")
+
+    @mock.patch("server.uuid.uuid4", side_effect=["file-1", "file-2"])
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    @mock.patch("pathlib.Path.unlink")
+    def test_batch_print(self, _, __, mock_popen, ___):
+        client = self.load_server_with_args()
+        results = []
+        for print_id in ("HP_P2015_DN-53", "HP_P2015_DN-54"):
+            result = mock.MagicMock()
+            result.returncode = 0
+            result.stdout.read.return_value = f"request id is {print_id} (1 file(s))"
+            results.append(result)
+        mock_popen.side_effect = results
+
+        with mock.patch.object(
+            server.print_scheduler, "turn", wraps=server.print_scheduler.turn
+        ) as mock_turn:
+            response = client.post(
+                "/print/batch",
+                files=[
+                    ("files", ("a.pdf", io.BytesIO(b"first file"), "application/pdf")),
+                    ("files", ("b.pdf", io.BytesIO(b"second file"), "application/pdf")),
+                ],
+                data={
+                    "copies": ["2", "1"],
+                    "sides": ["one-sided", "two-sided-long-edge"],
+                    "page_range": ["", "1-3, 5"],
+                },
+            )
+
+        self.assertEqual(response.status_code, 200)
+        # both files went to cups in a single turn, weighted by both
+        mock_turn.assert_called_once_with("file-1", "testclient", 3)
+        self.assertEqual(response.json(), {"print_ids": ["HP_P2015_DN-53", "HP_P2015_DN-54"]})
+        self.assertEqual(
+            [call.args[0] for call in mock_popen.call_args_list],
+            [
+                f"lp -n 2  -o sides=one-sided -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/file-1",
+                f"lp -n 1 -o page-ranges=1-3,5-5 -o sides=two-sided-long-edge -o media=na_letter_8.5x11in -d HP_P2015_DN {self.spool_directory}/file-2",
+            ],
+        )
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_batch_print_rejects_bad_options(self, mock_open_func, mock_popen):
+        client = self.load_server_with_args()
+
+        def post(data):
+            return client.post(
+                "/print/batch",
+                files=[
+                    ("files", ("a.pdf", io.BytesIO(b"first file"), "application/pdf")),
+                    ("files", ("b.pdf", io.BytesIO(b"second file"), "application/pdf")),
+                ],
+                data={"copies": ["1", "1"], "sides": ["one-sided", "one-sided"], **data},
+            )
+
+        self.assertEqual(post({"copies": ["1"]}).status_code, 400)
+        self.assertEqual(post({"copies": ["1", "many"]}).status_code, 400)
+        self.assertEqual(post({"sides": ["one-sided", "; rm -rf /"]}).status_code, 400)
+        self.assertEqual(post({"page_range": ["1-3", "1-3; rm -rf /"]}).status_code, 400)
+        self.assertEqual(post({"page_range": ["1-3", "5-2"]}).status_code, 400)
+        mock_open_func.assert_not_called()
+        mock_popen.assert_not_called()
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    def test_pdf_pages_are_counted_before_printing(self, mock_popen):
+        client = self.load_server_with_args()
+        self.mock_successful_lp(mock_popen)
+        file_ids = [f"test-pdf-{i}" for i in range(3)]
+        pages_before = server.metrics_handler.print_pages_submitted.labels(
+            printer="HP_P2015_DN"
+        )._value.get()
+
+        def post(copies, page_range=None):
+            if page_range is None:
+                return client.post(
+                    "/print",
+                    files={"file": ("test.pdf", io.BytesIO(test_pdf.make_pdf(12)), "application/pdf")},
+                    data={"copies": copies, "sides": "one-sided"},
+                )
+            return client.post(
+                "/print/batch",
+                files={"files": ("test.pdf", io.BytesIO(test_pdf.make_pdf(12)), "application/pdf")},
+                data={"copies": copies, "sides": "one-sided", "page_range": page_range},
+            )
+
+        with mock.patch("server.uuid.uuid4", side_effect=file_ids):
+            too_many_pages = post("30")
+            past_the_end = post("1", page_range="10-20")
+            printed = post("2", page_range="1-3,3-4")
+
+        self.assertEqual(too_many_pages.status_code, 400)
+        self.assertIn("360 pages", too_many_pages.json()["detail"])
+        self.assertEqual(past_the_end.status_code, 400)
+        self.assertIn("12 page document", past_the_end.json()["detail"])
+        self.assertEqual(printed.status_code, 200)
+        mock_popen.assert_called_once()
+
+        server.job_store.flush()
+        self.assertEqual(server.job_store.get_job("test-pdf-2")["pages"], 4)
+        self.assertEqual(server.job_tracker.get("test-pdf-0")["state"], "failed")
+        self.assertEqual(
+            server.metrics_handler.print_pages_submitted.labels(
+                printer="HP_P2015_DN"
+            )._value.get(),
+            pages_before + 8,
+        )
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("pathlib.Path.unlink")
+    def test_pdf_without_countable_pages_is_rejected(self, _, mock_popen):
+        client = self.load_server_with_args()
+        self.mock_successful_lp(mock_popen)
+
+        response = client.post(
+            "/print",
+            files={"file": ("test.pdf", io.BytesIO(b"%PDF-1.4 BROKEN"), "application/pdf")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("unable to count the pages", response.json()["detail"])
+        mock_popen.assert_not_called()
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    def test_pdfs_are_normalized_before_printing(self, mock_popen):
+        gs_log = test_normalize.install_fake_gs(self.temporary_directory.name)
+        cache_directory = pathlib.Path(self.temporary_directory.name) / "normalized"
+        with mock.patch.dict(
+            os.environ, {"PATH": f"{self.temporary_directory.name}{os.pathsep}{os.environ['PATH']}"}
+        ):
+            client = self.load_server_with_args(
+                [
+                    "--normalize-format=pcl",
+                    f"--normalize-cache-directory={cache_directory}",
+                    "--dedupe-window-seconds=0",
+                ]
+            )
+            self.addCleanup(server.normalizer.close)
+            self.mock_successful_lp(mock_popen)
+
+            def post(content):
+                return client.post(
+                    "/print",
+                    files={"file": ("test.pdf", io.BytesIO(content), "application/pdf")},
+                    data={"copies": "1", "sides": "one-sided"},
+                )
+
+            handout = test_pdf.make_pdf(3)
+            first = post(handout)
+            second = post(handout)
+            broken = post(b"%PDF-1.4 BROKEN")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(broken.status_code, 400)
+        self.assertIn("startxref", broken.json()["detail"])
+        # the handout was converted once, and the broken pdf was turned
+        # away before it got to ghostscript or lp
+        self.assertEqual(len(gs_log.read_text().splitlines()), 1)
+        # and once it was printed, the conversion could be evicted again
+        self.assertEqual(server.normalizer._pins, {})
+        commands = [call.args[0] for call in mock_popen.call_args_list]
+        self.assertEqual(len(commands), 2)
+        for command in commands:
+            self.assertIn(" -o raw ", command)
+            self.assertIn(str(cache_directory), command)
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    def test_print_requests_past_the_page_quota_are_rejected(self, mock_popen):
+        client = self.load_server_with_args(["--daily-page-quota=10"])
+        self.mock_successful_lp(mock_popen)
+        file_ids = [f"test-quota-{i}" for i in range(2)]
+
+        def post(page_count, copies, user_id="student"):
+            return client.post(
+                "/print",
+                files={"file": ("test.pdf", io.BytesIO(test_pdf.make_pdf(page_count)), "application/pdf")},
+                data={"copies": copies, "sides": "one-sided", "user_id": user_id},
+            )
+
+        # only two uploads may be written to disk, the last request has
+        # to be turned away before its upload is
+        with mock.patch("server.uuid.uuid4", side_effect=file_ids):
+            too_many_pages = post(12, "1")
+            printed = post(5, "2")
+            out_of_pages = post(1, "1")
+
+        self.assertEqual(too_many_pages.status_code, 429)
+        self.assertEqual(server.job_tracker.get("test-quota-0")["state"], "failed")
+        self.assertFalse((self.spool_directory / "test-quota-0").exists())
+        self.assertEqual(printed.status_code, 200)
+        self.assertEqual(out_of_pages.status_code, 429)
+        self.assertGreater(int(out_of_pages.headers["Retry-After"]), 0)
+        mock_popen.assert_called_once()
+        self.assertEqual(
+            client.get("/quota/student").json()["day"], {"used": 10, "limit": 10}
+        )
+
+        server.quota_store.flush()
+        server.job_store.flush()
+        self.assertEqual(server.job_store.get_job("test-quota-1")["user_id"], "student")
+        self.assertEqual(
+            {row["pages"] for row in server.job_store.get_quota_usage(
+                list(quota.get_periods(datetime.datetime.now()).values())
+            )},
+            {10},
+        )
+
+    def test_failed_submission_fails_over_to_next_printer(self):
+        self.load_server_with_args()
+        server.printer_router = routing.PrinterRouter([
+            routing.Printer("LEFT", "left-printer"),
+            routing.Printer("RIGHT", "right-printer"),
+        ])
+        server.printer_router.record_job("right-printer", "right-printer-1", 10)
+
+        with mock.patch.object(
+            server.printer_backend, "submit", side_effect=[None, "right-printer-2"]
+        ) as mock_submit:
+            print_id, printer_name = server.send_file_to_printer("/tmp/test-id", 1)
+
+        self.assertEqual((print_id, printer_name), ("right-printer-2", "right-printer"))
+        self.assertEqual(
+            [call.args[1] for call in mock_submit.call_args_list],
+            ["left-printer", "right-printer"],
+        )
+
+    def write_large_upload(self, size):
+        upload = UploadFile(file=ZeroStream(size), filename="large.pdf")
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = str(pathlib.Path(directory) / "large.pdf")
+            tracemalloc.start()
+            try:
+                bytes_written = asyncio.run(
+                    server.write_upload_to_disk(upload, file_path)
+                )
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(os.path.getsize(file_path), size)
+        return bytes_written, peak
+
+    def test_large_uploads_are_streamed_to_disk(self):
+        self.load_server_with_args(["--max-upload-size-mb=1024"])
+        chunk_size = server.args.upload_chunk_size_kb * 1024
+        for size_mb in (100, 300):
+            size = size_mb * 1024 * 1024
+            bytes_written, peak = self.write_large_upload(size)
+            self.assertEqual(bytes_written, size)
+            # only a couple of chunks should ever be alive at once,
+            # no matter how big the upload is
+            self.assertLess(peak, 4 * chunk_size)
+
+    def test_upload_over_max_size_is_rejected_while_streaming(self):
+        self.load_server_with_args(["--max-upload-size-mb=1"])
+        upload = UploadFile(file=ZeroStream(3 * 1024 * 1024), filename="large.pdf")
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = pathlib.Path(directory) / "large.pdf"
+            with self.assertRaises(HTTPException) as context:
+                asyncio.run(server.write_upload_to_disk(upload, str(file_path)))
+            self.assertEqual(context.exception.status_code, 413)
+            self.assertFalse(file_path.exists())
+
+    @mock.patch("printer_backends.subprocess.Popen")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_print_endpoint_rejects_large_content_length(
+        self, mock_open_func, mock_popen
+    ):
+        client = self.load_server_with_args(["--max-upload-size-mb=1"])
+        test_file = io.BytesIO(bytes(2 * 1024 * 1024))
+        response = client.post(
+            "/print",
+            files={"file": ("test.pdf", test_file, "application/pdf")},
+            data={"copies": "1", "sides": "one-sided"},
+        )
+
+        self.assertEqual(response.status_code, 413)
+        mock_open_func.assert_not_called()
+        mock_popen.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,109 @@
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+import uuid
+
+from metrics import MetricsHandler
+from spool import SpoolManager
+
+
+metrics_handler = MetricsHandler.instance()
+
+
+class TestSpoolManager(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.directory = pathlib.Path(temporary_directory.name) / "spool"
+
+    def write(self, spool_manager, size_bytes=10) -> str:
+        file_path = spool_manager.new_file(str(uuid.uuid4()))
+        pathlib.Path(file_path).write_bytes(bytes(size_bytes))
+        spool_manager.finish_writing(file_path, size_bytes)
+        return file_path
+
+    def write_orphan(self, age_seconds, size_bytes=10, name=None) -> pathlib.Path:
+        path = self.directory / (name or str(uuid.uuid4()))
+        path.write_bytes(bytes(size_bytes))
+        modified_at = time.time() - age_seconds
+        os.utime(path, (modified_at, modified_at))
+        return path
+
+    def test_released_files_are_deleted(self):
+        spool_manager = SpoolManager(self.directory)
+        file_path = self.write(spool_manager, 100)
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 100)
+        self.assertEqual(metrics_handler.spool_files.labels(state="in_use")._value.get(), 1)
+
+        spool_manager.release(file_path)
+        self.assertFalse(pathlib.Path(file_path).exists())
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 0)
+        # releasing twice is fine
+        spool_manager.release(file_path)
+
+    def test_only_the_newest_kept_files_stay(self):
+        spool_manager = SpoolManager(self.directory, keep_files=2)
+        file_paths = [self.write(spool_manager) for _ in range(3)]
+        for file_path in file_paths:
+            spool_manager.release(file_path)
+
+        self.assertEqual(
+            [pathlib.Path(file_path).exists() for file_path in file_paths],
+            [False, True, True],
+        )
+        self.assertEqual(metrics_handler.spool_files.labels(state="kept")._value.get(), 2)
+
+    def test_sweep_deletes_old_files(self):
+        spool_manager = SpoolManager(self.directory, max_age_seconds=60, orphan_grace_seconds=0)
+        in_use = self.write(spool_manager)
+        old = self.write_orphan(age_seconds=120)
+        new = self.write_orphan(age_seconds=0)
+        not_ours = self.write_orphan(age_seconds=120, name="jobs.db")
+
+        spool_manager.sweep(now=time.time() + 120)
+        self.assertTrue(pathlib.Path(in_use).exists())
+        self.assertFalse(old.exists())
+        self.assertFalse(new.exists())
+        self.assertTrue(not_ours.exists())
+
+    def test_sweep_deletes_oldest_files_past_max_bytes(self):
+        spool_manager = SpoolManager(
+            self.directory, max_age_seconds=0, max_bytes=250, orphan_grace_seconds=0
+        )
+        in_use = self.write(spool_manager, 100)
+        oldest = self.write_orphan(age_seconds=30, size_bytes=100)
+        middle = self.write_orphan(age_seconds=20, size_bytes=100)
+        newest = self.write_orphan(age_seconds=10, size_bytes=60)
+
+        spool_manager.sweep()
+        self.assertTrue(pathlib.Path(in_use).exists())
+        self.assertFalse(oldest.exists())
+        self.assertFalse(middle.exists())
+        self.assertTrue(newest.exists())
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 160)
+        self.assertEqual(metrics_handler.spool_files.labels(state="orphaned")._value.get(), 1)
+
+    def test_other_workers_uploads_are_left_alone(self):
+        spool_manager = SpoolManager(
+            self.directory, max_age_seconds=0, max_bytes=50, orphan_grace_seconds=60
+        )
+        # written by another worker a moment ago, still on its way to cups
+        uploading = self.write_orphan(age_seconds=1, size_bytes=100)
+        spool_manager.sweep()
+        self.assertTrue(uploading.exists())
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 0)
+
+        # kept by another worker, which deletes it after we've seen it
+        kept = self.write_orphan(age_seconds=120, size_bytes=40)
+        spool_manager.sweep()
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 40)
+        kept.unlink()
+        spool_manager.sweep()
+        self.assertEqual(metrics_handler.spool_bytes._value.get(), 0)
+        self.assertEqual(metrics_handler.spool_files.labels(state="orphaned")._value.get(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import http.server
+import sys
+import threading
+import time
+import unittest
+
+from metrics import MetricsHandler
+from ssh_tunnel import SshTunnel
+
+
+metrics_handler = MetricsHandler.instance()
+
+# stands in for ssh, runs until it's killed
+LONG_RUNNING_COMMAND = [sys.executable, "-c", "import time; time.sleep(60)"]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting")
+        time.sleep(0.01)
+
+
+def get_reconnects(reason):
+    return metrics_handler.ssh_tunnel_reconnects.labels(reason=reason)._value.get()
+
+
+class QuietHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"tunnel is up!")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSshTunnel(unittest.TestCase):
+    def start_tunnel(self, command, **kwargs) -> SshTunnel:
+        tunnel = SshTunnel(
+            command,
+            min_backoff_seconds=0.01,
+            max_backoff_seconds=0.02,
+            **kwargs,
+        )
+        tunnel.start()
+        self.addCleanup(tunnel.stop)
+        return tunnel
+
+    def test_backoff(self):
+        tunnel = SshTunnel([], min_backoff_seconds=1, max_backoff_seconds=60)
+        for failures, longest in [(0, 1), (1, 2), (3, 8), (10, 60)]:
+            for _ in range(20):
+                self.assertTrue(longest / 2 <= tunnel.get_backoff_seconds(failures) <= longest)
+
+    def test_exited_ssh_is_restarted(self):
+        before = get_reconnects("exited")
+        self.start_tunnel([sys.executable, "-c", "pass"])
+        wait_for(lambda: get_reconnects("exited") >= before + 3)
+
+    def test_up_while_ssh_runs(self):
+        tunnel = self.start_tunnel(LONG_RUNNING_COMMAND, probe_interval_seconds=0.05)
+        wait_for(lambda: tunnel.is_up)
+        self.assertEqual(metrics_handler.ssh_tunnel_up._value.get(), 1)
+        process = tunnel._process
+
+        tunnel.stop()
+        self.assertFalse(tunnel.is_up)
+        self.assertIsNotNone(process.poll())
+
+    def test_failed_probes_restart_ssh(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        before = get_reconnects("probe_failed")
+
+        tunnel = self.start_tunnel(
+            LONG_RUNNING_COMMAND,
+            probe_url=f"http://127.0.0.1:{server.server_address[1]}/healthcheck/tunnel",
+            probe_interval_seconds=0.05,
+            probe_timeout_seconds=1,
+            max_probe_failures=2,
+        )
+        wait_for(lambda: tunnel.is_up)
+        first_process = tunnel._process
+
+        # i.e. core-v4 restarted and the forward is gone, ssh doesn't notice
+        server.shutdown()
+        server.server_close()
+        wait_for(lambda: get_reconnects("probe_failed") == before + 1)
+        self.assertIsNotNone(first_process.poll())
+
+    def test_probe_that_never_worked_is_ignored(self):
+        before = get_reconnects("probe_failed")
+        tunnel = self.start_tunnel(
+            LONG_RUNNING_COMMAND,
+            # nothing listens on port 9 here
+            probe_url="http://127.0.0.1:9/healthcheck/tunnel",
+            probe_interval_seconds=0.05,
+            max_probe_failures=1,
+        )
+        wait_for(lambda: tunnel.is_up)
+        time.sleep(0.3)
+        self.assertTrue(tunnel.is_up)
+        self.assertEqual(get_reconnects("probe_failed"), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
-import subprocess
+import os
 import time
 import logging
 from datetime import datetime
 import platform  # Required for OS detection
 
+import printer_backends
+from queue_monitor import QueueMonitor
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(message)s',
@@ -15,64 +18,63 @@ logging.basicConfig(
 )
 
 PRINTER_NAME = "right-printer"
-INTERVAL_SECONDS = 5  # Check every 5 seconds
+# "ipp" reads the queue from cups directly instead of forking lpstat
+PRINTER_BACKEND = os.environ.get("PRINTER_BACKEND", "lp")
+CUPS_URL = os.environ.get("CUPS_URL", "http://localhost:631")
+# the queue is checked this often while it has jobs in it, and
+# backs off up to MAX_INTERVAL_SECONDS while it's empty. same as the
+# server, forking lpstat every second costs too much
+MIN_INTERVAL_SECONDS = 1 if PRINTER_BACKEND == "ipp" else 5
+MAX_INTERVAL_SECONDS = 60
 
 class PrinterMock:
     def __init__(self):
         self.job_counter = 1
-        
+
     def generate_mock_jobs(self):
         """Creates realistic mock print jobs"""
         self.job_counter += 1
         current_time = datetime.now().strftime('%a %b %d %H:%M:%S %Y')
-        
+
         # Simulate 1-3 random jobs
-        num_jobs = self.job_counter % 3 + 1  
+        num_jobs = self.job_counter % 3 + 1
         jobs = []
         for i in range(num_jobs):
             jobs.append(
                 f"{PRINTER_NAME}-{self.job_counter+i} user{i+1} {1024*(i+1)} {current_time}"
             )
-        return "\n".join(jobs) if jobs else "no entries"
+        return printer_backends.parse_lpstat_output("\n".join(jobs), PRINTER_NAME)
 
-printer_mock = PrinterMock()
+    def get_queue(self, printer_name):
+        return self.generate_mock_jobs()
 
-def get_print_queue():
-    try:
-        if platform.system() == "Windows":
-            # Windows mock mode
-            return printer_mock.generate_mock_jobs()
-        else:
-            # Real Linux mode
-            result = subprocess.run(
-                ["lpstat", "-o", PRINTER_NAME],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
-            )
-            return result.stdout.strip()
-    except Exception as e:
-        logging.error(f"Error: {str(e)}")
-        return None
+    def get_finished_jobs(self, printer_name):
+        # mock jobs vanish without a trace, so they count as completed
+        return []
+
+def get_backend():
+    if platform.system() == "Windows":
+        # Windows mock mode
+        return PrinterMock()
+    # Real Linux mode
+    return printer_backends.get_backend(PRINTER_BACKEND, cups_url=CUPS_URL, pool_size=1)
 
 def main():
-    #logging.info(f"Starting print queue monitor for printer: {PRINTER_NAME}")
-    #logging.info(f"Checking every {INTERVAL_SECONDS} seconds (Ctrl+C to stop)")
-    
+    # only changes to the queue get logged, see QueueMonitor
+    monitor = QueueMonitor(
+        [PRINTER_NAME],
+        get_backend(),
+        min_interval_seconds=MIN_INTERVAL_SECONDS,
+        max_interval_seconds=MAX_INTERVAL_SECONDS,
+    )
+    logging.info(f"Starting print queue monitor for printer: {PRINTER_NAME}")
+    monitor.start()
     try:
         while True:
-            queue_info = get_print_queue()
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            if queue_info:
-                logging.info(f"{timestamp} - Print queue status:\n{queue_info}")
-            else:
-                logging.info(f"{timestamp} - No queue information available")
-            
-            time.sleep(INTERVAL_SECONDS)
+            time.sleep(1)
     except KeyboardInterrupt:
+        monitor.stop()
         logging.info("Monitoring stopped by user")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
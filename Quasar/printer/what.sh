@@ -1,8 +1,5 @@
 #!/bin/sh
 
-# get Core-v4 ip from config.json
-CORE_V4_IP=$(cat /app/config/config.json | jq -r ".HEALTH_CHECK.CORE_V4_IP") 
-
 # known_hosts remembers servers we've ssh'd into in the past.
 # ssh can use this file to verify the legitimacy of CORE_V4_IP.
 # So, we know for sure that we're setting up a connection to Core-v4
@@ -24,11 +21,14 @@ CORE_V4_PORT=14000
 # out to Core-v4. 
 QUASAR_PORT=9000
 
-# intermediate variable to feed ssh command. It will look like sce@XXX.XXX.XXX.XXX
-CORE_V4_HOST=sce@${CORE_V4_IP}
-
 # Start the tunnel!
 open_ssh_tunnel () {
+    # get Core-v4 ip from config.json
+    CORE_V4_IP=$(cat /app/config/config.json | jq -r ".HEALTH_CHECK.CORE_V4_IP")
+
+    # intermediate variable to feed ssh command. It will look like sce@XXX.XXX.XXX.XXX
+    CORE_V4_HOST=sce@${CORE_V4_IP}
+
     # (more info about the switches can be found in "man ssh")
     # -o is for option to give known_hosts
     # -i is for giving Quasar's private key
@@ -54,19 +54,6 @@ open_ssh_tunnel () {
 chmod 600 ${DOCKER_CONTAINER_SSH_KEYS}
 
 
-# in https://stackoverflow.com/a/41518225 we trust
-
-# This function sets up the left and right printer to be used
-# with the Line Printer Daemon protocol. To read more about it
-# check out the below link:
-# https://en.wikipedia.org/wiki/Line_Printer_Daemon_protocol
-create_and_enable_printer() {
-    echo "Setting up $1 with ip address $2"
-    lpadmin -p $1 -v $2
-    lpadmin -d $1 -P /etc/cups/ppd/HP-LaserJet-p2015dn.ppd
-    cupsenable $1 && cupsaccept $1
-}
-
 # if the first argument passed to the script, is --tunnel-only,
 # we just open the ssh tunnel. i.e.
 #
@@ -81,6 +68,10 @@ if [ "$1" = "--tunnel-only" ]
 then
     open_ssh_tunnel
 else
+    # server.py measures how long it takes to be ready to print from here,
+    # see server_startup_seconds in /metrics
+    export QUASAR_STARTED_AT=$(date +%s.%N)
+
     # The below command starts CUPS in the background. Our base image for the
     # printing container comes with /root/start-cups.sh. Because the print
     # container is built from said image, the script comes with the build steps. 
@@ -88,24 +79,14 @@ else
     # https://github.com/DrPsychick/docker-cups-airprint/blob/d4c701b5a2897897413b22bd705c74159a579acc/start-cups.sh
     /root/start-cups.sh > /dev/null 2>&1 & 
 
-    # CUPS takes a bit to start running, so before we add our two SCE printers the
-    # script hangs out for 10 seconds.
-    sleep 10
+    # CUPS takes a bit to start running. Rather than waiting here, the server
+    # starts right away with --setup-cups, which has it poll CUPS until it's up,
+    # add the enabled printers in config.json to it with the Line Printer Daemon
+    # protocol (https://en.wikipedia.org/wiki/Line_Printer_Daemon_protocol) and
+    # only then report /ready and take print jobs.
 
-    # Call the above function for the left and right printers, both values
-    # defined in a config.json file. See this repo's README.md for more info.
-    if [ $(cat config/config.json | jq ".PRINTING.LEFT.ENABLED") = "true"  ]; then
-        export LEFT_PRINTER_NAME=$(jq -r '.PRINTING.LEFT.NAME' config/config.json)
-        export LEFT_PRINTER_LPD_URL=$(jq -r '.PRINTING.LEFT.LPD_URL' config/config.json)                         
-        create_and_enable_printer $LEFT_PRINTER_NAME $LEFT_PRINTER_LPD_URL
-    fi
-
-    if [ $(cat config/config.json | jq ".PRINTING.RIGHT.ENABLED") = "true"  ]; then
-        export RIGHT_PRINTER_NAME=$(jq -r '.PRINTING.RIGHT.NAME' config/config.json)
-        export RIGHT_PRINTER_LPD_URL=$(jq -r '.PRINTING.RIGHT.LPD_URL' config/config.json)                       
-        create_and_enable_printer $RIGHT_PRINTER_NAME $RIGHT_PRINTER_LPD_URL
-    fi
-    open_ssh_tunnel
-    python3 /app/printer/server.py $@
+    # server.py opens the ssh tunnel itself and reopens it when it
+    # drops, see ssh_tunnel.py
+    exec python3 /app/printer/server.py --setup-cups $@
 fi
 